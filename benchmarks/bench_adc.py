@@ -0,0 +1,50 @@
+"""
+Benchmark ADC parsing: type inference vs. schema-typed parsing
+vs. schema-typed parsing of only the image columns.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/bench_adc.py [n_targets]
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from ifcb.data.adc import parse_adc_file, SCHEMA_VERSION_2
+from ifcb.tests.utils import test_dir
+
+def synthetic_adc(path, n_targets):
+    """write a plausible schema version 2 .adc file"""
+    r = np.random.RandomState(0)
+    t = np.cumsum(r.uniform(0.01, 0.2, n_targets))
+    widths = r.randint(0, 300, n_targets) * (r.uniform(size=n_targets) > 0.3)
+    heights = r.randint(20, 200, n_targets) * (widths > 0)
+    start_bytes = np.cumsum(np.concatenate([[0], (widths * heights)[:-1]]))
+    with open(path, 'w') as fout:
+        for i in range(n_targets):
+            pmts = ','.join('%.5f' % v for v in r.uniform(0, 5, 8))
+            fout.write('%d,%.6f,%s,-999.00000,%.6f,%.6f,%d,%d,%d,%d,%d,-999.000000,0,0,0,%.6f,%.6f\n' % (
+                i+1, t[i], pmts, t[i], t[i] + 0.05, r.randint(0, 1300), r.randint(0, 1000),
+                widths[i], heights[i], start_bytes[i], t[i] + 0.06, t[i] / 10))
+
+def bench(label, fn, number=5):
+    secs = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    df = fn()
+    mem = df.memory_usage(deep=True).sum()
+    print('%-24s %8.2f ms/bin %10.1f KiB/bin' % (label, secs * 1000, mem / 1024.))
+
+def main(n_targets=50000):
+    with test_dir() as d:
+        path = os.path.join(d, 'D20180101T000000_IFCB999.adc')
+        synthetic_adc(path, n_targets)
+        s = SCHEMA_VERSION_2
+        print('%d targets, %d bytes' % (n_targets, os.path.getsize(path)))
+        bench('inferred', lambda: pd.read_csv(path, header=None, index_col=False))
+        bench('schema-typed', lambda: parse_adc_file(path))
+        bench('schema-typed, images', lambda: parse_adc_file(path, columns=s._image_cols))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,48 @@
+"""
+Benchmark writing and reading ROI images in HDF with the
+one-dataset-per-image (``refs``) and concatenated (``ragged``)
+layouts.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/bench_hdf.py [n_targets]
+"""
+import os
+import sys
+import time
+
+from ifcb.data.roi import RoiFile
+from ifcb.data.hdf import roi2hdf, HdfRoi
+from ifcb.data.h5utils import hdfopen
+from ifcb.tests.utils import test_dir
+
+from bench_adc import synthetic_adc
+from bench_roi import synthetic_roi
+
+def timed(label, fn):
+    then = time.time()
+    fn()
+    print('%-28s %.2fs' % (label, time.time() - then))
+
+def main(n_targets=20000):
+    with test_dir() as d:
+        adc_path = os.path.join(d, 'D20180101T000000_IFCB999.adc')
+        roi_path = os.path.join(d, 'D20180101T000000_IFCB999.roi')
+        synthetic_adc(adc_path, n_targets)
+        synthetic_roi(adc_path, roi_path)
+        with RoiFile(adc_path, roi_path) as roi:
+            images = dict(roi.items())
+        print('%d ROIs' % len(images))
+        for layout, compression in [('refs', None), ('ragged', None), ('ragged', 'gzip')]:
+            label = layout if compression is None else '%s+%s' % (layout, compression)
+            path = os.path.join(d, '%s.h5' % label)
+            timed('write %s' % label, lambda: roi2hdf(images, path, layout=layout, compression=compression))
+            with hdfopen(path) as h:
+                hroi = HdfRoi(h)
+                keys = list(hroi.keys())
+                timed('get each %s' % label, lambda: [hroi[k] for k in keys])
+                timed('items %s' % label, lambda: list(hroi.items()))
+            print('%-28s %d bytes' % ('size %s' % label, os.path.getsize(path)))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,35 @@
+"""
+Benchmark parsing a large number of pids one at a time with
+``Pid`` (including ``Pid.timestamp``) against ``parse_many``.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/bench_pids.py [n_pids]
+"""
+import sys
+import time
+import datetime
+
+from ifcb.data.identifiers import Pid, parse_many
+
+def synthetic_pids(n):
+    t0 = datetime.datetime(2016, 1, 1)
+    for i in range(n):
+        ts = t0 + datetime.timedelta(minutes=20 * i)
+        if i % 2:
+            yield ts.strftime('D%Y%m%dT%H%M%S_IFCB101')
+        else:
+            yield ts.strftime('IFCB5_%Y_%j_%H%M%S')
+
+def scalar(pids):
+    return [(p.bin_lid, p.instrument, p.timestamp) for p in map(Pid, pids)]
+
+def main(n=100000):
+    pids = list(synthetic_pids(n))
+    for name, fn in [('Pid', scalar), ('parse_many', parse_many)]:
+        then = time.time()
+        fn(pids)
+        print('%-12s %d pids in %.2fs' % (name, n, time.time() - then))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,59 @@
+"""
+Benchmark per-image overhead of reading images from a ``.roi`` file.
+
+Compares the pandas lookups previously done for each image with the
+``RoiIndex`` lookup, and one-at-a-time reads with coalesced iteration.
+Memory-mapped reads are included to show lookup overhead without I/O.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/bench_roi.py [n_targets]
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from ifcb.data.roi import RoiFile
+from ifcb.tests.utils import test_dir
+
+from bench_adc import synthetic_adc
+
+def synthetic_roi(adc_path, roi_path):
+    roi = RoiFile(adc_path, roi_path)
+    s = roi.adc.schema
+    csv = roi.csv
+    size = int((csv[s.START_BYTE] + csv[s.ROI_WIDTH] * csv[s.ROI_HEIGHT]).max())
+    with open(roi_path, 'wb') as fout:
+        fout.write(np.random.RandomState(0).randint(0, 256, size, dtype=np.uint8).tobytes())
+
+def per_image(label, fn, n):
+    secs = min(timeit.repeat(fn, number=1, repeat=3))
+    print('%-32s %8.2f us/image' % (label, secs * 1e6 / n))
+
+def main(n_targets=20000):
+    with test_dir() as d:
+        adc_path = os.path.join(d, 'D20180101T000000_IFCB999.adc')
+        roi_path = os.path.join(d, 'D20180101T000000_IFCB999.roi')
+        synthetic_adc(adc_path, n_targets)
+        synthetic_roi(adc_path, roi_path)
+        roi = RoiFile(adc_path, roi_path)
+        s = roi.adc.schema
+        keys = list(roi.keys())
+        n = len(keys)
+        print('%d ROIs, %d bytes' % (n, roi.getsize()))
+        cols = [s.START_BYTE, s.ROI_WIDTH, s.ROI_HEIGHT]
+        csv = roi.csv
+        per_image('pandas lookup', lambda: [[csv[c][k] for c in cols] for k in keys], n)
+        per_image('RoiIndex lookup', lambda: [roi.roi_index.lookup(k) for k in keys], n)
+        with roi:
+            list(roi.iter_images()) # warm the page cache
+            per_image('get_image', lambda: [roi[k] for k in keys], n)
+            per_image('iter_images', lambda: list(roi.iter_images()), n)
+        with RoiFile(adc_path, roi_path, mmap=True) as mroi:
+            per_image('get_image (mmap)', lambda: [mroi[k] for k in keys], n)
+            per_image('iter_images (mmap)', lambda: list(mroi.iter_images()), n)
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,79 @@
+"""
+Benchmark per-target overhead of stitching metadata lookups on a
+synthetic revision 1 bin: listing the keys of ``InfilledImages`` and
+computing stitched shapes, compared with the list membership tests and
+pandas ``.loc`` lookups previously done for each target.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/bench_stitching.py [n_rois]
+"""
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from ifcb.data.adc import SCHEMA_VERSION_1
+from ifcb.data.stitching import Stitcher, InfilledImages
+
+class SyntheticBin(object):
+    """revision 1 bin in which about a third of the ROIs are stitched pairs"""
+    schema = SCHEMA_VERSION_1
+    def __init__(self, n_rois):
+        r = np.random.RandomState(0)
+        s = self.schema
+        paired = r.uniform(size=n_rois) < 0.3
+        paired[-1] = False
+        trigger, x, y, w, h = [], [], [], [], []
+        t, i = 0, 0
+        while i < n_rois:
+            t += 1
+            x0, y0, w0, h0 = r.randint(0, 1000), r.randint(0, 800), r.randint(20, 200), r.randint(20, 200)
+            trigger.append(t); x.append(x0); y.append(y0); w.append(w0); h.append(h0)
+            if paired[i] and i + 1 < n_rois: # overlapping second ROI
+                trigger.append(t); x.append(x0 + w0 // 2); y.append(y0 + h0 // 2); w.append(w0); h.append(h0)
+                i += 1
+            i += 1
+        n = len(trigger)
+        adc = pd.DataFrame(np.zeros((n, 15)), columns=list(s._cols))
+        adc[s.TRIGGER] = trigger
+        adc[s.ROI_X], adc[s.ROI_Y], adc[s.ROI_WIDTH], adc[s.ROI_HEIGHT] = x, y, w, h
+        adc = adc.astype({ s.TRIGGER: int, s.ROI_X: int, s.ROI_Y: int, s.ROI_WIDTH: int, s.ROI_HEIGHT: int })
+        adc.index = np.arange(1, n + 1)
+        self.adc = adc
+        self.images_adc = adc
+        self.images = { k: None for k in adc.index }
+    def __contains__(self, k):
+        return k in self.images
+
+def old_keys(b, stitcher):
+    excluded = [x + 1 for x in stitcher.coordinates.index]
+    return [k for k in b.images if k not in excluded]
+
+def old_shape(stitcher, target_number):
+    row = stitcher.coordinates.loc[target_number]
+    return (row['sy2'] - row['sy1'], row['sx2'] - row['sx1'])
+
+def per_target(label, fn, n):
+    secs = min(timeit.repeat(fn, number=1, repeat=3))
+    print('%-36s %10.2f us/target' % (label, secs * 1e6 / n))
+
+def main(n_rois=10000):
+    b = SyntheticBin(n_rois)
+    ii = InfilledImages(b)
+    s = ii.stitcher
+    targets = list(s.keys())
+    print('%d ROIs, %d stitched' % (len(b.images), len(targets)))
+    assert old_keys(b, s) == list(ii.keys())
+    assert all(old_shape(s, t) == s.shape(t) for t in targets)
+    n = len(b.images)
+    per_target('keys, list membership', lambda: old_keys(b, s), n)
+    per_target('keys, exclusion mask', lambda: list(ii.keys()), n)
+    per_target('stitched shape, pandas .loc', lambda: [old_shape(s, t) for t in targets], len(targets))
+    per_target('stitched shape, arrays', lambda: [s.shape(t) for t in targets], len(targets))
+    keys = list(ii.keys())
+    per_target('InfilledImages.shape', lambda: [ii.shape(k) for k in keys], len(keys))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,65 @@
+"""
+Benchmark listing filesets in a large synthetic data directory,
+comparing the previous ``os.walk``-based listing with the
+``os.scandir``-based walker, serially and in parallel.
+
+The tree is laid out by year and day, with flat day directories
+of ``n_filesets / n_days`` filesets each.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/bench_walk.py [n_filesets [n_days]]
+"""
+import os
+import sys
+import time
+import datetime
+
+from ifcb.data.files import list_filesets, validate_path, DEFAULT_BLACKLIST
+from ifcb.tests.utils import test_dir
+
+WHITELIST = ['data']
+
+def oswalk_list_filesets(dirpath, blacklist=DEFAULT_BLACKLIST, whitelist=WHITELIST):
+    """the os.walk implementation list_filesets previously used"""
+    for dp, dirnames, filenames in os.walk(dirpath):
+        for d in dirnames:
+            if d in blacklist:
+                dirnames.remove(d)
+        dirnames.sort()
+        filenames.sort()
+        for f in filenames:
+            basename, extension = f[:-4], f[-3:]
+            if extension == 'adc' and basename+'.hdr' in filenames and basename+'.roi' in filenames:
+                reldir = dp[len(dirpath)+1:]
+                if not validate_path(os.path.join(reldir,basename), whitelist=whitelist, blacklist=blacklist):
+                    continue
+                yield dp, basename
+
+def synthetic_tree(root, n_filesets, n_days):
+    per_day = n_filesets // n_days
+    day = datetime.datetime(2018, 1, 1)
+    for _ in range(n_days):
+        day_dir = os.path.join(root, 'data', day.strftime('D%Y'), day.strftime('D%Y%m%d'))
+        os.makedirs(day_dir)
+        for i in range(per_day):
+            ts = day + datetime.timedelta(seconds=i * 20)
+            base = os.path.join(day_dir, ts.strftime('D%Y%m%dT%H%M%S_IFCB101'))
+            for ext in ['.adc', '.hdr', '.roi']:
+                open(base + ext, 'w').close()
+        day += datetime.timedelta(days=1)
+
+def bench(label, fn):
+    then = time.time()
+    n = sum(1 for _ in fn())
+    print('%-24s %8.3f s (%d filesets)' % (label, time.time() - then, n))
+
+def main(n_filesets=100000, n_days=100):
+    with test_dir() as d:
+        synthetic_tree(d, n_filesets, n_days)
+        bench('os.walk', lambda: oswalk_list_filesets(d))
+        bench('scandir, 1 worker', lambda: list_filesets(d, whitelist=WHITELIST, workers=1))
+        bench('scandir, 8 workers', lambda: list_filesets(d, whitelist=WHITELIST, workers=8))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
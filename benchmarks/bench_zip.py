@@ -0,0 +1,41 @@
+"""
+Benchmark writing a bin to a zip file with PNG encoding done
+serially and in thread pools of various sizes.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/bench_zip.py [n_targets]
+"""
+import os
+import sys
+import time
+import shutil
+
+from ifcb.data.roi import RoiFile
+from ifcb.data.io import open_raw
+from ifcb.data.zip import bin2zip
+from ifcb.tests.utils import test_dir
+
+from bench_adc import synthetic_adc
+from bench_roi import synthetic_roi
+
+HDR_PATH = os.path.join(os.path.dirname(__file__), '..', 'ifcb', 'tests', 'data', 'test_data',
+    'white', 'D2013', 'D201305', 'D20130526', 'D20130526T095207_IFCB013.hdr')
+
+def main(n_targets=5000):
+    with test_dir() as d:
+        adc_path = os.path.join(d, 'D20180101T000000_IFCB999.adc')
+        roi_path = os.path.join(d, 'D20180101T000000_IFCB999.roi')
+        synthetic_adc(adc_path, n_targets)
+        synthetic_roi(adc_path, roi_path)
+        shutil.copy(HDR_PATH, os.path.join(d, 'D20180101T000000_IFCB999.hdr'))
+        with open_raw(adc_path) as b:
+            images = list(b.images.items())
+            print('%d ROIs' % len(images))
+            for workers in [None, 2, 4, 8]:
+                then = time.time()
+                bin2zip(b, os.path.join(d, 'out.zip'), images=images, workers=workers)
+                print('workers=%-5s %.2fs' % (workers, time.time() - then))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -3,15 +3,16 @@ Support for parsing and accessing IFCB ADC data.
 """
 
 import os
+import tempfile
 from io import BytesIO
 
+import numpy as np
 import pandas as pd
 from pandas.errors import EmptyDataError
 
-from functools import lru_cache
 
 from .identifiers import Pid
-from .utils import BaseDictlike
+from .utils import BaseDictlike, cached_property, clear_cache
 
 # column names by schema
 # FIXME these are not anywhere in raw data except new-style instruments contain
@@ -44,6 +45,27 @@ class SCHEMA_VERSION_1(object):
     ROI_HEIGHT = 12
     START_BYTE = 13
     VALVE_STATUS = 14
+    # per-column types: compact integer types for integer columns;
+    # analog values and times stay float64 so they are parsed exactly
+    _dtypes = {
+        TRIGGER: np.int32,
+        PROCESSING_END_TIME: np.float64,
+        FLUORESCENCE_LOW: np.float64,
+        FLUORESCENCE_HIGH: np.float64,
+        SCATTERING_LOW: np.float64,
+        SCATTERING_HIGH: np.float64,
+        COMPARATOR_PULSE: np.float64,
+        TRIGGER_OPEN_TIME: np.float64,
+        FRAME_GRAB_TIME: np.float64,
+        ROI_X: np.int32,
+        ROI_Y: np.int32,
+        ROI_WIDTH: np.int32,
+        ROI_HEIGHT: np.int32,
+        START_BYTE: np.int64,
+        VALVE_STATUS: np.float64
+    }
+    # columns needed to read images from the .roi file
+    _image_cols = [ROI_X, ROI_Y, ROI_WIDTH, ROI_HEIGHT, START_BYTE]
 
 class SCHEMA_VERSION_2(object):
     """
@@ -75,6 +97,36 @@ class SCHEMA_VERSION_2(object):
     STATUS = 21
     RUN_TIME = 22
     INHIBIT_TIME = 23
+    # per-column types: compact integer types for integer columns;
+    # analog values and times stay float64 so they are parsed exactly
+    _dtypes = {
+        TRIGGER: np.int32,
+        ADC_TIME: np.float64,
+        PMT_A: np.float64,
+        PMT_B: np.float64,
+        PMT_C: np.float64,
+        PMT_D: np.float64,
+        PEAK_A: np.float64,
+        PEAK_B: np.float64,
+        PEAK_C: np.float64,
+        PEAK_D: np.float64,
+        TIME_OF_FLIGHT: np.float64,
+        GRAB_TIME_START: np.float64,
+        GRAB_TIME_END: np.float64,
+        ROI_X: np.int32,
+        ROI_Y: np.int32,
+        ROI_WIDTH: np.int32,
+        ROI_HEIGHT: np.int32,
+        START_BYTE: np.int64,
+        COMPARATOR_OUT: np.float64,
+        START_POINT: np.int32,
+        SIGNAL_LENGTH: np.int32,
+        STATUS: np.int32,
+        RUN_TIME: np.float64,
+        INHIBIT_TIME: np.float64
+    }
+    # columns needed to read images from the .roi file
+    _image_cols = [ROI_X, ROI_Y, ROI_WIDTH, ROI_HEIGHT, START_BYTE]
 
 SCHEMA = {
     1: SCHEMA_VERSION_1,
@@ -86,23 +138,174 @@ SCHEMA = {
 IFCB schemas
 """
 
-def parse_adc_file(adc_file):
+def _is_empty(adc_file):
+    if hasattr(adc_file, 'read'):
+        pos = adc_file.tell()
+        empty = not adc_file.read(1)
+        adc_file.seek(pos)
+        return empty
+    try:
+        return os.path.getsize(adc_file) == 0
+    except (OSError, TypeError):
+        return False # e.g., a URL
+
+def _empty_adc(schema, columns=None):
+    cols = list(schema._cols) if columns is None else sorted(columns)
+    return pd.DataFrame({c: np.array([], dtype=schema._dtypes[c]) for c in cols}, columns=cols)
+
+def parse_adc_file(adc_file, schema=None, columns=None):
     """
     Parse an ADC file and return it as a Pandas
     DataFrame, indexed by target number.
 
+    If the schema is known (it is inferred from the pathname
+    if not provided) each column is parsed with the type given
+    by the schema rather than by type inference: integer columns
+    get compact integer types, and other columns are float64, so
+    values are the same as with type inference. Only the schema's
+    columns are parsed; any others (e.g., the empty column after
+    the trailing comma on each line of some revision 1 files)
+    are dropped. Files that do not fit the schema's types are
+    parsed with type inference instead.
+
     :param adc_file: the pathname or URL of the ADC file,
       or a buffer containing the ADC data
+    :param schema: (optional) the ADC schema (e.g.,
+      ``SCHEMA_VERSION_2``)
+    :param columns: (optional) the column numbers to parse.
+      Other columns are skipped. Column labels are preserved
+      so schema constants can still be used to index the result.
     """
+    if schema is None:
+        try:
+            schema = SCHEMA[Pid(adc_file).schema_version]
+        except (ValueError, TypeError):
+            pass # not a path, or not a valid pid
+    if schema is None and columns is not None:
+        raise ValueError('column projection requires a schema')
+    if schema is not None and _is_empty(adc_file):
+        return _empty_adc(schema, columns)
     try:
-        df = pd.read_csv(adc_file, header=None, index_col=False)
+        if schema is None:
+            df = pd.read_csv(adc_file, header=None, index_col=False)
+        else:
+            try:
+                df = pd.read_csv(adc_file, header=None, index_col=False,
+                                 names=list(schema._cols), usecols=columns,
+                                 dtype=schema._dtypes)
+            except (ValueError, OverflowError):
+                # data does not fit the schema's types
+                if hasattr(adc_file, 'seek'):
+                    adc_file.seek(0)
+                df = pd.read_csv(adc_file, header=None, index_col=False, usecols=columns)
         df.index += 1 # index by 1-based ROI number
         return df
     except EmptyDataError:
-        s = SCHEMA[Pid(adc_file).schema_version]
-        cols = s._cols
-        return pd.DataFrame({c:[] for c in cols}, columns=cols)
-    
+        if schema is None:
+            schema = SCHEMA[Pid(adc_file).schema_version]
+        return _empty_adc(schema, columns)
+
+# persistent line index
+
+ADC_INDEX_SUFFIX = '.idx'
+"""
+Suffix appended to the ``.adc`` file's path to name its line index
+"""
+
+def adc_index_path(adc_path):
+    """
+    :param adc_path: the path of the ``.adc`` file
+    :returns str: the path of the file's line index
+    """
+    return adc_path + ADC_INDEX_SUFFIX
+
+def _adc_stat(adc_path):
+    st = os.stat(adc_path)
+    return st.st_size, st.st_mtime_ns
+
+def build_adc_index(adc_path):
+    """
+    Compute the byte offset of each line in an ADC file.
+
+    :param adc_path: the path of the ``.adc`` file
+    :returns numpy.array: the byte offset of the start of
+      each line, followed by the size of the file. The data
+      for target number ``n`` is between elements ``n-1`` and ``n``.
+    """
+    with open(adc_path, 'rb') as fin:
+        data = np.frombuffer(fin.read(), dtype=np.uint8)
+    starts = np.flatnonzero(data == ord('\n')) + 1
+    offsets = np.concatenate([[0], starts]).astype(np.int64)
+    if offsets[-1] != len(data): # last line has no newline
+        offsets = np.append(offsets, len(data))
+    return offsets
+
+def write_adc_index(adc_path, index_path=None):
+    """
+    Build the line index for an ADC file and write it next to
+    the file. The index records the size and modification time
+    of the ``.adc`` file and is considered stale if either
+    changes. The index is written atomically.
+
+    If the index cannot be written (e.g., because the
+    directory is read-only) the index is still returned.
+
+    :param adc_path: the path of the ``.adc`` file
+    :param index_path: (optional) where to write the index
+    :returns numpy.array: the line offsets (see ``build_adc_index``)
+    """
+    if index_path is None:
+        index_path = adc_index_path(adc_path)
+    size, mtime = _adc_stat(adc_path)
+    offsets = build_adc_index(adc_path)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(index_path) or '.',
+            prefix=os.path.basename(index_path) + '.', suffix='.tmp')
+    except OSError:
+        return offsets
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            np.array([size, mtime], dtype=np.int64).tofile(fout)
+            offsets.tofile(fout)
+        os.chmod(temp_path, 0o644) # mkstemp creates it readable only by its owner
+        os.replace(temp_path, index_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return offsets
+
+def read_adc_index(adc_path, index_path=None):
+    """
+    Read the line index for an ADC file, if it exists and is
+    not stale.
+
+    :param adc_path: the path of the ``.adc`` file
+    :param index_path: (optional) where the index is stored
+    :returns numpy.array: the line offsets, or ``None``
+      (see ``build_adc_index``)
+    """
+    if index_path is None:
+        index_path = adc_index_path(adc_path)
+    try:
+        index = np.fromfile(index_path, dtype=np.int64)
+    except (OSError, ValueError): # missing or unreadable
+        return None
+    if len(index) < 3 or tuple(index[:2]) != _adc_stat(adc_path):
+        return None
+    return index[2:]
+
+def adc_index(adc_path, index_path=None):
+    """
+    Read the line index for an ADC file, (re)building it
+    if it is missing or stale.
+
+    :see read_adc_index, write_adc_index
+    """
+    offsets = read_adc_index(adc_path, index_path)
+    if offsets is None:
+        offsets = write_adc_index(adc_path, index_path)
+    return offsets
+
 class AdcFile(BaseDictlike):
     """
     Represents an IFCB ``.adc`` file.
@@ -119,16 +322,19 @@ class AdcFile(BaseDictlike):
     135
 
     """
-    def __init__(self, adc_path, parse=False):
+    def __init__(self, adc_path, parse=False, columns=None):
         """
         :param adc_path: the path of the ``.adc`` file.
         :param parse: whether to parse the file
           (if not, parsing is deferred until data is accessed)
+        :param columns: (optional) the column numbers to parse
+          (if not specified, all columns are parsed)
         """
         self.path = adc_path
         self.pid = Pid(adc_path, parse=parse)
         self.schema_version = self.pid.schema_version
         self.schema = SCHEMA[self.schema_version]
+        self.columns = columns
         if parse:
             self.csv
     def getsize(self):
@@ -142,13 +348,18 @@ class AdcFile(BaseDictlike):
         The bin's LID
         """
         return self.pid.lid
-    @property
-    @lru_cache()
+    @cached_property
     def csv(self):
         """
         The underlying CSV data as a ``pandas.DataFrame``
         """
-        return parse_adc_file(self.path)
+        return parse_adc_file(self.path, schema=self.schema, columns=self.columns)
+    def clear_cache(self):
+        """
+        Discard the parsed data, which will be re-read
+        from the file on next access.
+        """
+        clear_cache(self)
     def to_dataframe(self):
         """
         Return the ADC data as a ``pandas.DataFrame``. If the
@@ -203,13 +414,42 @@ class AdcFragment(AdcFile):
     Represents a specific range of targets in an ADC file.
     Skips parsing other lines from the ADC file, for performance
     reasons.
+
+    With a line index (see ``adc_index``) the fragment is read
+    directly from its byte offset instead of by reading every
+    preceding line.
     """
-    def __init__(self, adc_path, start=1, end=None, parse=False):
+    def __init__(self, adc_path, start=1, end=None, parse=False, columns=None, index=False):
+        """
+        :param adc_path: the path of the ``.adc`` file
+        :param start: the first target number
+        :param end: the target number after the last one
+          (if not specified, read to the end of the file)
+        :param parse: whether to parse the file
+        :param columns: (optional) the column numbers to parse
+        :param index: whether to use (and if necessary create)
+          the persistent line index
+        """
         self.start = start
         self.end = end
-        super(AdcFragment, self).__init__(adc_path, parse=parse)
-    @property
+        self.index = index
+        super(AdcFragment, self).__init__(adc_path, parse=parse, columns=columns)
+    def _read_indexed(self):
+        offsets = adc_index(self.path)
+        n_lines = len(offsets) - 1
+        first = min(self.start, n_lines + 1) - 1
+        last = n_lines if self.end is None else min(self.end - 1, n_lines)
+        last = max(first, last)
+        with open(self.path, 'rb') as adc_file:
+            adc_file.seek(offsets[first])
+            return BytesIO(adc_file.read(offsets[last] - offsets[first]))
+    @cached_property
     def csv(self):
+        if self.index:
+            buf = self._read_indexed()
+            df = parse_adc_file(buf, schema=self.schema, columns=self.columns)
+            df.index += self.start - 1 # index by 1-based ROI number
+            return df
         with open(self.path) as adc_file:
             n, buf = 1, BytesIO()
             for line in adc_file:
@@ -219,7 +459,7 @@ class AdcFragment(AdcFile):
                 if n == self.end:
                     break
         buf.seek(0)
-        df = pd.read_csv(buf, header=None, index_col=False)
-        df.index += self.start # index by 1-based ROI number
+        df = parse_adc_file(buf, schema=self.schema, columns=self.columns)
+        df.index += self.start - 1 # index by 1-based ROI number
         return df
 
@@ -2,12 +2,10 @@
 Bin API. Provides consistent access to IFCB raw data stored
 in various formats.
 """
-from functools import lru_cache
-
 from .adc import SCHEMA
 from .hdr import TEMPERATURE, HUMIDITY
 
-from .utils import BaseDictlike
+from .utils import BaseDictlike, cached_property, clear_cache
 
 from ..metrics.ml_analyzed import compute_ml_analyzed
 
@@ -27,6 +25,9 @@ class BaseBin(BaseDictlike):
 
     Context manager support is provided for implementations
     that must open files or other data streams.
+
+    Data derived from the bin (e.g., ``images_adc``) is cached on
+    the instance and released with it, or on ``clear_cache``.
     """
     @property
     def lid(self):
@@ -34,8 +35,7 @@ class BaseBin(BaseDictlike):
         :returns str: the bin's LID.
         """
         return self.pid.bin_lid
-    @property
-    @lru_cache()
+    @cached_property
     def images_adc(self):
         """
         :returns pandas.DataFrame: the ADC data, minus targets that
@@ -51,6 +51,12 @@ class BaseBin(BaseDictlike):
     @property
     def schema(self):
         return SCHEMA[self.pid.schema_version]
+    def clear_cache(self):
+        """
+        Discard cached data (e.g., parsed ADC data and derived
+        values), which will be recomputed on next access.
+        """
+        clear_cache(self)
     # context manager default implementation
     def __enter__(self):
         return self
@@ -80,20 +86,20 @@ class BaseBin(BaseDictlike):
     def __getitem__(self, target_number):
         return self.get_target(target_number)
     # metrics
-    @lru_cache()
-    def _get_ml_analyzed(self):
+    @cached_property
+    def _ml_analyzed(self):
         return compute_ml_analyzed(self)
     @property
     def ml_analyzed(self):
-        ma, _, _ = self._get_ml_analyzed()
+        ma, _, _ = self._ml_analyzed
         return ma
     @property
     def look_time(self):
-        _, lt, _ = self._get_ml_analyzed()
+        _, lt, _ = self._ml_analyzed
         return lt
     @property
     def run_time(self):
-        _, _, rt = self._get_ml_analyzed()
+        _, _, rt = self._ml_analyzed
         return rt
     @property
     def inhibit_time(self):
@@ -116,12 +122,12 @@ class BaseBin(BaseDictlike):
         new_bin.adc = self.adc
         new_bin.images = { k:v for k,v in self.images.items() }
         return new_bin
-    def to_hdf(self, hdf_file, group=None, replace=True):
+    def to_hdf(self, hdf_file, group=None, replace=True, **kw):
         from .hdf import bin2hdf
-        bin2hdf(self, hdf_file, group=group, replace=replace)
-    def to_zip(self, zip_path):
+        bin2hdf(self, hdf_file, group=group, replace=replace, **kw)
+    def to_zip(self, zip_path, **kw):
         from .zip import bin2zip
-        bin2zip(self, zip_path)
+        bin2zip(self, zip_path, **kw)
     def to_mat(self, mat_path):
         from .matlab import bin2mat
         bin2mat(self, mat_path)
@@ -0,0 +1,246 @@
+"""
+Persistent index of the raw data filesets in a data directory,
+stored in an SQLite database.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+from .identifiers import Pid
+from .files import Fileset, validate_path, DEFAULT_BLACKLIST, DEFAULT_WHITELIST
+
+SCHEMA_SQL = """
+create table if not exists meta (
+    key text primary key,
+    value text
+);
+create table if not exists dirs (
+    dir text primary key,
+    mtime integer
+);
+create table if not exists filesets (
+    lid text,
+    dir text,
+    sortkey text,
+    timestamp text,
+    instrument integer,
+    schema_version integer,
+    adc_size integer,
+    hdr_size integer,
+    roi_size integer,
+    adc_mtime integer,
+    hdr_mtime integer,
+    roi_mtime integer,
+    primary key (dir, lid)
+);
+create index if not exists filesets_lid on filesets (lid);
+create index if not exists filesets_dir on filesets (dir);
+create index if not exists filesets_sortkey on filesets (sortkey, lid);
+"""
+
+INDEX_SCHEMA_VERSION = 2
+
+FILESET_COLUMNS = ['lid', 'dir', 'timestamp', 'instrument', 'schema_version',
+    'adc_size', 'hdr_size', 'roi_size', 'adc_mtime', 'hdr_mtime', 'roi_mtime']
+
+def _sortkey(reldir):
+    # sorting on this key orders directories the way a sorted
+    # top-down walk does (parents before children)
+    if not reldir:
+        return ''
+    return '\x01'.join(reldir.split('/'))
+
+def _fileset_record(dirpath, reldir, lid):
+    sizes, mtimes = [], []
+    for ext in ['adc', 'hdr', 'roi']:
+        st = os.stat(os.path.join(dirpath, '%s.%s' % (lid, ext)))
+        sizes.append(st.st_size)
+        mtimes.append(st.st_mtime_ns)
+    pid = Pid(lid, parse=False)
+    if pid.isvalid():
+        timestamp = pid.timestamp.isoformat()
+        instrument, schema_version = pid.instrument, pid.schema_version
+    else:
+        timestamp, instrument, schema_version = None, None, None
+    return [lid, reldir, _sortkey(reldir), timestamp, instrument, schema_version] + sizes + mtimes
+
+class FilesetIndex(object):
+    """
+    Index of the filesets in a data directory, stored in an
+    SQLite database. Records the LID, directory (relative to the
+    data directory), timestamp, instrument, schema version, and file
+    sizes and modification times of each fileset.
+
+    The index reflects the state of the data directory as of the
+    last call to ``refresh``, which by default only rescans directories
+    whose modification time has changed. Files rewritten in place do not
+    change their directory's modification time; use
+    ``refresh(check_files=True)`` to detect them. Fileset paths are
+    validated as in ``list_filesets``. A LID that occurs in more than one
+    directory is indexed once per directory.
+
+    An index can be used from several threads; access to the
+    database is serialized.
+    """
+    def __init__(self, db_path, root, whitelist=DEFAULT_WHITELIST, blacklist=DEFAULT_BLACKLIST):
+        """
+        :param db_path: the path of the SQLite database
+          (created if it does not exist)
+        :param root: the path of the data directory
+        :param whitelist: a list of directory names to allow
+        :param blacklist: a list of directory names to disallow
+        """
+        if not set(blacklist).isdisjoint(set(whitelist)):
+            raise ValueError('whitelist and blacklist must be disjoint')
+        self.db_path = db_path
+        self.root = root
+        self.whitelist = whitelist
+        self.blacklist = blacklist
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript(SCHEMA_SQL)
+        self._check_config()
+    def _check_config(self):
+        # an index built with different settings must be rebuilt
+        config = json.dumps({
+            'schema': INDEX_SCHEMA_VERSION,
+            'root': os.path.abspath(self.root),
+            'whitelist': sorted(self.whitelist),
+            'blacklist': sorted(self.blacklist)
+        })
+        row = self._conn.execute("select value from meta where key = 'config'").fetchone()
+        if row is None or row[0] != config:
+            with self._conn:
+                # the tables may have been created by an older version
+                self._conn.execute('drop table dirs')
+                self._conn.execute('drop table filesets')
+            self._conn.executescript(SCHEMA_SQL)
+            with self._conn:
+                self._conn.execute("insert or replace into meta values ('config', ?)", (config,))
+    def close(self):
+        """
+        Close the database connection.
+        """
+        with self._lock:
+            self._conn.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def _walk_dirs(self, reldir=''):
+        # yield (reldir, mtime) for every non-blacklisted directory
+        dirpath = os.path.join(self.root, reldir)
+        yield reldir, os.stat(dirpath).st_mtime_ns
+        names = sorted(e.name for e in os.scandir(dirpath) if e.is_dir(follow_symlinks=False) and e.name not in self.blacklist)
+        for name in names:
+            child = name if not reldir else reldir + '/' + name
+            for d in self._walk_dirs(child):
+                yield d
+    def _scan_dir(self, reldir):
+        # list the valid filesets in one directory
+        dirpath = os.path.join(self.root, reldir)
+        names = set(os.listdir(dirpath))
+        records = []
+        for name in names:
+            if not name.endswith('.adc'):
+                continue
+            lid = name[:-4]
+            if lid + '.hdr' not in names or lid + '.roi' not in names:
+                continue
+            relpath = os.path.join(reldir.replace('/', os.sep), lid)
+            if not validate_path(relpath, whitelist=self.whitelist, blacklist=self.blacklist):
+                continue
+            records.append(_fileset_record(dirpath, reldir, lid))
+        return records
+    def _files_changed(self, reldir):
+        # have any indexed files in a directory changed size or mtime?
+        dirpath = os.path.join(self.root, reldir)
+        rows = self._conn.execute('select lid, adc_size, hdr_size, roi_size, adc_mtime, hdr_mtime, roi_mtime from filesets where dir = ?', (reldir,))
+        for row in rows.fetchall():
+            try:
+                record = _fileset_record(dirpath, reldir, row[0])
+            except OSError: # removed
+                return True
+            if tuple(record[6:]) != tuple(row[1:]):
+                return True
+        return False
+    def refresh(self, check_files=False):
+        """
+        Bring the index up to date with the data directory. Only
+        directories that are new or whose modification time has
+        changed are rescanned; filesets in directories that no longer
+        exist are removed.
+
+        :param check_files: if True, also rescan directories in which
+          the size or modification time of any indexed file has
+          changed (this stats every indexed file)
+        :returns int: the number of directories rescanned
+        """
+        with self._lock:
+            stored = dict(self._conn.execute('select dir, mtime from dirs'))
+            n_scanned = 0
+            with self._conn:
+                seen = set()
+                for reldir, mtime in self._walk_dirs():
+                    seen.add(reldir)
+                    if stored.get(reldir) == mtime and not (check_files and self._files_changed(reldir)):
+                        continue
+                    records = self._scan_dir(reldir)
+                    self._conn.execute('delete from filesets where dir = ?', (reldir,))
+                    self._conn.executemany('insert into filesets (lid, dir, sortkey, timestamp, instrument, schema_version, adc_size, hdr_size, roi_size, adc_mtime, hdr_mtime, roi_mtime) values (?,?,?,?,?,?,?,?,?,?,?,?)', records)
+                    self._conn.execute('insert or replace into dirs values (?, ?)', (reldir, mtime))
+                    n_scanned += 1
+                for reldir in set(stored) - seen:
+                    self._conn.execute('delete from filesets where dir = ?', (reldir,))
+                    self._conn.execute('delete from dirs where dir = ?', (reldir,))
+            return n_scanned
+    def isempty(self):
+        """
+        :returns bool: whether the index has never been refreshed
+        """
+        with self._lock:
+            return self._conn.execute('select count(*) from dirs').fetchone()[0] == 0
+    def _fileset(self, reldir, lid):
+        return Fileset(os.path.join(self.root, reldir.replace('/', os.sep), lid))
+    def list_filesets(self):
+        """
+        Yield all indexed filesets, in the order ``list_filesets``
+        yields them.
+        """
+        with self._lock:
+            rows = self._conn.execute('select dir, lid from filesets order by sortkey, lid').fetchall()
+        for reldir, lid in rows:
+            yield self._fileset(reldir, lid)
+    def find_fileset(self, lid):
+        """
+        Locate a fileset by LID. If the LID occurs in more than one
+        directory, the first in ``list_filesets`` order is returned.
+
+        :param lid: the LID to search for
+        :returns Fileset: the fileset, or None if not found
+        """
+        with self._lock:
+            row = self._conn.execute('select dir from filesets where lid = ? order by sortkey limit 1', (lid,)).fetchone()
+        if row is None:
+            return None
+        return self._fileset(row[0], lid)
+    def get_record(self, lid):
+        """
+        Return the indexed metadata for a fileset (the first, if the
+        LID occurs in more than one directory; see ``find_fileset``).
+
+        :param lid: the LID of the fileset
+        :returns dict: the record, or None if not found
+        """
+        with self._lock:
+            row = self._conn.execute('select %s from filesets where lid = ? order by sortkey limit 1' % ', '.join(FILESET_COLUMNS), (lid,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(FILESET_COLUMNS, row))
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('select count(*) from filesets').fetchone()[0]
+    def __repr__(self):
+        return '<FilesetIndex %s>' % self.db_path
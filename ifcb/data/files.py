@@ -3,7 +3,8 @@ Access to IFCB raw data files, including directory operations.
 """
 
 import os
-from functools import lru_cache
+from string import Formatter
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
@@ -11,7 +12,7 @@ from .identifiers import Pid
 from .adc import AdcFile, AdcFragment
 from .hdr import parse_hdr_file
 from .roi import RoiFile
-from .utils import BaseDictlike
+from .utils import BaseDictlike, cached_property
 from .bins import BaseBin
 
 DEFAULT_BLACKLIST = ['skip','beads']
@@ -26,6 +27,7 @@ class Fileset(object):
         :param basepath: the base path of the files (no extension)
         """
         self.basepath = basepath
+        self._pid = None
     @property
     def adc_path(self):
         """
@@ -45,12 +47,13 @@ class Fileset(object):
         """
         return self.basepath + '.roi'
     @property
-    @lru_cache()
     def pid(self):
         """
         A ``Pid`` representing the bin PID
         """
-        return Pid(os.path.basename(self.basepath))
+        if self._pid is None:
+            self._pid = Pid(os.path.basename(self.basepath))
+        return self._pid
     @property
     def lid(self):
         """
@@ -93,11 +96,12 @@ class Fileset(object):
         :returns int: the total size of all three files
         """
         return sum(self.getsizes().values())
-    def as_bin(self):
+    def as_bin(self, mmap=False):
         """
+        :param mmap: whether to memory-map the ``.roi`` file
         :returns: a Bin view of this fileset.
         """
-        return FilesetBin(self)
+        return FilesetBin(self, mmap=mmap)
     def __repr__(self):
         return '<IFCB Fileset %s>' % self.basepath
     def __str__(self):
@@ -112,16 +116,17 @@ class FilesetBin(BaseBin):
     Context manager support opens and closes the ``.roi`` file for image
     access.
     """
-    def __init__(self, fileset):
+    def __init__(self, fileset, mmap=False):
         """
         :param fileset: the ``Fileset`` to represent
+        :param mmap: whether to memory-map the ``.roi`` file
+          (see ``RoiFile``)
         """
         self.fileset = fileset
         self.adc_file = AdcFile(fileset.adc_path)
-        self.roi_file = RoiFile(self.adc_file, fileset.roi_path)
+        self.roi_file = RoiFile(self.adc_file, fileset.roi_path, mmap=mmap)
     # oo interface to fileset
-    @property
-    @lru_cache()
+    @cached_property
     def hdr_attributes(self):
         """
         A ``dict`` representing the headers
@@ -133,7 +138,15 @@ class FilesetBin(BaseBin):
         The bin's timestamp (as a ``datetime``)
         """
         return self.pid.timestamp
-    def to_hdf(self, hdf_file, group=None, replace=True, archive=False):
+    def clear_cache(self):
+        """
+        Discard cached data, including the parsed ADC data
+        and the index of the ``.roi`` file.
+        """
+        super(FilesetBin, self).clear_cache()
+        self.adc_file.clear_cache()
+        self.roi_file.clear_cache()
+    def to_hdf(self, hdf_file, group=None, replace=True, archive=False, **kw):
         """
         Convert the fileset to HDF.
 
@@ -145,9 +158,12 @@ class FilesetBin(BaseBin):
           at that location in the HDF file
         :param archive: whether to include the full text of the .hdr
           and .roi files
+
+        Other keywords (``layout``, ``compression``) are passed
+        to ``filesetbin2hdf``.
         """
         from .hdf import filesetbin2hdf
-        filesetbin2hdf(self, hdf_file, group=group, replace=replace, archive=archive)
+        filesetbin2hdf(self, hdf_file, group=group, replace=replace, archive=archive, **kw)
     # bin interface
     @property
     def pid(self):
@@ -198,14 +214,18 @@ class FilesetBin(BaseBin):
     def __exit__(self, *args):
         self.close()
     # support for single image reading
-    def as_single(self, target):
+    def as_single(self, target, index=False):
         """Return a new FilesetBin that only provides access to
         a single target. If called immediately upon construction
         (before accessing any data) this will avoid parsing the
-        entire ADC file. Otherwise it will raise ValueError."""
+        entire ADC file. Otherwise it will raise ValueError.
+
+        If ``index`` is True, a persistent line index of the ADC
+        file is used (and created if necessary) so that the target
+        can be read without reading the preceding lines."""
         if self.isopen():
             raise ValueError('as_single must be called before opening FilesetBin')
-        return FilesetFragmentBin(self.fileset, target)
+        return FilesetFragmentBin(self.fileset, target, index=index, mmap=self.roi_file.mmap)
     def __repr__(self):
         return '<FilesetBin %s>' % self
     def __str__(self):
@@ -214,10 +234,10 @@ class FilesetBin(BaseBin):
 # special fileset bin subclass for reading one image fast
 
 class FilesetFragmentBin(FilesetBin):
-    def __init__(self, fileset, target):
+    def __init__(self, fileset, target, index=False, mmap=False):
         self.fileset = fileset
-        self.adc_file = AdcFragment(fileset.adc_path, target, target+2)
-        self.roi_file = RoiFile(self.adc_file, fileset.roi_path)
+        self.adc_file = AdcFragment(fileset.adc_path, target, target+2, index=index)
+        self.roi_file = RoiFile(self.adc_file, fileset.roi_path, mmap=mmap)
 
 # listing and finding raw filesets and associated bin objects
 
@@ -249,7 +269,103 @@ def validate_path(filepath, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITE
             return False
     return True
 
-def list_filesets(dirpath, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITELIST, sort=True, validate=True):
+DEFAULT_WALK_WORKERS = 1
+"""
+Default number of threads used to scan directories in ``list_filesets``
+(more than one can help on network filesystems)
+"""
+
+def _scan_dir(dirpath, blacklist, sort):
+    # returns the basenames of complete filesets in a directory
+    # and the names of its non-blacklisted subdirectories
+    filenames, subdirs = set(), []
+    try:
+        it = os.scandir(dirpath)
+    except OSError: # like os.walk, ignore unreadable directories
+        return [], []
+    with it:
+        while True:
+            try:
+                entry = next(it)
+            except StopIteration:
+                break
+            except OSError: # like os.walk, stop at a read error
+                break
+            try:
+                is_dir = entry.is_dir()
+            except OSError: # like os.walk, treat as a file
+                is_dir = False
+            if is_dir:
+                # like os.walk, do not follow symlinks to directories
+                try:
+                    is_symlink = entry.is_symlink()
+                except OSError:
+                    is_symlink = False
+                if entry.name not in blacklist and not is_symlink:
+                    subdirs.append(entry.name)
+            else:
+                filenames.add(entry.name)
+    basenames = []
+    for f in filenames:
+        if f.endswith('.adc'):
+            basename = f[:-4]
+            if basename+'.hdr' in filenames and basename+'.roi' in filenames:
+                basenames.append(basename)
+    if sort:
+        basenames.sort()
+        subdirs.sort()
+    return basenames, subdirs
+
+def walk_filesets(dirpath, blacklist=DEFAULT_BLACKLIST, sort=True, workers=DEFAULT_WALK_WORKERS):
+    """
+    Walk a directory tree top-down (in the order ``os.walk`` does)
+    and, for each directory, yield the basenames of the
+    ``.adc``/``.hdr``/``.roi`` filesets in it. Directories are scanned
+    with ``os.scandir``; with more than one worker, the next few
+    directories to be visited are scanned concurrently, ahead of the
+    consumer. At most ``2 * workers`` scans are in progress or waiting
+    to be consumed at once.
+
+    :param dirpath: the directory to walk
+    :param blacklist: list of directory names to ignore
+    :param sort: whether to sort output (sorts by alpha)
+    :param workers: the number of threads scanning directories
+    :returns: iterator of ``(dirpath, basenames)`` pairs
+    """
+    # directories still to visit; the next is on top
+    stack = [dirpath]
+    if workers is None or workers <= 1:
+        while stack:
+            dp = stack.pop()
+            basenames, subdirs = _scan_dir(dp, blacklist, sort)
+            yield dp, basenames
+            stack.extend(os.path.join(dp, d) for d in reversed(subdirs))
+        return
+    read_ahead = 2 * workers
+    futures = {}
+    pool = ThreadPoolExecutor(workers)
+    try:
+        while stack:
+            # scan the next directories to be visited, up to the limit
+            for dp in stack[:-read_ahead-1:-1]:
+                if len(futures) >= read_ahead:
+                    break
+                if dp not in futures:
+                    futures[dp] = pool.submit(_scan_dir, dp, blacklist, sort)
+            dp = stack.pop()
+            f = futures.pop(dp, None)
+            if f is None:
+                basenames, subdirs = _scan_dir(dp, blacklist, sort)
+            else:
+                basenames, subdirs = f.result()
+            yield dp, basenames
+            stack.extend(os.path.join(dp, d) for d in reversed(subdirs))
+    finally:
+        for f in futures.values():
+            f.cancel()
+        pool.shutdown(wait=True)
+
+def list_filesets(dirpath, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITELIST, sort=True, validate=True, workers=DEFAULT_WALK_WORKERS):
     """
     Iterate over entire directory tree and yield a Fileset
     object for each .adc/.hdr/.roi fileset found. Warning: for
@@ -260,24 +376,18 @@ def list_filesets(dirpath, blacklist=DEFAULT_BLACKLIST, whitelist=DEFAULT_WHITEL
       do not match a file's basename
     :param sort: whether to sort output (sorts by alpha)
     :param validate: whether to validate each path
+    :param workers: the number of threads scanning directories
+      (see ``walk_filesets``)
     """
     if not set(blacklist).isdisjoint(set(whitelist)):
         raise ValueError('whitelist and blacklist must be disjoint')
-    for dp, dirnames, filenames in os.walk(dirpath):
-        for d in dirnames:
-            if d in blacklist:
-                dirnames.remove(d)
-        if sort:
-            dirnames.sort()
-            filenames.sort()
-        for f in filenames:
-            basename, extension = f[:-4], f[-3:]
-            if extension == 'adc' and basename+'.hdr' in filenames and basename+'.roi' in filenames:
-                if validate:
-                    reldir = dp[len(dirpath)+1:]
-                    if not validate_path(os.path.join(reldir,basename), whitelist=whitelist, blacklist=blacklist):
-                        continue
-                yield dp, basename
+    for dp, basenames in walk_filesets(dirpath, blacklist=blacklist, sort=sort, workers=workers):
+        for basename in basenames:
+            if validate:
+                reldir = dp[len(dirpath)+1:]
+                if not validate_path(os.path.join(reldir,basename), whitelist=whitelist, blacklist=blacklist):
+                    continue
+            yield dp, basename
 
 def list_data_dirs(dirpath, blacklist=DEFAULT_BLACKLIST, sort=True, prune=True):
     """
@@ -305,14 +415,72 @@ def list_data_dirs(dirpath, blacklist=DEFAULT_BLACKLIST, sort=True, prune=True):
                 for dp in list_data_dirs(child, sort=sort, prune=prune):
                     yield dp
 
-def find_fileset(dirpath, lid, whitelist=['data'], blacklist=['skip','beads']):
+DEFAULT_LAYOUTS = ['', '{day_prefix}', '{year}/{day_prefix}', 'D{year}/{day_prefix}']
+"""
+Directory layouts tried by ``DataDirectory`` before searching for a fileset
+"""
+
+def layout_dir(layout, pid):
+    """
+    Fill in a directory layout template with fields from a parsed
+    pid. Templates are relative paths using ``/`` as a separator and
+    ``str.format`` syntax, e.g., ``{year}/{day_prefix}``. Any field
+    produced by ``identifiers.parse`` can be used, e.g., ``year``,
+    ``month``, ``day``, ``yearday``, ``day_prefix``, ``instrument``.
+
+    :param layout: the template
+    :param pid: the ``Pid``
+    :returns str: the relative directory path, or None if the template
+      uses a field the pid does not have (e.g., ``month`` for a
+      schema version 1 pid)
+    """
+    fields = pid.parsed
+    for _, name, _, _ in Formatter().parse(layout):
+        if name is not None and fields.get(name) is None:
+            return None
+    return os.path.join(*layout.format(**fields).split('/'))
+
+def find_fileset_by_layout(dirpath, lid, layouts, whitelist=DEFAULT_WHITELIST, blacklist=DEFAULT_BLACKLIST):
+    """
+    Find a fileset by trying to stat it in each of the given
+    directory layouts (see ``layout_dir``), without listing any
+    directories. Candidate paths must be valid (see ``validate_path``).
+
+    :param dirpath: the root directory
+    :param lid: the bin's LID
+    :param layouts: list of directory layout templates
+    :returns Fileset: the ``Fileset``, or ``None`` if it is not found.
+    """
+    pid = Pid(lid, parse=False)
+    if not pid.isvalid():
+        return None
+    for layout in layouts:
+        reldir = layout_dir(layout, pid)
+        if reldir is None:
+            continue
+        relpath = os.path.join(reldir, lid)
+        if not validate_path(relpath, whitelist=whitelist, blacklist=blacklist):
+            continue
+        basepath = os.path.join(dirpath, relpath)
+        if os.path.exists(basepath + '.adc'):
+            return Fileset(basepath)
+    return None
+
+def find_fileset(dirpath, lid, whitelist=['data'], blacklist=['skip','beads'], layouts=None):
     """
     Find a fileset anywhere below the given directory path
     given the bin's lid. This assumes that the file's path
     is valid.
 
+    If directory layouts are given, those locations are tried
+    first (see ``find_fileset_by_layout``) before searching.
+
     :returns Fileset: the ``Fileset``, or ``None`` if it is not found.
     """
+    if layouts:
+        fs = find_fileset_by_layout(dirpath, lid, layouts, whitelist=whitelist, blacklist=blacklist)
+        if fs is not None:
+            return fs
     dirlist = os.listdir(dirpath)
     for name in dirlist:
         if name == lid + '.adc':
@@ -326,26 +494,62 @@ def find_fileset(dirpath, lid, whitelist=['data'], blacklist=['skip','beads']):
     # not found
     return None
 
+def accept_all(fs):
+    """
+    Default ``DataDirectory`` filter, which accepts every fileset.
+    """
+    return True
+
 class DataDirectory(object):
     """
     Represents a directory containing IFCB raw data.
 
     Provides a dict-like interface allowing access to FilesetBins by LID.
+
+    Optionally, a persistent index of the directory (see ``FilesetIndex``)
+    can be used for iteration, ``len``, and lookup by LID, avoiding a walk
+    of the directory tree. The index is built on first use if it is empty,
+    and is otherwise only updated by calling ``refresh``.
     """
-    def __init__(self, path='.', whitelist=DEFAULT_WHITELIST, blacklist=DEFAULT_BLACKLIST, filter=lambda x: True):
+    def __init__(self, path='.', whitelist=DEFAULT_WHITELIST, blacklist=DEFAULT_BLACKLIST, filter=accept_all, index=None, layouts=DEFAULT_LAYOUTS):
         """
         :param path: the path of the data directory
         :param whitelist: a list of directory names to allow
         :param blacklist: a list of directory names to disallow
+        :param filter: a function that takes a ``Fileset`` and returns
+          whether to include it
+        :param index: (optional) the path of an SQLite database in which to
+          keep a persistent index of the directory, or a ``FilesetIndex``
+        :param layouts: directory layout templates to try when looking up
+          a fileset by LID, before searching (see ``layout_dir``)
         """
         self.path = path
         self.whitelist = whitelist
         self.blacklist = blacklist
         self.filter = filter
+        self.layouts = layouts
+        if isinstance(index, str):
+            from .dirindex import FilesetIndex
+            index = FilesetIndex(index, path, whitelist=whitelist, blacklist=blacklist)
+        self.index = index
+        if index is not None and index.isempty():
+            index.refresh()
+    def refresh(self):
+        """
+        Update the persistent index, rescanning only directories
+        that have changed. Does nothing if there is no index.
+        """
+        if self.index is not None:
+            self.index.refresh()
     def list_filesets(self):
         """
         Yield all filesets.
         """
+        if self.index is not None:
+            for fs in self.index.list_filesets():
+                if self.filter(fs):
+                    yield fs
+            return
         for dirpath, basename in list_filesets(self.path, whitelist=self.whitelist, blacklist=self.blacklist):
             basepath = os.path.join(dirpath, basename)
             fs = Fileset(basepath)
@@ -359,7 +563,10 @@ class DataDirectory(object):
         :type lid: str
         :returns Fileset: the fileset, or None if not found
         """
-        fs = find_fileset(self.path, lid, whitelist=self.whitelist, blacklist=self.blacklist)
+        if self.index is not None:
+            fs = self.index.find_fileset(lid)
+        else:
+            fs = find_fileset(self.path, lid, whitelist=self.whitelist, blacklist=self.blacklist, layouts=self.layouts)
         if fs is None:
             return None
         elif self.filter(fs):
@@ -377,8 +584,10 @@ class DataDirectory(object):
             raise KeyError('No fileset for %s found at or under %s' % (lid, self.path))
         return FilesetBin(fs)
     def __len__(self):
-        """warning: for large datasets, this is very slow"""
-        return sum(1 for _ in self)
+        """warning: without an index, for large datasets, this is very slow"""
+        if self.index is not None and self.filter is accept_all:
+            return len(self.index)
+        return sum(1 for _ in self.list_filesets())
     # subdirectories
     def list_descendants(self, **kw):
         """
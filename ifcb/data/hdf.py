@@ -5,16 +5,32 @@ Support for reading and writing IFCB data to HDF5.
 import datetime
 
 import numpy as np
-from functools import lru_cache
 
 from .h5utils import pd2hdf, hdf2pd, hdfopen, H5_REF_TYPE
 
 from .identifiers import Pid
 from .adc import SCHEMA
-from .utils import BaseDictlike
+from .roi import DEFAULT_MAX_READ, iter_all_images
+from .utils import BaseDictlike, cached_property
 from .bins import BaseBin
 from .files import FilesetBin
 
+ROI_LAYOUT_REFS = 'refs'
+ROI_LAYOUT_RAGGED = 'ragged'
+DEFAULT_ROI_LAYOUT = ROI_LAYOUT_REFS
+ROI_LAYOUT_ATTR = 'layout'
+
+PIXELS_CHUNK_SIZE = 64 * 1024
+"""
+Chunk size, in pixels, of the pixel dataset in the ragged ROI layout
+"""
+
+INDEX_ATTR_MAX_SIZE = 4096
+"""
+Largest number of images for which the ``refs`` layout also stores
+its index as an attribute (HDF5 attributes are limited to 64KiB)
+"""
+
 def adc2hdf(adcfile, hdf_file, group=None, replace=True):
     """
     Store an ``AdcFile`` in an HDF file or group. ADC
@@ -36,15 +52,28 @@ def adc2hdf(adcfile, hdf_file, group=None, replace=True):
         pd2hdf(root, adcfile.to_dataframe(), compression='gzip')
         root.attrs['schema'] = adcfile.schema._name
 
-def roi2hdf(roifile, hdf_file, group=None, replace=True):
+def roi2hdf(roifile, hdf_file, group=None, replace=True, layout=DEFAULT_ROI_LAYOUT, compression=None):
     """
     Store a ``RoiFile`` in an HDF file or group. ROI
-    data is represented as follows in an HDF group:
+    data is represented in one of two layouts. In the ``'refs'``
+    layout (the default), each image is a separate dataset:
 
-    * ``{root}.index`` (attribute): target number for each image
+    * ``{root}/index`` (dataset): target number for each image
+      (also stored as the ``{root}.index`` attribute for bins with up
+      to ``INDEX_ATTR_MAX_SIZE`` images, as older versions did)
     * ``{root}/images`` (dataset): references to images keyed by target number
     * ``{root}/{n}`` (dataset): 2d uint8 image (n = ``str(target_number)``)
 
+    In the ``'ragged'`` layout, all images are concatenated into
+    a single dataset, which is much faster to read and write and
+    has less overhead in the HDF file (see ``images2hdf_ragged``):
+
+    * ``{root}.layout`` (attribute): ``'ragged'``
+    * ``{root}/pixels`` (dataset): 1d uint8 pixels of every image, in order
+    * ``{root}/targets`` (dataset): target number of each image
+    * ``{root}/offsets`` (dataset): offset of each image in ``pixels``
+    * ``{root}/heights``, ``{root}/widths`` (datasets): shape of each image
+
     :param roifile: the ``RoiFile`` to store (or similar dictlike)
     :type roifile: RoiFile
     :param hdf_file: the root HDF
@@ -54,15 +83,81 @@ def roi2hdf(roifile, hdf_file, group=None, replace=True):
       to use
     :param replace: whether to replace any existing data
       at that location in the HDF file
+    :param layout: ``'refs'`` or ``'ragged'``
+    :param compression: (optional, ``'ragged'`` layout only) the
+      ``h5py`` compression filter to apply to the pixel data
+      (e.g., ``'gzip'``)
     """
     with hdfopen(hdf_file, group, replace=replace) as root:
-        root.attrs['index'] = roifile.keys()
-        # create image datasets and map them to roi numbers
-        d = { n: root.create_dataset(str(n), data=im) for n, im in roifile.items() }
-        # now create sparse array of references keyed by roi number
-        n = max(d.keys())+1
-        r = [ d[i].ref if i in d else None for i in range(n) ]
-        root.create_dataset('images', data=r, dtype=H5_REF_TYPE)
+        _write_images(iter_all_images(roifile), root, layout, compression)
+
+def _write_images(items, root, layout, compression=None):
+    if layout == ROI_LAYOUT_REFS:
+        images2hdf(items, root)
+    elif layout == ROI_LAYOUT_RAGGED:
+        images2hdf_ragged(items, root, compression=compression)
+    else:
+        raise ValueError('unknown ROI layout %s' % layout)
+
+def images2hdf(items, root):
+    """
+    Write images to an HDF group, one at a time, in the
+    layout described in ``roi2hdf``.
+
+    :param items: iterable of (target number, image) pairs
+    :param root: an open ``h5py.Group``
+    """
+    # create image datasets and map them to roi numbers
+    d = {}
+    for n, im in items:
+        d[n] = root.create_dataset(str(n), data=im)
+    index = np.array(list(d.keys()), dtype=np.int64)
+    root.create_dataset('index', data=index)
+    if len(index) <= INDEX_ATTR_MAX_SIZE:
+        root.attrs['index'] = index
+    # now create sparse array of references keyed by roi number
+    n = max(d.keys(), default=0)+1
+    r = [ d[i].ref if i in d else None for i in range(n) ]
+    root.create_dataset('images', data=r, dtype=H5_REF_TYPE)
+
+def images2hdf_ragged(items, root, compression=None, chunk_size=PIXELS_CHUNK_SIZE):
+    """
+    Write images to an HDF group in the ragged layout described
+    in ``roi2hdf``. The pixel data is written in chunks as the
+    images are read, so the images need not all fit in memory.
+
+    :param items: iterable of (target number, image) pairs
+    :param root: an open ``h5py.Group``
+    :param compression: (optional) the ``h5py`` compression filter
+    :param chunk_size: the chunk size of the pixel dataset
+    """
+    pixels = root.create_dataset('pixels', shape=(0,), maxshape=(None,),
+        dtype=np.uint8, chunks=(chunk_size,), compression=compression)
+    targets, offsets, heights, widths = [], [], [], []
+    buf, buffered, written = [], 0, 0
+    def flush():
+        data = np.concatenate(buf)
+        pixels.resize((written + len(data),))
+        pixels[written:] = data
+        buf.clear()
+        return written + len(data)
+    for n, im in items:
+        h, w = im.shape
+        targets.append(n)
+        offsets.append(written + buffered)
+        heights.append(h)
+        widths.append(w)
+        buf.append(np.asarray(im, dtype=np.uint8).ravel())
+        buffered += h * w
+        if buffered >= chunk_size:
+            written, buffered = flush(), 0
+    if buf:
+        written = flush()
+    root.create_dataset('targets', data=np.array(targets, dtype=np.int64))
+    root.create_dataset('offsets', data=np.array(offsets, dtype=np.int64))
+    root.create_dataset('heights', data=np.array(heights, dtype=np.int32))
+    root.create_dataset('widths', data=np.array(widths, dtype=np.int32))
+    root.attrs[ROI_LAYOUT_ATTR] = ROI_LAYOUT_RAGGED
 
 def hdr2hdf(hdr_dict, hdf_file, group=None, replace=True):
     """
@@ -110,7 +205,7 @@ def hdf2file(hdf_dataset, path):
     with open(path,'wb') as outfile:
         outfile.write(file_data)
 
-def bin2hdf(b, hdf_file, group=None, replace=True):
+def bin2hdf(b, hdf_file, group=None, replace=True, images=None, layout=DEFAULT_ROI_LAYOUT, compression=None):
     """
     Write a ``Bin`` to an HDF file.
 
@@ -132,7 +227,14 @@ def bin2hdf(b, hdf_file, group=None, replace=True):
       to use
     :param replace: whether to replace any existing data
       at that location in the HDF file
+    :param images: (optional) (target number, image) pairs to write
+      instead of the bin's images (e.g., an ``ImageStream``)
+    :param layout: the ROI layout (see ``roi2hdf``)
+    :param compression: (optional) compression for the ROI
+      pixel data (see ``roi2hdf``)
     """
+    if images is None:
+        images = iter_all_images(b.images)
     with hdfopen(hdf_file, group, replace=replace) as root:
         root.attrs['pid'] = str(b.pid)
         root.attrs['lid'] = b.lid
@@ -141,9 +243,10 @@ def bin2hdf(b, hdf_file, group=None, replace=True):
         with hdfopen(root, 'adc') as adc:
             pd2hdf(adc, b.adc, compression='gzip')
             adc.attrs['schema'] = b.schema._name
-        roi2hdf(b.images, root, 'roi', replace=replace)
+        with hdfopen(root, 'roi', replace=replace) as roi:
+            _write_images(images, roi, layout, compression)
 
-def filesetbin2hdf(fs_bin, hdf_file, group=None, replace=True, archive=False):
+def filesetbin2hdf(fs_bin, hdf_file, group=None, replace=True, archive=False, layout=DEFAULT_ROI_LAYOUT, compression=None):
     """
     Write a ``FilesetBin`` to an HDF file.
 
@@ -165,21 +268,24 @@ def filesetbin2hdf(fs_bin, hdf_file, group=None, replace=True, archive=False):
       at that location in the HDF file
     :param archive: whether to store copies of the ``.adc`` and ``.hdr``
       files in the HDF file
+    :param layout: the ROI layout (see ``roi2hdf``)
+    :param compression: (optional) compression for the ROI
+      pixel data (see ``roi2hdf``)
     """
     with hdfopen(hdf_file, group, replace=replace) as root:
-        bin2hdf(fs_bin, root)
+        bin2hdf(fs_bin, root, layout=layout, compression=compression)
         if archive:
             file2hdf(root, 'archive/adc', fs_bin.fileset.adc_path, compression='gzip')
             file2hdf(root, 'archive/hdr', fs_bin.fileset.hdr_path)
         
-def fileset2hdf(fileset, hdf_file, group=None, replace=True, archive=False):
+def fileset2hdf(fileset, hdf_file, group=None, replace=True, archive=False, layout=DEFAULT_ROI_LAYOUT, compression=None):
     """
     Write a fileset to HDF.
 
     :see filesetbin2hdf
     """
     with FilesetBin(fileset) as fs_bin:
-        filesetbin2hdf(fs_bin, hdf_file, group=group, replace=replace, archive=archive)
+        filesetbin2hdf(fs_bin, hdf_file, group=group, replace=replace, archive=archive, layout=layout, compression=compression)
 
 def hdf2fileset(hdf_path, fileset_path, group=None):
     """
@@ -202,9 +308,7 @@ def hdf2fileset(hdf_path, fileset_path, group=None):
             schema1 = root['adc'].attrs['schema'] == SCHEMA[1]._name
             if schema1:
                 outroi.write("\0")
-            imref = root['roi/images']
-            for i in root['roi'].attrs['index']:
-                image = root[imref[i]]
+            for _, image in HdfRoi(root['roi']).items():
                 outroi.write(np.array(image).ravel())
             if schema1:
                 outroi.write("\0")
@@ -213,20 +317,61 @@ def hdf2fileset(hdf_path, fileset_path, group=None):
 
 class HdfRoi(BaseDictlike):
     """
-    Dict-like interface to IFCB images stored in an HDF file.
+    Dict-like interface to IFCB images stored in an HDF file,
+    in either ROI layout (see ``roi2hdf``).
     """
     def __init__(self, group):
         """
         :param group: the ``h5py.Group`` containing the image data
         """
         self._group = group
+        self.layout = group.attrs.get(ROI_LAYOUT_ATTR, ROI_LAYOUT_REFS)
+        if self.layout == ROI_LAYOUT_RAGGED:
+            self._targets = group['targets'][:]
+            self._offsets = group['offsets'][:]
+            self._heights = group['heights'][:]
+            self._widths = group['widths'][:]
+        elif 'index' in group:
+            self._targets = group['index'][:]
+        else: # written by an older version
+            self._targets = np.asarray(group.attrs['index'])
+        self._positions = { t: i for i, t in enumerate(self._targets.tolist()) }
     def keys(self):
-        for k in self._group.attrs['index']:
+        for k in self._targets:
             yield k
+    def has_key(self, roi_number):
+        return roi_number in self._positions
     def __len__(self):
-        return len(self._group.attrs['index'])
+        return len(self._targets)
     def __getitem__(self, roi_number):
+        if self.layout == ROI_LAYOUT_RAGGED:
+            try:
+                i = self._positions[roi_number]
+            except KeyError:
+                raise KeyError('no ROI #%s' % roi_number)
+            offset, h, w = self._offsets[i], self._heights[i], self._widths[i]
+            return self._group['pixels'][offset:offset + h * w].reshape((h, w))
         return np.array(self._group[self._group['images'][roi_number]])
+    def items(self):
+        if self.layout != ROI_LAYOUT_RAGGED:
+            for item in super(HdfRoi, self).items():
+                yield item
+            return
+        # read the pixel data in large contiguous blocks
+        pixels = self._group['pixels']
+        ends = self._offsets + self._heights.astype(np.int64) * self._widths
+        i, n = 0, len(self._targets)
+        while i < n:
+            j = i + 1
+            while j < n and ends[j-1] - self._offsets[i] < DEFAULT_MAX_READ:
+                j += 1
+            block_start = self._offsets[i]
+            block = pixels[block_start:ends[j-1]]
+            for k in range(i, j):
+                start = self._offsets[k] - block_start
+                h, w = self._heights[k], self._widths[k]
+                yield self._targets[k], block[start:start + h * w].reshape((h, w))
+            i = j
         
 class HdfBin(BaseBin):
     """
@@ -235,7 +380,7 @@ class HdfBin(BaseBin):
     Context manager implementation opens and closes the HDF file.
     This implementation is caching, so if the HDF file changes during
     an instance's lifecycle, those changes may not be reflected in
-    subsequent accesses.
+    subsequent accesses (unless ``clear_cache`` is called).
     """
     def __init__(self, hdf_file, group=None):
         """
@@ -272,30 +417,26 @@ class HdfBin(BaseBin):
         if self.isopen():
             self.close()
     # Dictlike
-    @property
-    @lru_cache()
+    @cached_property
     def adc(self):
         """
         adc(self)
         The bin's ADC data as a ``pandas.DataFrame``
         """
         return hdf2pd(self._group['adc'])
-    @property
-    @lru_cache()
+    @cached_property
     def schema(self):
         """
         The bin's schema
         """
         return SCHEMA[self._group['adc'].attrs['schema']]
-    @property
-    @lru_cache()
+    @cached_property
     def headers(self):
         """
         The bin's headers
         """
         return dict(self._group['hdr'].attrs)
-    @property
-    @lru_cache()
+    @cached_property
     def pid(self):
         """
         The bin's ``Pid``
@@ -0,0 +1,225 @@
+"""
+Archives of many bins in a single HDF file, with an index
+table for looking up bins without scanning the file's groups.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import h5py as h5
+
+from .identifiers import Pid
+from .hdf import bin2hdf, HdfBin, ROI_LAYOUT_RAGGED
+from .roi import iter_all_images
+
+BINS_GROUP = 'bins'
+TEMP_PREFIX = '.tmp-'
+INDEX_DATASET = 'index'
+
+INDEX_DTYPE = np.dtype([
+    ('lid', 'S64'),
+    ('timestamp', 'i8'), # nanoseconds since the epoch, UTC
+    ('n_targets', 'i8'),
+    ('n_rois', 'i8'),
+    ('group', 'S128')
+])
+
+ARCHIVE_PERIODS = {
+    'day': 'D%Y%m%d',
+    'month': 'D%Y%m'
+}
+
+def archive_path(root, pid, period='day'):
+    """
+    The path of the archive file that holds a given bin, for
+    archives that each hold one day's or one month's bins.
+
+    :param root: the directory containing the archive files
+    :param pid: the bin's pid (a string or ``Pid``)
+    :param period: ``'day'`` or ``'month'``
+    :returns str: the path of the archive file
+    """
+    if not isinstance(pid, Pid):
+        pid = Pid(pid)
+    try:
+        fmt = ARCHIVE_PERIODS[period]
+    except KeyError:
+        raise ValueError('unknown archive period %s' % period)
+    return os.path.join(root, pid.timestamp.strftime(fmt) + '.h5')
+
+class HdfArchive(object):
+    """
+    An HDF file containing any number of bins, each in its own group
+    (in the layout written by ``bin2hdf``), along with an index table
+    recording each bin's LID, timestamp, number of targets, number of
+    ROIs, and group path.
+
+    Provides a dict-like interface similar to ``DataDirectory``:
+    keys are LIDs and values are ``HdfBin`` objects. Iterating over
+    the archive yields its bins in the order they were added.
+    Lookups use the index and do not scan the file's groups.
+    """
+    def __init__(self, path, mode='a'):
+        """
+        :param path: the path of the HDF file
+        :param mode: ``'a'`` to open the archive for appending
+          (creating it if it does not exist) or ``'r'`` for reading
+        """
+        if mode not in ('a', 'r'):
+            raise ValueError('mode must be "a" or "r"')
+        self.path = path
+        self.mode = mode
+        self._file = h5.File(path, mode)
+        try:
+            if INDEX_DATASET in self._file:
+                self._index = self._file[INDEX_DATASET]
+            elif mode == 'r':
+                raise ValueError('%s is not an HdfArchive' % path)
+            else:
+                self._index = self._file.create_dataset(INDEX_DATASET, shape=(0,),
+                    maxshape=(None,), dtype=INDEX_DTYPE, chunks=True)
+            rows = self._index[:]
+            self._rows = { lid.decode('ascii'): i for i, lid in enumerate(rows['lid']) }
+        except:
+            self.close()
+            raise
+    def close(self):
+        """
+        Close the HDF file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def add(self, b, replace=False, layout=ROI_LAYOUT_RAGGED, compression=None, images=None):
+        """
+        Add a bin to the archive.
+
+        :param b: the bin
+        :param replace: whether to replace the bin if it is already
+          in the archive (if not, ``ValueError`` is raised)
+        :param layout: the ROI layout (see ``roi2hdf``)
+        :param compression: (optional) compression for the ROI
+          pixel data (see ``roi2hdf``)
+        :param images: (optional) (target number, image) pairs to write
+          instead of the bin's images (see ``bin2hdf``)
+        """
+        lid = b.lid
+        if lid in self._rows and not replace:
+            raise ValueError('%s is already in the archive' % lid)
+        group = '%s/%s' % (BINS_GROUP, lid)
+        # write to a temporary group, so that if writing fails
+        # any existing copy of the bin is left as it was
+        temp_group = '%s/%s%s' % (BINS_GROUP, TEMP_PREFIX, lid)
+        if temp_group in self._file:
+            del self._file[temp_group]
+        if images is None:
+            images = iter_all_images(b.images)
+        n_rois = [0]
+        def counted(items):
+            for item in items:
+                n_rois[0] += 1
+                yield item
+        try:
+            bin2hdf(b, self._file, group=temp_group, replace=True, images=counted(images),
+                layout=layout, compression=compression)
+        except:
+            if temp_group in self._file:
+                del self._file[temp_group]
+            raise
+        if group in self._file:
+            del self._file[group]
+        self._file.move(temp_group, group)
+        row = np.array((lid, b.timestamp.value, len(b.adc), n_rois[0], group), dtype=INDEX_DTYPE)
+        i = self._rows.get(lid)
+        if i is None:
+            i = len(self._rows)
+            self._index.resize((i + 1,))
+            self._rows[lid] = i
+        self._index[i] = row
+    def get_record(self, lid):
+        """
+        Return the index record for a bin.
+
+        :param lid: the bin's LID
+        :returns dict: the record, or None if the bin is not in the archive
+        """
+        i = self._rows.get(lid)
+        if i is None:
+            return None
+        row = self._index[i]
+        return {
+            'lid': lid,
+            'timestamp': pd.Timestamp(int(row['timestamp']), tz='UTC'),
+            'n_targets': int(row['n_targets']),
+            'n_rois': int(row['n_rois']),
+            'group': row['group'].decode('ascii')
+        }
+    @property
+    def index(self):
+        """
+        The index table as a ``pandas.DataFrame``, indexed by LID
+        """
+        rows = self._index[:]
+        df = pd.DataFrame({
+            'lid': rows['lid'].astype(str),
+            'timestamp': pd.to_datetime(rows['timestamp'], utc=True),
+            'n_targets': rows['n_targets'],
+            'n_rois': rows['n_rois'],
+            'group': rows['group'].astype(str)
+        })
+        return df.set_index('lid')
+    def keys(self):
+        """
+        Yield the LIDs of the bins in the archive.
+        """
+        for lid in self._rows:
+            yield lid
+    def has_key(self, lid):
+        return lid in self._rows
+    def __contains__(self, lid):
+        return self.has_key(lid)
+    def __getitem__(self, lid):
+        i = self._rows.get(lid)
+        if i is None:
+            raise KeyError('%s is not in archive %s' % (lid, self.path))
+        return HdfBin(self._file, self._index[i]['group'].decode('ascii'))
+    def __iter__(self):
+        for lid in self.keys():
+            yield self[lid]
+    def __len__(self):
+        return len(self._rows)
+    def __repr__(self):
+        return '<HdfArchive %s>' % self.path
+    def __str__(self):
+        return self.path
+
+def archive_bins(bins, root, period='day', **kw):
+    """
+    Add bins to per-day or per-month archives (see ``archive_path``),
+    creating the archives as needed. Keywords are passed to
+    ``HdfArchive.add``.
+
+    :param bins: the bins to archive
+    :param root: the directory containing the archive files
+    :param period: ``'day'`` or ``'month'``
+    :returns int: the number of bins archived
+    """
+    archive, n = None, 0
+    try:
+        for b in bins:
+            path = archive_path(root, b.pid, period=period)
+            if archive is None or archive.path != path:
+                if archive is not None:
+                    archive.close()
+                archive = HdfArchive(path)
+            archive.add(b, **kw)
+            n += 1
+    finally:
+        if archive is not None:
+            archive.close()
+    return n
@@ -3,7 +3,9 @@ Support for parsing IFCB permanent identifiers (a.k.a., pids).
 """
 
 import re
+import threading
 
+from collections import OrderedDict, namedtuple
 from functools import lru_cache
 import pandas as pd
 
@@ -93,7 +95,6 @@ def c(pattern):
     """
     return re.compile(pattern)
 
-@lru_cache()
 def m(pattern, string):
     """
     Match a pattern against a string and return the
@@ -127,6 +128,31 @@ def m(pattern, string):
         return nones(n)
     return col_or_scalar(tuple(m.groups()))
 
+_EXTENSION = re.compile(r'[a-zA-Z][a-zA-Z0-9]*')
+
+def _split_namespace(pid):
+    # returns the pid (minus any Windows dirs), its namespace,
+    # the rest of the pid, and the time series label
+    if '\n' in pid: # the patterns' '.' does not match newlines
+        pid = c(r'^.*\\').sub('',pid) # strip Windows dirs
+        namespace, suffix = m('(.*/)?(.*)',pid)
+        ts_label = m('(?:.*/)?(.*)/$',namespace)
+        return pid, namespace, suffix, ts_label
+    # same as above, with string operations
+    pid = pid[pid.rfind('\\')+1:] # strip Windows dirs
+    i = pid.rfind('/') + 1
+    if i == 0:
+        return pid, None, pid, None
+    namespace = pid[:i]
+    return pid, namespace, pid[i:], namespace[namespace.rfind('/', 0, -1)+1:-1]
+
+def _split_extension(suffix):
+    # returns the suffix minus any extension, and the extension
+    i = suffix.rfind('.')
+    if i >= 0 and '\n' not in suffix and _EXTENSION.fullmatch(suffix, i+1):
+        return suffix[:i], suffix[i+1:]
+    return suffix, None
+
 def parse(pid):
     """
     Parse an IFCB permanent identifier (a.k.a., "pid"). The
@@ -169,9 +195,7 @@ def parse(pid):
     :type pid: str
     :returns dict: fields extraced from the pid
     """
-    pid = c(r'^.*\\').sub('',pid) # strip Windows dirs
-    namespace, suffix = m('(.*/)?(.*)',pid)
-    ts_label = m('(?:.*/)?(.*)/$',namespace)
+    pid, namespace, suffix, ts_label = _split_namespace(pid)
     # try v2 identifier pattern
     bin_lid, timestamp, year, month, day, hour, minute, second, instrument, tpe = m(timestamp2regex(V2_PID_PATTERN),suffix)
     # try v1 identifier pattern
@@ -206,6 +230,91 @@ def parse(pid):
     # this might actually be an acceptable use of locals()
     return locals()
 
+PARSE_MANY_COLUMNS = ['pid', 'namespace', 'lid', 'bin_lid', 'instrument', 'schema_version',
+    'target', 'product', 'extension', 'timestamp']
+
+_V2_GROUPS = ['bin_lid', 'timestamp', 'year', 'month', 'day', 'hour', 'minute', 'second', 'instrument', 'tpe']
+_V1_GROUPS = ['bin_lid', 'instrument', 'timestamp', 'year', 'day', 'hour', 'minute', 'second', 'tpe']
+_TPE_PATTERN = r'(?:_([0-9]+))?(?:_([a-zA-Z][a-zA-Z0-9_]*))?(?:\.([a-zA-Z][a-zA-Z0-9]*))?'
+
+def _extract(strings, pattern, names):
+    # like m, but for a Series of strings; NaN where there is no match
+    df = strings.str.extract('^' + pattern, expand=True)
+    df.columns = names
+    return df
+
+def parse_many(pids, errors='raise'):
+    """
+    Parse many pids at once, with vectorized string operations.
+    Produces the same values as ``parse`` (and ``Pid``) for each pid,
+    but for large numbers of pids is much faster than parsing them
+    one at a time.
+
+    The result has one row per pid, in the order given, and the columns
+
+    * ``pid``, ``namespace``, ``lid``, ``bin_lid``, ``product``,
+      ``extension`` - strings (or ``None``)
+    * ``instrument``, ``schema_version`` - integers (nullable
+      integers if any pid is invalid)
+    * ``target`` - nullable integer
+    * ``timestamp`` - UTC ``datetime64``, as ``Pid.timestamp``
+
+    :param pids: an iterable of pids (as strings)
+    :param errors: if ``'raise'`` (the default), raise ``ValueError``
+      if any pid is invalid. If ``'coerce'``, fill the rows of invalid
+      pids with missing values.
+    :returns DataFrame: the parsed fields
+    """
+    if errors not in ('raise', 'coerce'):
+        raise ValueError('errors must be "raise" or "coerce"')
+    pid = pd.Series(list(pids), dtype=object).astype(str)
+    pid = pid.str.replace(r'^.*\\', '', regex=True) # strip Windows dirs
+    ns = _extract(pid, r'(.*/)?(.*)', ['namespace', 'suffix'])
+    # try v2 identifier pattern, then v1 where that fails
+    v2 = _extract(ns.suffix, timestamp2regex(V2_PID_PATTERN), _V2_GROUPS)
+    is_v1 = v2.bin_lid.isna()
+    v1 = _extract(ns.suffix[is_v1], timestamp2regex(V1_PID_PATTERN), _V1_GROUPS)
+    fields = v2.drop(columns=['month'])
+    fields.loc[is_v1, _V1_GROUPS] = v1[_V1_GROUPS]
+    schema_version = pd.Series(2, index=pid.index, dtype='Int64')
+    schema_version[is_v1] = 1
+    # tpe, if not empty, must start with _ or .
+    tpe = fields.tpe.fillna('')
+    bad_tpe = (tpe != '') & (~tpe.str[:1].isin(['.', '_']) | (tpe.str.len() < 2))
+    invalid = fields.bin_lid.isna() | bad_tpe
+    if invalid.any() and errors == 'raise':
+        bad = pid[invalid].iloc[0]
+        raise ValueError('invalid pid: %s' % bad)
+    tpe = _extract(tpe, _TPE_PATTERN, ['target', 'product', 'extension'])
+    product = tpe['product'].fillna('raw')
+    lid = fields.bin_lid.where(tpe.target.isna(), fields.bin_lid + '_' + tpe.target)
+    # timestamps, with the format of each schema version
+    timestamp = pd.Series(pd.NaT, index=pid.index, dtype='datetime64[ns, UTC]')
+    for version, fmt in [(1, '%Y_%j_%H%M%S'), (2, '%Y%m%dT%H%M%S')]:
+        which = (schema_version == version) & ~invalid
+        if which.any():
+            timestamp[which] = pd.to_datetime(fields.timestamp[which], format=fmt, utc=True, errors='coerce')
+    df = pd.DataFrame({
+        'pid': pid,
+        'namespace': ns.namespace,
+        'lid': lid,
+        'bin_lid': fields.bin_lid,
+        'instrument': pd.to_numeric(fields.instrument).astype('Int64'),
+        'schema_version': schema_version,
+        'target': pd.to_numeric(tpe.target).astype('Int64'),
+        'product': product,
+        'extension': tpe.extension,
+        'timestamp': timestamp,
+    }, columns=PARSE_MANY_COLUMNS)
+    if invalid.any():
+        df.loc[invalid, PARSE_MANY_COLUMNS[1:]] = None
+    else:
+        df = df.astype({'instrument': 'int64', 'schema_version': 'int64'})
+    # missing strings are None, as in parse
+    for col in ['namespace', 'lid', 'bin_lid', 'product', 'extension']:
+        df[col] = df[col].astype(object).where(df[col].notna(), None)
+    return df
+
 def unparse(parsed):
     """
     Unparse a PID. Accepts a parsed PID or anything containing
@@ -274,6 +383,115 @@ def unparse(parsed):
     except KeyError:
         raise ValueError('cannot unparse PID')
         
+DEFAULT_PID_CACHE_SIZE = 16384
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class PidCache(object):
+    """
+    Bounded, thread-safe least-recently-used cache of parsed pids.
+    Pids that differ only in namespace (path or URL prefix) and
+    extension share an entry, keyed on the rest of the pid (e.g.,
+    ``D20160714T023910_IFCB101_00014``). Only valid pids are cached.
+    ``Pid`` uses a module-level instance (see ``pid_cache_info``,
+    ``clear_pid_cache``, and ``set_pid_cache_size``).
+    """
+    def __init__(self, maxsize=DEFAULT_PID_CACHE_SIZE):
+        """
+        :param maxsize: the maximum number of pids to cache
+          (0 disables caching)
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def parse(self, pid):
+        """
+        Parse a pid as ``Pid.parsed`` does, using the cache.
+
+        :param pid: the pid (as a string)
+        :returns dict: the parsed fields. The caller may modify it.
+        """
+        pid_, namespace, suffix, ts_label = _split_namespace(pid)
+        key, extension = _split_extension(suffix)
+        with self._lock:
+            parsed = self._entries.get(key)
+            if parsed is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if parsed is not None:
+            parsed = parsed.copy()
+            parsed.update(pid=pid_, namespace=namespace, suffix=suffix,
+                ts_label=ts_label, extension=extension)
+            return parsed
+        with self._lock:
+            self.misses += 1
+        parsed = parse(pid)
+        # the other fields depend only on the key if the key is
+        # exactly the lid and product (e.g., not if the pid has
+        # trailing characters that parsing ignores)
+        cacheable = parsed['extension'] == extension and key in (parsed['lid'],
+            '{}_{}'.format(parsed['lid'], parsed['product']))
+        for ip in ['target', 'instrument', 'schema_version']:
+            if parsed[ip] is not None:
+                parsed[ip] = int(parsed[ip])
+        if self.maxsize > 0 and cacheable:
+            with self._lock:
+                self._entries[key] = parsed
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return parsed.copy()
+    def info(self):
+        """
+        :returns CacheInfo: hits, misses, maximum size, and current size
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+    def resize(self, maxsize):
+        """
+        Change the maximum size, evicting entries if necessary.
+
+        :param maxsize: the new maximum size
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > max(maxsize, 0):
+                self._entries.popitem(last=False)
+    def clear(self):
+        """
+        Remove all entries and reset the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+    def __len__(self):
+        return len(self._entries)
+
+PID_CACHE = PidCache()
+
+def pid_cache_info():
+    """
+    :returns CacheInfo: statistics for the cache of parsed pids
+    """
+    return PID_CACHE.info()
+
+def clear_pid_cache():
+    """
+    Empty the cache of parsed pids.
+    """
+    PID_CACHE.clear()
+
+def set_pid_cache_size(maxsize):
+    """
+    Set the maximum number of parsed pids to cache.
+
+    :param maxsize: the maximum size (0 disables caching)
+    """
+    PID_CACHE.resize(maxsize)
+
 class Pid(object):
     """
     Represents the permanent identifier of an IFCB bin.
@@ -333,12 +551,7 @@ class Pid(object):
         The parsed PID
         """
         if self._parsed is None:
-            # convert some properties to int
-            p = parse(self.pid)
-            for ip in ['target', 'instrument', 'schema_version']:
-                if p[ip] is not None:
-                    p[ip] = int(p[ip])
-            self._parsed = p
+            self._parsed = PID_CACHE.parse(self.pid)
         return self._parsed
     def __getattr__(self, name):
         if name in ['pid','_parsed','parsed']:
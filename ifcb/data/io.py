@@ -33,3 +33,48 @@ def open_zip(zip_path):
 def open_mat(mat_path):
     from .matlab import MatBin
     return MatBin(mat_path)
+
+FORMATS_BY_EXTENSION = {
+    '.hdf': 'hdf',
+    '.h5': 'hdf',
+    '.hdf5': 'hdf',
+    '.zip': 'zip',
+    '.mat': 'mat'
+}
+
+def convert(src_bin, dst_path, format=None, buffer_size=None, **kw):
+    """
+    Write a bin to a file in another format, streaming its images
+    through a bounded buffer (see ``ImageStream``) so that reading
+    images overlaps with encoding and writing them, and memory use
+    does not grow with the size of the bin.
+
+    :param src_bin: the bin to convert
+    :param dst_path: the path of the file to write
+    :param format: ``'hdf'``, ``'zip'``, or ``'mat'`` (if not
+      specified, determined from the extension of ``dst_path``)
+    :param buffer_size: (optional) the maximum number of bytes of
+      image data to buffer
+
+    Other keywords are passed to the writer (e.g., ``layout`` and
+    ``compression`` for ``bin2hdf``).
+    """
+    from .streaming import ImageStream, DEFAULT_BUFFER_SIZE
+    if format is None:
+        _, ext = os.path.splitext(dst_path)
+        try:
+            format = FORMATS_BY_EXTENSION[ext.lower()]
+        except KeyError:
+            raise ValueError('cannot determine format of %s' % dst_path)
+    if format == 'hdf':
+        from .hdf import bin2hdf as write
+    elif format == 'zip':
+        from .zip import bin2zip as write
+    elif format == 'mat':
+        from .matlab import bin2mat as write
+    else:
+        raise ValueError('unsupported format %s' % format)
+    if buffer_size is None:
+        buffer_size = DEFAULT_BUFFER_SIZE
+    with ImageStream(src_bin.images, buffer_size=buffer_size) as images:
+        write(src_bin, dst_path, images=images, **kw)
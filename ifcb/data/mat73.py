@@ -0,0 +1,213 @@
+"""
+Minimal support for reading and writing MATLAB v7.3 (HDF5-based)
+MAT-files with ``h5py``, following MATLAB's conventions for
+numeric arrays, strings, structs, and cell arrays.
+
+MATLAB stores arrays in column-major order, so an ``m x n`` MATLAB
+array is an ``n x m`` HDF5 dataset. Each variable has a
+``MATLAB_class`` attribute. Cell arrays are datasets of object
+references to their elements, which are stored in the ``#refs#``
+group.
+"""
+
+import datetime
+
+import numpy as np
+import h5py as h5
+
+from .h5utils import H5_REF_TYPE
+
+USERBLOCK_SIZE = 512
+REFS_GROUP = '#refs#'
+
+CLASS_ATTR = 'MATLAB_class'
+EMPTY_ATTR = 'MATLAB_empty'
+INT_DECODE_ATTR = 'MATLAB_int_decode'
+FIELDS_ATTR = 'MATLAB_fields'
+
+MATLAB_CLASSES = {
+    np.dtype(np.float64): 'double',
+    np.dtype(np.float32): 'single',
+    np.dtype(np.int8): 'int8',
+    np.dtype(np.uint8): 'uint8',
+    np.dtype(np.int16): 'int16',
+    np.dtype(np.uint16): 'uint16',
+    np.dtype(np.int32): 'int32',
+    np.dtype(np.uint32): 'uint32',
+    np.dtype(np.int64): 'int64',
+    np.dtype(np.uint64): 'uint64',
+    np.dtype(np.bool_): 'logical'
+}
+
+def is_mat73(path):
+    """
+    :param path: the path of a MAT-file
+    :returns bool: whether the file is a v7.3 (HDF5-based) MAT-file
+    """
+    return h5.is_hdf5(path)
+
+def _header():
+    # the 128-byte MAT-file header, which goes in the HDF5 userblock
+    text = 'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: %s HDF5 schema 1.00 .' % \
+        datetime.datetime.now().strftime('%a %b %d %H:%M:%S %Y')
+    return text.encode('ascii').ljust(116) + b' ' * 8 + b'\x00\x02' + b'IM'
+
+class Mat73Writer(object):
+    """
+    Writes variables to a new MATLAB v7.3 file.
+    """
+    def __init__(self, path):
+        """
+        :param path: the path of the file to create
+        """
+        self.path = path
+        self._file = h5.File(path, 'w', userblock_size=USERBLOCK_SIZE, libver='earliest')
+        self._n_refs = 0
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            with open(self.path, 'r+b') as fout:
+                fout.write(_header())
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def _ref_name(self):
+        name = '%x' % self._n_refs
+        self._n_refs += 1
+        return name
+    def _write(self, parent, name, value):
+        if isinstance(value, str):
+            codes = np.frombuffer(value.encode('utf-16-le'), dtype='<u2')
+            ds = self._write_array(parent, name, codes.reshape((1, -1)))
+            ds.attrs[CLASS_ATTR] = np.bytes_('char')
+            ds.attrs[INT_DECODE_ATTR] = np.int32(2)
+            return ds
+        if isinstance(value, dict):
+            return self._write_struct(parent, name, value)
+        arr = np.asarray(value)
+        if arr.dtype not in MATLAB_CLASSES:
+            raise TypeError('cannot write %s to MATLAB file' % arr.dtype)
+        if arr.ndim < 2: # MATLAB arrays are at least 2d; 1d arrays are rows
+            arr = arr.reshape((1, -1))
+        ds = self._write_array(parent, name, arr.astype(np.uint8) if arr.dtype == np.bool_ else arr)
+        ds.attrs[CLASS_ATTR] = np.bytes_(MATLAB_CLASSES[arr.dtype])
+        if arr.dtype == np.bool_:
+            ds.attrs[INT_DECODE_ATTR] = np.int32(1)
+        return ds
+    def _write_array(self, parent, name, arr):
+        if arr.size == 0:
+            # empty arrays are stored as their dimensions
+            ds = parent.create_dataset(name, data=np.array(arr.shape, dtype=np.uint64))
+            ds.attrs[EMPTY_ATTR] = np.uint8(1)
+            return ds
+        return parent.create_dataset(name, data=arr.T)
+    def _write_struct(self, parent, name, fields):
+        group = parent.create_group(name)
+        group.attrs[CLASS_ATTR] = np.bytes_('struct')
+        names = list(fields.keys())
+        vlen = h5.vlen_dtype(np.dtype('S1'))
+        field_names = np.empty(len(names), dtype=vlen)
+        for i, n in enumerate(names):
+            field_names[i] = np.frombuffer(n.encode('ascii'), dtype='S1')
+        group.attrs.create(FIELDS_ATTR, field_names, dtype=vlen)
+        for n in names:
+            self._write(group, n, fields[n])
+        return group
+    def write(self, name, value):
+        """
+        Write a variable. Supported values are strings, numeric
+        and logical scalars and arrays, and dicts (written as
+        scalar structs).
+
+        :param name: the variable name
+        :param value: the value
+        """
+        self._write(self._file, name, value)
+    def write_cells(self, name, items, n):
+        """
+        Write a ``1 x n`` cell array variable one element at a time,
+        so that the elements need not all be in memory.
+
+        :param name: the variable name
+        :param items: iterable of (key, value) pairs
+        :param n: the number of elements
+        :returns list: the keys, in the order written
+        """
+        refs = self._file.require_group(REFS_GROUP)
+        cells = self._file.create_dataset(name, shape=(n, 1), dtype=H5_REF_TYPE)
+        cells.attrs[CLASS_ATTR] = np.bytes_('cell')
+        keys = []
+        for k, value in items:
+            if len(keys) == n:
+                raise ValueError('more than %d items for %s' % (n, name))
+            ds = self._write(refs, self._ref_name(), value)
+            cells[len(keys), 0] = ds.ref
+            keys.append(k)
+        if len(keys) != n:
+            raise ValueError('expected %d items for %s, got %d' % (n, name, len(keys)))
+        return keys
+
+def _matlab_class(obj):
+    mclass = obj.attrs.get(CLASS_ATTR, b'double')
+    if isinstance(mclass, bytes):
+        mclass = mclass.decode('ascii')
+    return mclass
+
+def read_value(obj, squeeze=True):
+    """
+    Read a variable from a v7.3 MAT-file. Strings are returned as
+    ``str``, structs as ``dict``, cell arrays as ``Mat73Cell``, and
+    other values as ``numpy`` arrays in MATLAB's shape (with singleton
+    dimensions removed and 1x1 arrays converted to scalars, if
+    ``squeeze`` is True).
+
+    :param obj: the ``h5py`` dataset or group
+    :param squeeze: whether to squeeze arrays
+    """
+    mclass = _matlab_class(obj)
+    if mclass == 'struct':
+        names = obj.attrs.get(FIELDS_ATTR)
+        if names is None:
+            names = list(obj.keys())
+        else:
+            names = [b''.join(n).decode('ascii') for n in names]
+        return { n: read_value(obj[n], squeeze) for n in names }
+    if mclass == 'cell':
+        return Mat73Cell(obj)
+    if obj.attrs.get(EMPTY_ATTR, 0):
+        shape = tuple(int(d) for d in obj[()])
+        if mclass == 'char':
+            return ''
+        return np.zeros(shape, dtype=np.float64)
+    arr = obj[()].T
+    if mclass == 'char':
+        return arr.astype('<u2').tobytes(order='F').decode('utf-16-le')
+    if mclass == 'logical':
+        arr = arr.astype(np.bool_)
+    if squeeze:
+        arr = arr.squeeze()
+        if arr.ndim == 0:
+            return arr.item()
+    return arr
+
+class Mat73Cell(object):
+    """
+    Read-only, sequence-like access to the elements of a cell array
+    in a v7.3 MAT-file. Elements are read when they are accessed.
+    """
+    def __init__(self, dataset):
+        """
+        :param dataset: the ``h5py`` dataset of references
+        """
+        self._dataset = dataset
+        self._refs = dataset[()].T.ravel(order='F')
+    def __len__(self):
+        return len(self._refs)
+    def __getitem__(self, i):
+        obj = self._dataset.file[self._refs[i]]
+        return read_value(obj, squeeze=False)
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
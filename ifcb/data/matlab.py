@@ -1,11 +1,16 @@
+import io
+import struct
+
 import numpy as np
 from scipy.io import savemat, loadmat
 import pandas as pd
+import h5py as h5
 
-from .utils import BaseDictlike
+from .utils import BaseDictlike, cached_property
 from .bins import BaseBin
 
 from .identifiers import Pid
+from .mat73 import Mat73Writer, is_mat73, read_value
 
 PID_VAR = 'pid'
 ADC_VAR = 'adc'
@@ -15,50 +20,241 @@ HEADERS_VAR = 'headers'
 
 MAX_FIELD_LENGTH = 31
 
+MAT_V5 = '5'
+MAT_V73 = '7.3'
+
 # notes about MATLAB format
 # the matrix of ADC data is of a uniform type, so int columns
 # come back as floats.
 
-def bin2mat(b, mat_path):
-    # ADC data
-    adc = np.array(b.adc)
-    # warning: reads all images into memory
-    roi_numbers = sorted(b.images)
-    images = [ b.images[r] for r in roi_numbers ]
-    savemat(mat_path, {
-        PID_VAR: str(b.lid), # remove non-bin parts of pid
-        HEADERS_VAR: b.headers,
-        ADC_VAR: adc,
-        ROI_NUMBERS_VAR: roi_numbers,
-        IMAGES_VAR: images
-    }, long_field_names=True)
+# MAT v5 data element types and array classes, from the
+# MAT-File Format documentation
+MI_INT8 = 1
+MI_INT32 = 5
+MI_UINT32 = 6
+MI_MATRIX = 14
+
+MX_CELL_CLASS = 1
+
+MAT5_HEADER_SIZE = 128
+
+MAT5_TYPES = { # dtype: (data type, array class)
+    np.dtype(np.float64): (9, 6),
+    np.dtype(np.float32): (7, 7),
+    np.dtype(np.int8): (1, 8),
+    np.dtype(np.uint8): (2, 9),
+    np.dtype(np.int16): (3, 10),
+    np.dtype(np.uint16): (4, 11),
+    np.dtype(np.int32): (5, 12),
+    np.dtype(np.uint32): (6, 13)
+}
+
+def _pad8(n):
+    return (8 - n % 8) % 8
+
+def _write_element(fout, mi_type, data):
+    # write a data element: tag, data, and padding to 8 bytes
+    fout.write(struct.pack('<II', mi_type, len(data)))
+    fout.write(data)
+    fout.write(b'\0' * _pad8(len(data)))
+    return 8 + len(data) + _pad8(len(data))
+
+def _write_matrix_header(fout, mx_class, shape, name=b''):
+    # write the array flags, dimensions, and name subelements of a matrix
+    n = _write_element(fout, MI_UINT32, struct.pack('<II', mx_class, 0))
+    n += _write_element(fout, MI_INT32, struct.pack('<%di' % len(shape), *shape))
+    n += _write_element(fout, MI_INT8, name)
+    return n
+
+def _write_array(fout, arr):
+    # write a 2d numeric array as an unnamed matrix element
+    arr = np.asarray(arr)
+    try:
+        mi_type, mx_class = MAT5_TYPES[arr.dtype.newbyteorder('=')]
+    except KeyError:
+        raise ValueError('cannot write %s to a MAT-file' % arr.dtype)
+    arr = np.atleast_2d(arr)
+    data = arr.astype(arr.dtype.newbyteorder('<'), copy=False).tobytes(order='F')
+    body = io.BytesIO()
+    n = _write_matrix_header(body, mx_class, arr.shape)
+    body.write(struct.pack('<II', mi_type, len(data)))
+    n += 8 + len(data) + _pad8(len(data))
+    fout.write(struct.pack('<II', MI_MATRIX, n))
+    fout.write(body.getvalue())
+    fout.write(data)
+    fout.write(b'\0' * _pad8(len(data)))
+    return 8 + n
+
+def _write_cells(fout, name, items, n):
+    # write n arrays to a MAT v5 file as a 1xn cell array variable,
+    # one at a time, returning the keys of the items in the order
+    # written. savemat can only write a cell array from an array of all
+    # its elements, so the cell array is written here, following the
+    # MAT-File Format documentation
+    start = fout.tell()
+    fout.write(struct.pack('<II', MI_MATRIX, 0)) # size filled in below
+    size = _write_matrix_header(fout, MX_CELL_CLASS, (1, n), name.encode('latin1'))
+    keys = []
+    for k, arr in items:
+        if len(keys) == n:
+            raise ValueError('more than %d items for %s' % (n, name))
+        size += _write_array(fout, arr)
+        keys.append(k)
+    if len(keys) != n:
+        raise ValueError('expected %d items for %s, got %d' % (n, name, len(keys)))
+    if size >= 2**32:
+        raise ValueError('%s is too large for a version 5 MAT-file; use version 7.3' % name)
+    end = fout.tell()
+    fout.seek(start + 4)
+    fout.write(struct.pack('<I', size))
+    fout.seek(end)
+    return keys
+
+def _append_variables(fout, variables):
+    # write variables with savemat and append them (without the
+    # file header) to an open MAT-file
+    buf = io.BytesIO()
+    savemat(buf, variables, long_field_names=True, oned_as='row')
+    fout.write(buf.getvalue()[MAT5_HEADER_SIZE:])
+
+def bin2mat(b, mat_path, images=None, version=MAT_V5):
+    """
+    Write a bin to a MATLAB file. Images are written one
+    at a time, so they need not all fit in memory.
+
+    Version 5 files are written with ``scipy``, except for the images,
+    which are written as they are read; version 7.3
+    (HDF5-based) files, which have no size limits, with ``h5py``
+    (see ``bin2mat73``).
+
+    :param b: the bin
+    :param mat_path: the path of the ``.mat`` file
+    :param images: (optional) (target number, image) pairs to write
+      instead of the bin's images (e.g., an ``ImageStream``)
+    :param version: the MAT-file version, ``'5'`` or ``'7.3'``
+    """
+    if version == MAT_V73:
+        return bin2mat73(b, mat_path, images=images)
+    elif version != MAT_V5:
+        raise ValueError('unsupported MAT-file version %s' % version)
+    if images is None:
+        images = ((r, b.images[r]) for r in sorted(b.images))
+    n_images = len(b.images)
+    with open(mat_path, 'wb') as fout:
+        savemat(fout, {
+            PID_VAR: str(b.lid), # remove non-bin parts of pid
+            HEADERS_VAR: b.headers,
+            ADC_VAR: np.array(b.adc)
+        }, long_field_names=True, oned_as='row')
+        roi_numbers = _write_cells(fout, IMAGES_VAR, images, n_images)
+        _append_variables(fout, {
+            ROI_NUMBERS_VAR: np.array(roi_numbers)
+        })
+
+def bin2mat73(b, mat_path, images=None):
+    """
+    Write a bin to a MATLAB v7.3 (HDF5-based) file, with the same
+    variables as ``bin2mat``. Images are written one at a time.
+
+    :param b: the bin
+    :param mat_path: the path of the ``.mat`` file
+    :param images: (optional) (target number, image) pairs to write
+      instead of the bin's images (e.g., an ``ImageStream``)
+    """
+    if images is None:
+        images = ((r, b.images[r]) for r in sorted(b.images))
+    n_images = len(b.images)
+    with Mat73Writer(mat_path) as writer:
+        writer.write(PID_VAR, str(b.lid))
+        writer.write(HEADERS_VAR, b.headers)
+        writer.write(ADC_VAR, np.array(b.adc, dtype=np.float64))
+        roi_numbers = writer.write_cells(IMAGES_VAR, images, n_images)
+        writer.write(ROI_NUMBERS_VAR, np.array(roi_numbers, dtype=np.int64))
 
 class _MatBinImages(BaseDictlike):
-    def __init__(self, mat):
-        self._mat = mat
+    def __init__(self, mat_bin):
+        self._bin = mat_bin
+    @cached_property
+    def _positions(self):
+        # target number -> position in the images cell array
+        return { k: i for i, k in enumerate(self.keys()) }
     def keys(self):
-        for k in self._mat[ROI_NUMBERS_VAR]:
-            yield k
+        return [int(k) for k in np.atleast_1d(self._bin._roi_numbers)]
     def has_key(self, k):
-        return k in self._mat[ROI_NUMBERS_VAR]
+        return k in self._positions
+    def __len__(self):
+        return len(self._positions)
     def __getitem__(self, roi_number):
-        i = 0
-        for k in self.keys():
-            if k == roi_number:
-                return self._mat[IMAGES_VAR][i]
-            i += 1 
-        raise KeyError('no ROI #%d' % roi_number)
-    
+        try:
+            i = self._positions[roi_number]
+        except KeyError:
+            raise KeyError('no ROI #%d' % roi_number)
+        return self._bin._images[i]
+
 class MatBin(BaseBin):
-    def __init__(self, mat_path):
-        self._mat = loadmat(mat_path, squeeze_me=True)
-        self.pid = Pid(self._mat[PID_VAR])
-        self.adc = pd.DataFrame(self._mat[ADC_VAR]);
+    """
+    Bin interface to a MATLAB file written by ``bin2mat``, in
+    either version 5 or version 7.3 format.
+
+    If ``lazy`` is True (the default), only the pid, headers, ADC data,
+    and target numbers are read on construction; the images are read
+    the first time one of them is accessed. Version 7.3 files are kept
+    open (until ``close`` is called) and each image is read when it
+    is accessed.
+    """
+    def __init__(self, mat_path, lazy=True):
+        """
+        :param mat_path: the path of the ``.mat`` file
+        :param lazy: whether to defer reading the images
+        """
+        self.mat_path = mat_path
+        self._h5 = None
+        if is_mat73(mat_path):
+            self._init_mat73(lazy)
+            return
+        if lazy:
+            variable_names = [PID_VAR, ADC_VAR, HEADERS_VAR, ROI_NUMBERS_VAR]
+        else:
+            variable_names = None
+        mat = loadmat(mat_path, squeeze_me=True, variable_names=variable_names)
+        self.pid = Pid(mat[PID_VAR])
+        self.adc = pd.DataFrame(mat[ADC_VAR])
         self.adc.index += 1 # 1-based indexes
-        self.images = _MatBinImages(self._mat)
-        rec = self._mat[HEADERS_VAR]
+        self._roi_numbers = mat[ROI_NUMBERS_VAR]
+        self._mat = None if lazy else mat
+        self.images = _MatBinImages(self)
+        rec = mat[HEADERS_VAR]
         rec_names = rec.dtype.names
-        self.headers = { n : np.asscalar(rec[n]) for n in rec_names }
-
-
-
+        self.headers = { n : rec[n].item() for n in rec_names }
+    def _init_mat73(self, lazy):
+        self._h5 = h5.File(self.mat_path, 'r')
+        self._mat = None
+        self.pid = Pid(read_value(self._h5[PID_VAR]))
+        self.adc = pd.DataFrame(read_value(self._h5[ADC_VAR], squeeze=False))
+        self.adc.index += 1 # 1-based indexes
+        self._roi_numbers = read_value(self._h5[ROI_NUMBERS_VAR])
+        self.headers = read_value(self._h5[HEADERS_VAR])
+        self.images = _MatBinImages(self)
+        if not lazy: # read all the images now
+            self._images = list(self._images)
+            self.close()
+    def close(self):
+        """
+        Close the file, if it is a version 7.3 file.
+        """
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+    def __exit__(self, *args):
+        self.close()
+    @cached_property
+    def _images(self):
+        if self._h5 is not None:
+            return read_value(self._h5[IMAGES_VAR])
+        mat = self._mat
+        if mat is None:
+            mat = loadmat(self.mat_path, squeeze_me=True, variable_names=[IMAGES_VAR])
+        images = mat[IMAGES_VAR]
+        if images.dtype != object: # squeezed from a single image
+            images = np.array([images], dtype=object)
+        return images
@@ -1,5 +1,11 @@
 import os
+import json
+import time
+import uuid
+import hashlib
 from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import shutil
 
@@ -7,17 +13,498 @@ import requests
 
 from .identifiers import Pid
 from .files import Fileset, FilesetBin
+from .adc import AdcFile
+from .roi import RoiFile
+
+DEFAULT_POOL_SIZE = 16
+"""
+Default number of connections per host kept by the shared session
+"""
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+"""
+Default size budget, in bytes, of a ``BinCache``
+"""
+
+DEFAULT_MAX_AGE = 3600
+"""
+Default number of seconds a ``BinCache`` serves files without revalidating them
+"""
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+"""
+Size of the chunks in which downloads are written to disk
+"""
+
+DEFAULT_WORKERS = 4
+"""
+Default number of bins ``open_urls`` downloads at once
+"""
+
+_session = None
+
+def get_session():
+    """
+    Return the ``requests.Session`` shared by remote bins, creating
+    it if necessary. The session keeps connections alive and pools
+    up to ``DEFAULT_POOL_SIZE`` of them per host.
+
+    :returns requests.Session: the session
+    """
+    global _session
+    if _session is None:
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=DEFAULT_POOL_SIZE,
+            pool_maxsize=DEFAULT_POOL_SIZE)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        _session = s
+    return _session
+
+def _download(session, url, path, headers=None):
+    # stream a file to disk. returns the response, whose body has been
+    # consumed unless the status is 304 (not modified)
+    with session.get(url, headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            return r
+        r.raise_for_status()
+        with open(path, 'wb') as fout:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                fout.write(chunk)
+        return r
+
+def _download_all(session, downloads):
+    # download (url, path, headers) triples concurrently. returns
+    # the responses, in order
+    if len(downloads) <= 1:
+        return [_download(session, *d) for d in downloads]
+    with ThreadPoolExecutor(len(downloads)) as executor:
+        futures = [executor.submit(_download, session, *d) for d in downloads]
+        return [f.result() for f in futures]
+
+def _validators(response):
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified')
+    }
+
+def _conditional_headers(validators):
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+def _base_url(url):
+    # the base URL of a bin's files (no extension)
+    return os.path.splitext(url)[0]
+
+def _dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, fn))
+            except OSError: # removed by another process
+                pass
+    return size
+
+class BinCache(object):
+    """
+    Persistent local cache of the raw data files of remote bins,
+    with a size budget and least-recently-used eviction.
+
+    Each bin is stored under a directory named by a hash of its
+    URL. Every download of a bin's files creates a new, complete
+    version directory, which is moved into place with an atomic rename;
+    a small ``entry.json`` file, itself replaced atomically, records
+    the current version, its size, and each file's ``ETag`` and
+    ``Last-Modified`` validators. Readers therefore never see partially
+    written files, and several processes can share a cache. The
+    modification times of ``entry.json`` and of the version directory
+    record when the bin was last used.
+
+    Bins in use are protected from eviction: a bin is never removed
+    within ``GRACE_PERIOD`` seconds of being used, nor while a lease
+    on it is held (see ``lease``). ``open_url`` and ``open_urls`` hold
+    a lease on each bin while it is open.
+
+    Files validated less than ``max_age`` seconds ago are served
+    without contacting the server. Older files are revalidated with
+    conditional requests and downloaded again only if they have
+    changed.
+    """
+    ENTRY_FILE = 'entry.json'
+    TEMP_PREFIX = '.tmp-'
+    LEASE_PREFIX = '.lease-'
+    GRACE_PERIOD = 60 # seconds after use before a bin can be removed
+    TEMP_TIMEOUT = 24 * 3600 # seconds after which a temp file is considered abandoned
+    LEASE_TIMEOUT = 24 * 3600 # seconds after which a lease is considered abandoned
+    def __init__(self, root, max_size=DEFAULT_CACHE_SIZE, max_age=DEFAULT_MAX_AGE):
+        """
+        :param root: the cache directory (created if it does not exist)
+        :param max_size: the size budget in bytes
+        :param max_age: the number of seconds to serve files without
+          revalidating them (None to never revalidate)
+        """
+        self.root = root
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(root, exist_ok=True)
+    def _key(self, base_url):
+        return hashlib.sha1(_base_url(base_url).encode('utf-8')).hexdigest()
+    def _entry_path(self, key):
+        return os.path.join(self.root, key, self.ENTRY_FILE)
+    def _read_entry(self, key):
+        try:
+            with open(self._entry_path(key)) as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return None
+    def _write_entry(self, key, entry):
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, key), prefix=self.TEMP_PREFIX)
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(entry, fout)
+        os.replace(tmp, self._entry_path(key))
+    def _touch(self, key, entry):
+        for path in [self._entry_path(key), os.path.join(self.root, key, entry['version'])]:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+    def _base_path(self, key, entry):
+        return os.path.join(self.root, key, entry['version'], entry['lid'])
+    def _isfresh(self, entry, ext, now):
+        f = entry['files'].get(ext)
+        if f is None:
+            return False
+        return self.max_age is None or now - f['validated'] < self.max_age
+    def _version_path(self, key, entry):
+        return os.path.join(self.root, key, entry['version'])
+    def fetch(self, base_url, exts, session=None, lease=False):
+        """
+        Return the local path of a remote bin's files, downloading
+        or revalidating them as needed. The files are protected from
+        eviction for ``GRACE_PERIOD`` seconds; to use them for longer,
+        hold a lease on them.
+
+        :param base_url: the base URL of the remote files (an extension,
+          if any, is ignored)
+        :param exts: the extensions of the files needed
+          (e.g., ``['hdr', 'adc', 'roi']``)
+        :param session: (optional) the ``requests.Session`` to use
+        :param lease: whether to take a lease on the files (see
+          ``lease``). Unlike calling ``lease`` afterward, this leaves
+          no interval in which the files could be evicted.
+        :returns: the base path of the local files (no extension), or,
+          if ``lease`` is true, the base path and the lease
+        """
+        if session is None:
+            session = get_session()
+        base_url = _base_url(base_url)
+        while True:
+            result = self._fetch(base_url, exts, session, lease)
+            if result is not None:
+                return result if lease else result[0]
+    def _fetch(self, base_url, exts, session, lease):
+        # returns the base path and lease (or None), or None if a
+        # cached version was removed while it was being used
+        key = self._key(base_url)
+        entry = self._read_entry(key)
+        if entry is not None and not os.path.isdir(self._version_path(key, entry)):
+            entry = None # removed, or being removed, by another process
+        now = time.time()
+        if entry is not None and all(self._isfresh(entry, ext, now) for ext in exts):
+            try:
+                lease_path = self._new_lease(self._version_path(key, entry)) if lease else None
+            except FileNotFoundError: # just removed
+                return None
+            self._touch(key, entry)
+            return self._base_path(key, entry), lease_path
+        lid = Pid(base_url).bin_lid
+        old_files = entry['files'] if entry is not None else {}
+        tmp = tempfile.mkdtemp(dir=self.root, prefix=self.TEMP_PREFIX)
+        lease_path = None
+        try:
+            files, changed = {}, False
+            all_exts = sorted(set(exts) | set(old_files))
+            to_download = []
+            for ext in all_exts:
+                old = old_files.get(ext)
+                if old is not None and (ext not in exts or self._isfresh(entry, ext, now)):
+                    files[ext] = old # keep without revalidating
+                else:
+                    to_download.append(ext)
+            downloads = [('%s.%s' % (base_url, ext), os.path.join(tmp, '%s.%s' % (lid, ext)),
+                _conditional_headers(old_files[ext]) if ext in old_files else None) for ext in to_download]
+            for ext, r in zip(to_download, _download_all(session, downloads)):
+                if r.status_code == 304:
+                    files[ext] = dict(old_files[ext], validated=now)
+                else:
+                    files[ext] = dict(_validators(r), validated=now)
+                    changed = True
+            for ext in all_exts:
+                path = os.path.join(tmp, '%s.%s' % (lid, ext))
+                if not os.path.exists(path): # carry over the cached copy
+                    src = os.path.join(self._version_path(key, entry), '%s.%s' % (lid, ext))
+                    try:
+                        os.link(src, path)
+                    except FileNotFoundError: # just removed
+                        shutil.rmtree(tmp)
+                        return None
+                    except OSError:
+                        shutil.copyfile(src, path)
+            size = sum(os.path.getsize(os.path.join(tmp, '%s.%s' % (lid, ext))) for ext in all_exts)
+            if not changed and entry is not None: # nothing changed; keep the current version
+                version = entry['version']
+                try:
+                    if lease:
+                        lease_path = self._new_lease(self._version_path(key, entry))
+                except FileNotFoundError: # just removed; use the new copy
+                    changed = True
+                else:
+                    shutil.rmtree(tmp)
+            if changed or entry is None:
+                version = uuid.uuid4().hex
+                if lease: # leased before it can be seen by other processes
+                    lease_path = self._new_lease(tmp)
+                os.makedirs(os.path.join(self.root, key), exist_ok=True)
+                os.rename(tmp, os.path.join(self.root, key, version))
+                if lease_path is not None:
+                    lease_path = os.path.join(self.root, key, version, os.path.basename(lease_path))
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        new_entry = { 'url': base_url, 'lid': lid, 'version': version, 'size': size, 'files': files }
+        self._write_entry(key, new_entry)
+        self._touch(key, new_entry)
+        if entry is not None and version != entry['version']:
+            self._prune_versions(key, version, now)
+        self.evict(keep=key)
+        return self._base_path(key, new_entry), lease_path
+    def _new_lease(self, version_path):
+        lease = os.path.join(version_path, self.LEASE_PREFIX + uuid.uuid4().hex)
+        with open(lease, 'w'):
+            pass
+        return lease
+    def lease(self, base_path):
+        """
+        Protect a bin's files, as returned by ``fetch``, from eviction
+        until the lease is released (or ``LEASE_TIMEOUT`` seconds have
+        passed). See also ``fetch``'s ``lease`` parameter.
+
+        :param base_path: the base path of the files
+        :returns str: the lease, to pass to ``release``
+        """
+        return self._new_lease(os.path.dirname(base_path))
+    def release(self, lease):
+        """
+        Release a lease obtained from ``lease``.
+        """
+        try:
+            os.remove(lease)
+        except OSError:
+            pass
+    def _in_use(self, version_path, now):
+        # is a version directory recently used or leased?
+        try:
+            if now - os.path.getmtime(version_path) < self.GRACE_PERIOD:
+                return True
+            for e in os.scandir(version_path):
+                if e.name.startswith(self.LEASE_PREFIX) and now - e.stat().st_mtime < self.LEASE_TIMEOUT:
+                    return True
+        except OSError: # already removed
+            pass
+        return False
+    def _prune_versions(self, key, current, now):
+        # remove versions of a bin that are no longer current or in use
+        for v in os.scandir(os.path.join(self.root, key)):
+            if v.is_dir() and v.name != current and not self._in_use(v.path, now):
+                shutil.rmtree(v.path, ignore_errors=True)
+    def _entries(self):
+        # yield (key, last used, size) for each cached bin
+        for e in os.scandir(self.root):
+            if not e.is_dir() or e.name.startswith(self.TEMP_PREFIX):
+                continue
+            entry = self._read_entry(e.name)
+            try:
+                mtime = os.path.getmtime(self._entry_path(e.name))
+            except OSError:
+                mtime = 0 # incomplete entry
+            if entry is None or 'size' not in entry:
+                yield e.name, mtime, _dir_size(e.path)
+            else:
+                yield e.name, mtime, entry['size']
+    def _remove_abandoned(self, now):
+        # remove temp files left by interrupted downloads
+        for e in os.scandir(self.root):
+            if e.name.startswith(self.TEMP_PREFIX) and now - e.stat().st_mtime > self.TEMP_TIMEOUT:
+                shutil.rmtree(e.path, ignore_errors=True)
+    def evict(self, keep=None):
+        """
+        Remove least-recently-used bins until the cache is within
+        its size budget. Bins that are in use (see ``BinCache``)
+        are not removed, so the cache may remain over budget.
+
+        :param keep: (optional) the key of a bin not to remove
+        :returns int: the number of bins removed
+        """
+        now = time.time()
+        self._remove_abandoned(now)
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(e[2] for e in entries)
+        n = 0
+        for key, mtime, size in entries:
+            if total <= self.max_size:
+                break
+            if key == keep or now - mtime < self.GRACE_PERIOD:
+                continue
+            key_path = os.path.join(self.root, key)
+            try:
+                versions = [v.path for v in os.scandir(key_path) if v.is_dir()]
+            except OSError: # removed by another process
+                continue
+            if any(self._in_use(v, now) for v in versions):
+                continue
+            shutil.rmtree(key_path, ignore_errors=True)
+            total -= size
+            n += 1
+        return n
+    def size(self):
+        """
+        :returns int: the total size of the cached files in bytes
+        """
+        return sum(e[2] for e in self._entries())
+    def __contains__(self, base_url):
+        return self._read_entry(self._key(base_url)) is not None
+    def clear(self):
+        """
+        Remove all cached bins, including any in use.
+        """
+        for e in os.scandir(self.root):
+            shutil.rmtree(e.path, ignore_errors=True)
+    def __repr__(self):
+        return '<BinCache %s>' % self.root
+
+class HttpRoiFile(RoiFile):
+    """
+    ``RoiFile`` backed by a ``.roi`` file on an HTTP server. The byte
+    range of each image is located using the (local) ADC data, and
+    only those bytes are fetched, using HTTP ``Range`` requests.
+    Adjacent images read with ``read_many`` are fetched together.
+
+    Servers that ignore ``Range`` requests are supported, but then
+    every read transfers the whole file.
+    """
+    def __init__(self, adc, roi_url, session=None):
+        """
+        :param adc: the path of the ``.adc`` file, or an ``AdcFile`` object
+        :param roi_url: the URL of the ``.roi`` file
+        :param session: (optional) the ``requests.Session`` to use
+          (by default, the shared session; see ``get_session``)
+        """
+        super(HttpRoiFile, self).__init__(adc, roi_url)
+        self.session = session if session is not None else get_session()
+    @property
+    def url(self):
+        """
+        The URL of the ``.roi`` file
+        """
+        return self.path
+    def getsize(self):
+        """
+        :returns int: the size of the file in bytes
+        """
+        r = self.session.head(self.url)
+        r.raise_for_status()
+        return int(r.headers['Content-Length'])
+    def _open_handle(self):
+        # there is no file handle; all requests go through the session
+        return self.session
+    def _close_handle(self, inroi):
+        pass
+    def _read(self, inroi, byte_offset, length):
+        if length == 0:
+            return b''
+        headers = { 'Range': 'bytes=%d-%d' % (byte_offset, byte_offset + length - 1) }
+        r = inroi.get(self.url, headers=headers)
+        r.raise_for_status()
+        if r.status_code == 206: # partial content
+            data = r.content
+        else: # range ignored; the whole file was sent
+            data = r.content[byte_offset:byte_offset + length]
+        if len(data) != length:
+            raise IOError('expected %d bytes from %s, got %d' % (length, self.url, len(data)))
+        return data
+    def __repr__(self):
+        return '<HTTP ROI file %s>' % self.url
+
+class HttpFilesetBin(FilesetBin):
+    """
+    ``FilesetBin`` whose ``.hdr`` and ``.adc`` files are local and
+    whose images are fetched on demand from a remote ``.roi`` file
+    (see ``HttpRoiFile``).
+    """
+    def __init__(self, fileset, roi_url, session=None):
+        """
+        :param fileset: the ``Fileset`` containing the ``.hdr`` and
+          ``.adc`` files (the ``.roi`` file need not exist)
+        :param roi_url: the URL of the ``.roi`` file
+        :param session: (optional) the ``requests.Session`` to use
+        """
+        self.fileset = fileset
+        self.adc_file = AdcFile(fileset.adc_path)
+        self.roi_file = HttpRoiFile(self.adc_file, roi_url, session=session)
+    def as_single(self, target, index=False):
+        raise ValueError('as_single is not supported for remote bins')
+
+def _exts(images, ranges):
+    if images and not ranges:
+        return ['hdr', 'adc', 'roi']
+    return ['hdr', 'adc']
+
+def _stage(base_url, exts, session, cache=None):
+    # download a bin's files, concurrently. returns the base path of the
+    # local files and a function that releases them (removing temporary
+    # files, or releasing the lease on cached files)
+    if cache is not None:
+        base_path, lease = cache.fetch(base_url, exts, session=session, lease=True)
+        return base_path, lambda: cache.release(lease)
+    d = tempfile.mkdtemp()
+    try:
+        base_path = os.path.join(d, Pid(base_url).bin_lid)
+        _download_all(session, [('%s.%s' % (base_url, ext), '%s.%s' % (base_path, ext), None) for ext in exts])
+    except BaseException:
+        shutil.rmtree(d)
+        raise
+    return base_path, lambda: shutil.rmtree(d)
+
+def _staged_bin(base_path, base_url, images, ranges, session):
+    fs = Fileset(base_path)
+    if images and ranges:
+        return HttpFilesetBin(fs, '%s.roi' % base_url, session=session)
+    return FilesetBin(fs)
 
 @contextmanager
-def open_url(base_url, images=True):
+def open_url(base_url, images=True, ranges=False, session=None, cache=None):
     """
     Context manager for remote access to a bin. Stages
-    files to a temporary directory and creates a ``FilesetBin``
-    backed by them.
+    files to a temporary directory (or a ``BinCache``) and creates
+    a ``FilesetBin`` backed by them. The files are downloaded
+    concurrently and streamed to disk.
 
     :param url: the base URL of the remote files
     :param image: whether or not to download image data (i.e., the
       ``.roi`` file)
+    :param ranges: if True, do not download the ``.roi`` file; instead
+      fetch each image when it is accessed, using HTTP range requests
+      (see ``HttpRoiFile``)
+    :param session: (optional) the ``requests.Session`` to use
+      (by default, a shared session; see ``get_session``)
+    :param cache: (optional) a ``BinCache`` in which to keep the
+      files, so that they are not downloaded again the next time
+      the bin is opened
 
     :Example:
 
@@ -26,20 +513,70 @@ def open_url(base_url, images=True):
 
 
     """
-    d = tempfile.mkdtemp()
+    if session is None:
+        session = get_session()
+    base_url = _base_url(base_url)
+    base_path, release = _stage(base_url, _exts(images, ranges), session, cache)
     try:
-        base_url = os.path.splitext(base_url)[0]
-        base_path = os.path.join(d, Pid(base_url).bin_lid)
-        if images:
-            exts = ['hdr', 'adc', 'roi']
-        else:
-            exts = ['hdr', 'adc']
-        for ext in exts:
-            url = '%s.%s' % (base_url, ext)
-            path = '%s.%s' % (base_path, ext)
-            with open(path,'wb') as f:
-                f.write(requests.get(url).content)
-        fs = Fileset(base_path)
-        yield FilesetBin(fs)
+        b = _staged_bin(base_path, base_url, images, ranges, session)
+        try:
+            yield b
+        finally:
+            b.close()
     finally:
-        shutil.rmtree(d)
+        release()
+
+def open_urls(base_urls, images=True, ranges=False, session=None, cache=None, workers=DEFAULT_WORKERS):
+    """
+    Generator providing remote access to many bins, in order. While
+    one bin is in use, up to ``workers`` of the following bins are
+    downloaded in the background. Each bin's files are removed (or,
+    if they are in a ``cache``, their lease is released) when the next
+    bin is requested, so a bin should not be used after that.
+
+    Other parameters are as for ``open_url``.
+
+    :param base_urls: the base URLs of the bins
+    :param workers: the largest number of bins to download at once
+
+    :Example:
+
+    >>> for b in open_urls(urls):
+    ...     im = b.images[32]
+
+    """
+    if session is None:
+        session = get_session()
+    exts = _exts(images, ranges)
+    base_urls = (_base_url(u) for u in base_urls)
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        def submit():
+            for base_url in base_urls:
+                pending.append((base_url, executor.submit(_stage, base_url, exts, session, cache)))
+                return
+        try:
+            for _ in range(workers):
+                submit()
+            while pending:
+                base_url, future = pending.popleft()
+                base_path, release = future.result()
+                try:
+                    submit()
+                    b = _staged_bin(base_path, base_url, images, ranges, session)
+                    try:
+                        yield b
+                    finally:
+                        b.close()
+                finally:
+                    release()
+        finally:
+            # clean up bins downloaded but never used
+            for _, future in pending:
+                if future.cancel():
+                    continue
+                try:
+                    _, release = future.result()
+                except Exception:
+                    continue
+                release()
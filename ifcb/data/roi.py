@@ -3,12 +3,14 @@ Support for reading images from IFCB ``.roi`` files.
 """
 
 import os
-from functools import lru_cache
+import threading
 
 import numpy as np
+import pandas as pd
 
-from .adc import AdcFile
-from .utils import BaseDictlike
+from .adc import AdcFile, SCHEMA
+from .identifiers import Pid
+from .utils import BaseDictlike, cached_property, clear_cache
 
 def read_image(inroi, byte_offset, width, height):
     """
@@ -25,6 +27,124 @@ def read_image(inroi, byte_offset, width, height):
     inroi.seek(byte_offset)
     return np.frombuffer(inroi.read(length), dtype=np.uint8).reshape((width,height))
 
+def image_view(roi_data, byte_offset, width, height):
+    """
+    Return a view of an image in memory-mapped (or otherwise
+    in-memory) raw 8-bit binary data. No data is copied.
+
+    :param roi_data: a 1d uint8 array (e.g., a ``numpy.memmap``)
+    :param byte_offset: the position of the image in the data
+    :param width: the width of the image in pixels
+    :param height: the height of the image in pixels
+
+    :returns array-like: an 8-bit 2d image
+    """
+    length = width * height
+    view = np.asarray(roi_data[byte_offset:byte_offset+length])
+    return view.reshape((width,height))
+
+def iter_all_images(images):
+    """
+    Iterate over all of a bin's images, with ``RoiFile.iter_images``
+    (i.e., with as few reads as possible) if the images are in a
+    ``RoiFile``. The images may then be read-only views of shared
+    buffers, so this is meant for code that only reads them, such
+    as code that writes bins in other formats.
+
+    :param images: the images (e.g., ``Bin.images``)
+    :returns: iterator of ``(roi_number, image)`` pairs
+    """
+    if hasattr(images, 'iter_images'):
+        return images.iter_images()
+    return images.items()
+
+HAS_PREAD = hasattr(os, 'pread')
+"""
+Whether positional reads (``os.pread``) are available on this platform
+"""
+
+DEFAULT_MAX_READ = 16 * 1024 * 1024
+"""
+Default upper bound, in bytes, on the size of a coalesced read
+"""
+
+def coalesce_ranges(offsets, lengths, max_gap=0, max_read=DEFAULT_MAX_READ):
+    """
+    Group byte ranges into a small number of contiguous reads.
+    Ranges must be sorted by offset. Ranges separated by no more
+    than ``max_gap`` bytes are merged, as long as the merged read
+    does not exceed ``max_read`` bytes. A single range larger
+    than ``max_read`` is read by itself.
+
+    :param offsets: the start of each range, in ascending order
+    :param lengths: the length of each range
+    :param max_gap: the largest gap to read through
+    :param max_read: the largest number of bytes to read at once
+    :returns list: ``(start, end, first, last)`` for each read, where
+      ``first`` and ``last`` (exclusive) delimit the ranges it contains
+    """
+    reads = []
+    if len(offsets) == 0:
+        return reads
+    start, end, first = offsets[0], offsets[0] + lengths[0], 0
+    for i in range(1, len(offsets)):
+        o, e = offsets[i], offsets[i] + lengths[i]
+        if o <= end + max_gap and max(end, e) - start <= max_read:
+            end = max(end, e)
+        else:
+            reads.append((int(start), int(end), first, i))
+            start, end, first = o, e, i
+    reads.append((int(start), int(end), first, len(offsets)))
+    return reads
+
+class RoiIndex(object):
+    """
+    Compact index of the ROIs in a ``.roi`` file, built from
+    ADC data. Maps target numbers to the byte offset and shape of
+    each image using numpy arrays and a direct-address table, so
+    lookups do not go through pandas.
+    """
+    def __init__(self, csv, schema):
+        """
+        :param csv: ADC data (as a ``pandas.DataFrame``) for targets with ROIs
+        :param schema: the ADC schema
+        """
+        self.targets = np.asarray(csv.index, dtype=np.int64)
+        self.offsets = np.asarray(csv[schema.START_BYTE], dtype=np.int64)
+        self.heights = np.asarray(csv[schema.ROI_HEIGHT], dtype=np.int64)
+        self.widths = np.asarray(csv[schema.ROI_WIDTH], dtype=np.int64)
+        # position of each target number, or -1
+        size = self.targets.max() + 1 if len(self.targets) else 0
+        self.positions = np.full(size, -1, dtype=np.int64)
+        self.positions[self.targets] = np.arange(len(self.targets))
+    def position(self, target_number):
+        """
+        :param target_number: the target number
+        :returns int: the position of the ROI in the index
+        :raises KeyError: if there is no ROI for the target number
+        """
+        if 0 <= target_number < len(self.positions):
+            p = self.positions[target_number]
+            if p >= 0:
+                return p
+        raise KeyError('adc data does not contain a roi #%d' % target_number)
+    def lookup(self, target_number):
+        """
+        :param target_number: the target number
+        :returns tuple: the byte offset, height, and width of the ROI
+        :raises KeyError: if there is no ROI for the target number
+        """
+        p = self.position(target_number)
+        return int(self.offsets[p]), int(self.heights[p]), int(self.widths[p])
+    def __contains__(self, target_number):
+        try:
+            self.position(target_number)
+            return True
+        except (KeyError, TypeError, IndexError):
+            return False
+    def __len__(self):
+        return len(self.targets)
+
 class RoiFile(BaseDictlike):
     """
     Wraps and provides access to an IFCB ``.roi`` file.
@@ -34,11 +154,26 @@ class RoiFile(BaseDictlike):
     and access to images by target number.
 
     Requires an associated ``.adc`` file or ``AdcFile`` object.
+
+    In memory-mapped mode the file is mapped once when opened
+    and images are returned as read-only views into the mapping
+    rather than being read and copied. Images remain valid after
+    the file is closed; the mapping is released when the last
+    image referring to it is garbage collected.
+
+    Reading images is thread-safe: many threads may read from the
+    same ``RoiFile`` at once, whether or not it is open. Reads from
+    an open file use positional I/O (``os.pread``) so they do not
+    share a file position; on platforms without ``os.pread`` they
+    are serialized with a lock. Reads from a closed file use their
+    own file handle. Opening or closing the file while other threads
+    are reading from it is not safe.
     """
-    def __init__(self, adc, roi_path):
+    def __init__(self, adc, roi_path, mmap=False):
         """
         :param adc: the path of the ``.adc`` file, or an ``AdcFile`` object
         :param roi_path: the path to the ``.roi`` file
+        :param mmap: whether to memory-map the file
         """
         # duck type adc argument
         self.adc = None
@@ -46,17 +181,33 @@ class RoiFile(BaseDictlike):
             adc.pid # should work for AdcFile objects
             self.adc = adc
         except AttributeError:
-            self.adc = AdcFile(adc)
+            # only the columns needed to locate images
+            schema = SCHEMA[Pid(adc).schema_version]
+            self.adc = AdcFile(adc, columns=schema._image_cols)
         self.path = roi_path
+        self.mmap = mmap
         self._inroi = None # start with the file closed
-    @property
-    @lru_cache()
+        self._lock = threading.Lock() # only used without os.pread
+    @cached_property
     def csv(self):
         """adc data with non-ROI targets removed"""
         # remove 0x0 rois from adc data
         csv = self.adc.csv
         s = self.adc.schema
         return csv[csv[s.ROI_WIDTH] != 0]
+    @cached_property
+    def roi_index(self):
+        """
+        The ``RoiIndex`` of this file, built on first access
+        """
+        return RoiIndex(self.csv, self.adc.schema)
+    def clear_cache(self):
+        """
+        Discard the ADC data and the indexes built from it,
+        which will be recomputed on next access.
+        """
+        clear_cache(self)
+        self.adc.clear_cache()
     @property
     def lid(self):
         """
@@ -73,10 +224,21 @@ class RoiFile(BaseDictlike):
         Flag indicating if the file is open
         """
         return self._inroi is not None
+    def _open_handle(self):
+        if not self.mmap:
+            return open(self.path, 'rb')
+        elif self.getsize() == 0:
+            return np.zeros(0, dtype=np.uint8) # cannot map an empty file
+        else:
+            return np.memmap(self.path, dtype=np.uint8, mode='r')
+    def _close_handle(self, inroi):
+        # memory maps are closed when unreferenced
+        if not self.mmap:
+            inroi.close()
     def _open(self):
         if self.isopen():
             raise ValueError('RoiFile already open')
-        self._inroi = open(self.path, 'rb')
+        self._inroi = self._open_handle()
     def close(self):
         """
         Close the file.
@@ -85,8 +247,19 @@ class RoiFile(BaseDictlike):
         """
         # allow re-closing
         if self.isopen():
-            self._inroi.close()
+            self._close_handle(self._inroi)
         self._inroi = None
+    def _read(self, inroi, byte_offset, length):
+        if HAS_PREAD:
+            return os.pread(inroi.fileno(), length, byte_offset)
+        with self._lock:
+            inroi.seek(byte_offset)
+            return inroi.read(length)
+    def _read_image(self, inroi, byte_offset, width, height):
+        if self.mmap:
+            return image_view(inroi, byte_offset, width, height)
+        data = self._read(inroi, byte_offset, width * height)
+        return np.frombuffer(data, dtype=np.uint8).reshape((width,height))
     def __enter__(self):
         self._open()
         return self
@@ -101,38 +274,84 @@ class RoiFile(BaseDictlike):
         :returns numpy.array: an 8-bit 2d image
         """
         roi_number = int(roi_number)
-        s = self.adc.schema
-        keys = [s.START_BYTE, s.ROI_WIDTH, s.ROI_HEIGHT]
-        try:
-            bo, width, height = [self.csv[k][roi_number] for k in keys]
-        except KeyError:
-            raise KeyError('adc data does not contain a roi #%d' % roi_number)
+        bo, height, width = self.roi_index.lookup(roi_number)
         if width * height == 0:
             raise KeyError('roi #%d is 0x0' % roi_number)
-        if not self.isopen():
-            self._open()
-            try:
-                im = read_image(self._inroi, bo, height, width)
-            except:
-                raise
-            finally:
-                self.close()
-        else:
-            im = read_image(self._inroi, bo, height, width)
-        return im
+        inroi = self._inroi
+        if inroi is not None:
+            return self._read_image(inroi, bo, height, width)
+        # not open. use a private handle so as not to change state
+        inroi = self._open_handle()
+        try:
+            return self._read_image(inroi, bo, height, width)
+        finally:
+            self._close_handle(inroi)
+    def read_many(self, roi_numbers, max_gap=0, max_read=DEFAULT_MAX_READ):
+        """
+        Read many images using as few reads as possible. Requests
+        are sorted by position in the file and adjacent images are
+        read together (see ``coalesce_ranges``), so images are
+        yielded in file order rather than in the order requested.
+
+        Images read together share an underlying buffer.
+
+        :param roi_numbers: the (1-based) target numbers to read
+        :param max_gap: the largest number of unneeded bytes to read
+          through in order to merge reads
+        :param max_read: the largest number of bytes to read at once
+        :returns: iterator of ``(roi_number, image)`` pairs
+        """
+        ix = self.roi_index
+        roi_numbers = [int(n) for n in roi_numbers]
+        positions = np.array([ix.position(n) for n in roi_numbers], dtype=np.int64)
+        offsets = ix.offsets[positions]
+        widths = ix.widths[positions]
+        heights = ix.heights[positions]
+        lengths = widths * heights
+        if np.any(lengths == 0):
+            raise KeyError('roi #%d is 0x0' % roi_numbers[np.flatnonzero(lengths == 0)[0]])
+        order = np.argsort(offsets, kind='stable')
+        inroi = self._inroi
+        private = inroi is None
+        if private:
+            inroi = self._open_handle()
+        try:
+            for start, end, first, last in coalesce_ranges(offsets[order], lengths[order], max_gap, max_read):
+                if self.mmap:
+                    block, start = inroi, 0
+                else:
+                    block = np.frombuffer(self._read(inroi, start, end - start), dtype=np.uint8)
+                for i in order[first:last]:
+                    yield roi_numbers[i], image_view(block, offsets[i] - start, heights[i], widths[i])
+        finally:
+            if private:
+                self._close_handle(inroi)
+    def iter_images(self, **kw):
+        """
+        Iterate over all images in the file using as few reads
+        as possible. Keywords are passed to ``read_many``.
+
+        Unlike ``items``, which reads each image separately, images
+        are yielded in file order (usually, but not necessarily, the
+        order of ``keys``), and are read-only views of buffers shared
+        with neighboring images; copy an image to modify it.
+
+        :returns: iterator of ``(roi_number, image)`` pairs, in file order
+        """
+        return self.read_many(self.roi_index.targets, **kw)
     def __len__(self):
-        return len(self.csv)
-    @property
+        return len(self.roi_index)
+    @cached_property
     def index(self):
         """
-        An array-like object containing the target number
+        A ``pandas.Index`` containing the target number
           of each ROI in the file, in order
         """
-        return self.csv.index
+        return pd.Index(self.roi_index.targets)
     def keys(self):
         return self.index
     def has_key(self, k):
-        return k in self.keys()
+        return k in self.roi_index
     def __getitem__(self, roi_number):
         return self.get_image(roi_number)
     def to_dict(self):
@@ -149,7 +368,7 @@ class RoiFile(BaseDictlike):
           images as values.
         """
         return dict(self.items())
-    def to_hdf(self, hdf_file, group=None, replace=True):
+    def to_hdf(self, hdf_file, group=None, replace=True, **kw):
         """
         Convert the image data to HDF5.
 
@@ -160,9 +379,12 @@ class RoiFile(BaseDictlike):
           to use
         :param replace: whether to replace any existing data
           at that location in the HDF file
+
+        Other keywords (``layout``, ``compression``) are passed
+        to ``roi2hdf``.
         """
         from .hdf import roi2hdf
-        roi2hdf(self, hdf_file, group, replace=replace)
+        roi2hdf(self, hdf_file, group, replace=replace, **kw)
     def __repr__(self):
         return '<ROI file %s>' % self.path
     def __str__(self):
@@ -4,15 +4,82 @@ Note that this does not apply to data from commercial
 IFCB instruments.
 """
 
-from functools import lru_cache
+from collections import OrderedDict
 
 import numpy as np
 from scipy import ndimage as ndi
 
-from .utils import BaseDictlike
+from .utils import BaseDictlike, cached_property, cached_method, clear_cache
 
 ### Stitching
 
+def _position_table(targets):
+    # direct-address table giving the position of each target number, or -1
+    size = targets.max() + 1 if len(targets) else 0
+    positions = np.full(size, -1, dtype=np.int64)
+    positions[targets] = np.arange(len(targets))
+    return positions
+
+def _lookup(positions, target_number):
+    # position of a target number in a position table, or -1
+    try:
+        if 0 <= target_number < len(positions):
+            return positions[target_number]
+    except TypeError:
+        pass
+    return -1
+
+class StitchedBoxes(object):
+    """
+    Stitching coordinates held in numpy arrays, indexed by target
+    number with a direct-address table, so that per-target lookups
+    do not go through pandas.
+    """
+    COLUMNS = ['ax1', 'ay1', 'ax2', 'ay2', 'bx1', 'by1', 'bx2', 'by2', 'sx1', 'sy1', 'sx2', 'sy2']
+    def __init__(self, coordinates):
+        """
+        :param coordinates: stitching coordinates (see ``Stitcher.coordinates``)
+        """
+        self.targets = np.asarray(coordinates.index, dtype=np.int64)
+        self.boxes = np.asarray(coordinates[self.COLUMNS], dtype=np.int64)
+        self.positions = _position_table(self.targets)
+        # the second ROI of each stitched pair is excluded
+        excluded = self.targets + 1
+        self.excluded = np.zeros(excluded.max() + 1 if len(excluded) else 0, dtype=bool)
+        self.excluded[excluded] = True
+    def position(self, target_number):
+        """
+        :returns int: the position of the target in the arrays
+        :raises KeyError: if the target is not stitched
+        """
+        p = _lookup(self.positions, target_number)
+        if p < 0:
+            raise KeyError('target #%s is not stitched' % target_number)
+        return p
+    def box(self, target_number):
+        """
+        :returns dict: the target's coordinates, keyed by column name
+        """
+        return dict(zip(self.COLUMNS, self.boxes[self.position(target_number)].tolist()))
+    def shape(self, target_number):
+        """
+        :returns tuple: the height and width of the stitched image
+        """
+        _, _, _, _, _, _, _, _, sx1, sy1, sx2, sy2 = self.boxes[self.position(target_number)].tolist()
+        return (sy2 - sy1, sx2 - sx1)
+    def __contains__(self, target_number):
+        return _lookup(self.positions, target_number) >= 0
+    def is_excluded(self, target_number):
+        """
+        :returns bool: is the target the second ROI of a stitched pair?
+        """
+        try:
+            return 0 <= target_number < len(self.excluded) and bool(self.excluded[target_number])
+        except TypeError:
+            return False
+    def __len__(self):
+        return len(self.targets)
+
 class Stitcher(BaseDictlike):
     """
     Delegate for Bins that stitches images. Provides a
@@ -28,8 +95,8 @@ class Stitcher(BaseDictlike):
         :type the_bin: Bin
         """
         self.bin = the_bin
-    @property
-    @lru_cache()
+        self._recent = OrderedDict() # the most recently stitched images
+    @cached_property
     def coordinates(self):
         """
         Compute stitched image metrics.
@@ -67,7 +134,14 @@ class Stitcher(BaseDictlike):
         M['sx2'] = np.maximum(M['ax2'], M['bx2'])
         M['sy2'] = np.maximum(M['ay2'], M['by2'])
         return M
-    @lru_cache()
+    @cached_property
+    def boxes(self):
+        """
+        The stitching coordinates as a ``StitchedBoxes``, for
+        fast per-target lookups
+        """
+        return StitchedBoxes(self.coordinates)
+    @cached_method
     def excluded_targets(self):
         """
         Returns the target numbers of the targets that should
@@ -77,31 +151,49 @@ class Stitcher(BaseDictlike):
         This is just each included key + 1.
         """
         return [x + 1 for x in self.keys()]
+    def is_excluded(self, target_number):
+        """
+        :returns bool: is the target the second of a pair of
+          stitched ROIs (see ``excluded_targets``)?
+        """
+        return self.boxes.is_excluded(target_number)
     def has_key(self, target_number):
         """
         :returns bool: is the ROI with the given target
           number stitched?
         """
-        return target_number in self.coordinates.index
+        return target_number in self.boxes
     def keys(self):
         """
         Yield the target number of each stitched ROI.
         """
-        for k in self.coordinates.index:
+        for k in self.boxes.targets.tolist():
             yield k
     def __len__(self):
-        return len(self.coordinates.index)
+        return len(self.boxes)
     def shape(self, target_number):
-        row = self.coordinates.loc[target_number]
-        w = row['sx2'] - row['sx1']
-        h = row['sy2'] - row['sy1']
-        return (h, w)
-    @lru_cache(maxsize=2)
+        return self.boxes.shape(target_number)
+    def clear_cache(self):
+        """
+        Discard the stitching coordinates and any cached images.
+        """
+        clear_cache(self)
+        self._recent.clear()
     def __getitem__(self, target_number):
+        try:
+            return self._recent[target_number]
+        except KeyError:
+            pass
+        image = self._stitch(target_number)
+        self._recent[target_number] = image
+        while len(self._recent) > 2:
+            self._recent.popitem(last=False)
+        return image
+    def _stitch(self, target_number):
         h, w = self.shape(target_number)
-        row = self.coordinates.loc[target_number]
+        row = self.boxes.box(target_number)
         # create composite image
-        msk = np.ones((h,w),dtype=np.bool)
+        msk = np.ones((h,w),dtype=bool)
         im = np.zeros((h,w),dtype=np.uint8)
         for ab,ij in zip('ab',[target_number, target_number+1]):
             rx1 = row[ab+'x1'] - row['sx1']
@@ -216,8 +308,9 @@ class InfilledImages(BaseDictlike):
         Yield the target number of each ROI that is not the second
         ROI in a stitched pair.
         """
+        is_excluded = self.stitcher.is_excluded
         for k in self.bin.images:
-            if k not in self.stitcher.excluded_targets():
+            if not is_excluded(k):
                 yield k
     def has_key(self, target_number):
         """
@@ -225,8 +318,7 @@ class InfilledImages(BaseDictlike):
         second ROI from a stitched pair.
         """
         in_bin = target_number in self.bin
-        excluded = target_number in self.stitcher.excluded_targets()
-        return in_bin and not excluded
+        return in_bin and not self.stitcher.is_excluded(target_number)
     def __getitem__(self, target_number):
         if target_number in self.stitcher:
             # stitch the images
@@ -239,15 +331,24 @@ class InfilledImages(BaseDictlike):
         else:
             # this is not a stitched image
             return self.bin.images[target_number]
+    @cached_property
+    def _roi_shapes(self):
+        # (position table, heights, widths) of the bin's ROIs
+        s = self.bin.schema
+        adc = self.bin.images_adc
+        targets = np.asarray(adc.index, dtype=np.int64)
+        heights = np.asarray(adc[s.ROI_HEIGHT], dtype=np.int64)
+        widths = np.asarray(adc[s.ROI_WIDTH], dtype=np.int64)
+        return _position_table(targets), heights, widths
     def shape(self, target_number):
         if target_number in self.stitcher:
             return self.stitcher.shape(target_number)
         else:
-            s = self.bin.schema
-            row = self.bin.images_adc.loc[target_number]
-            h = int(row[s.ROI_HEIGHT])
-            w = int(row[s.ROI_WIDTH])
-            return (h, w)
+            positions, heights, widths = self._roi_shapes
+            p = _lookup(positions, target_number)
+            if p < 0:
+                raise KeyError('no ROI #%s' % target_number)
+            return (int(heights[p]), int(widths[p]))
     # convenience methods
     def raw_stitch(self, target_number):
         return self.stitcher[target_number]
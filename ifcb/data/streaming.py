@@ -0,0 +1,124 @@
+"""
+Streaming access to the images in a bin, for writing bins
+without holding all of their images in memory.
+"""
+
+import threading
+from collections import deque
+
+import numpy as np
+
+DEFAULT_BUFFER_SIZE = 32 * 1024 * 1024
+"""
+Default maximum number of bytes of image data buffered by an ``ImageStream``
+"""
+
+def _buffer_size(image):
+    # the size of the memory an image holds on to, which is larger than
+    # the image itself if it is a view into a larger buffer
+    base = image
+    while isinstance(base, np.ndarray) and base.base is not None:
+        base = base.base
+    if isinstance(base, np.ndarray):
+        return base.nbytes
+    try:
+        return memoryview(base).nbytes
+    except TypeError:
+        return image.nbytes
+
+class ImageStream(object):
+    """
+    Iterates over the images of a bin as (target number, image)
+    pairs, in the order the bin's ``images`` yields them. Images
+    are read ahead on a background thread into a buffer holding at
+    most ``buffer_size`` bytes of image data (but always at least
+    one image), so that reading overlaps with whatever the consumer
+    does with each image.
+
+    Images that are views into larger buffers (e.g., images read
+    together by ``RoiFile.read_many``, or memory-mapped images) are
+    copied before being buffered, so that buffered images do not keep
+    those buffers alive. Besides the buffer, the reader holds whatever
+    the bin's ``items`` holds while reading (e.g., one coalesced read).
+
+    Exceptions raised while reading are re-raised in the consuming
+    thread. If iteration is abandoned, call ``close`` (or use the
+    stream as a context manager) to stop the reader.
+
+    A stream can only be iterated over once.
+    """
+    def __init__(self, images, buffer_size=DEFAULT_BUFFER_SIZE):
+        """
+        :param images: a bin's ``images`` (or any dict-like with
+          an ``items`` method whose values are ``numpy`` arrays)
+        :param buffer_size: the maximum number of bytes of image
+          data to buffer
+        """
+        self.images = images
+        self.buffer_size = buffer_size
+        self.max_buffered = 0 # largest number of bytes buffered
+        self._queue = deque()
+        self._buffered = 0
+        self._cond = threading.Condition()
+        self._done = False
+        self._closed = False
+        self._error = None
+        self._thread = None
+    def _start(self):
+        if self._thread is not None:
+            raise ValueError('ImageStream can only be iterated over once')
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+    def _read(self):
+        try:
+            for target, image in self.images.items():
+                if _buffer_size(image) > image.nbytes:
+                    image = image.copy()
+                nbytes = image.nbytes
+                with self._cond:
+                    while not self._closed and self._queue and self._buffered + nbytes > self.buffer_size:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    self._queue.append((target, image))
+                    self._buffered += nbytes
+                    self.max_buffered = max(self.max_buffered, self._buffered)
+                    self._cond.notify_all()
+        except BaseException as e:
+            self._error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+    def __iter__(self):
+        self._start()
+        while True:
+            with self._cond:
+                while not self._queue and not self._done:
+                    self._cond.wait()
+                if self._queue:
+                    target, image = self._queue.popleft()
+                    self._buffered -= image.nbytes
+                    self._cond.notify_all()
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    return
+            yield target, image
+    def items(self):
+        return iter(self)
+    def close(self):
+        """
+        Stop reading and discard any buffered images.
+        """
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._buffered = 0
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
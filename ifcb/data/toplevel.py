@@ -6,8 +6,8 @@ from .identifiers import Pid
 
 # I/O helper functions
 
-from .io import open_raw, open_hdf, open_zip, open_mat
-from .remote import open_url
+from .io import open_raw, open_hdf, open_zip, open_mat, convert
+from .remote import open_url, open_urls
 
 # low-level API
 
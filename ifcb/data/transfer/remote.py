@@ -1,48 +1,156 @@
 import os
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 
-from .smb_utils import smb_connect
+from .transport import SmbTransport
 
 DEFAULT_TIMEOUT = 30
 DEFAULT_SHARE = 'data'
+DEFAULT_WORKERS = 4
+
+TEMP_SUFFIX = '.temp_download'
+MTIME_SUFFIX = '.mtime'
+
+class FileTransfer(namedtuple('FileTransfer', ['name', 'size', 'offset', 'transferred', 'elapsed'])):
+    """
+    Record of one file transfer: the file name, its size, the offset
+    the transfer resumed from, the number of bytes transferred, and the
+    time taken in seconds. Skipped files have ``transferred`` 0.
+    """
+    @property
+    def throughput(self):
+        """bytes per second, or None if nothing was transferred"""
+        if not self.transferred or not self.elapsed:
+            return None
+        return self.transferred / self.elapsed
 
 class RemoteIfcb(object):
-    def __init__(self, addr, username, password, timeout=DEFAULT_TIMEOUT):
+    def __init__(self, addr, username, password, timeout=DEFAULT_TIMEOUT, transport=None):
+        """
+        :param addr: the instrument's DNS name or IP address
+        :param username: the SMB username
+        :param password: the SMB password
+        :param timeout: the connection timeout in seconds
+        :param transport: (optional) function of no arguments returning
+          a new connected transport (see ``transport.SmbTransport``);
+          by default, connects to the instrument's data share with SMB
+        """
         self.addr = addr
         self.username = username
         self.password = password
         self.timeout = timeout
         self.share = DEFAULT_SHARE
+        if transport is None:
+            transport = self._smb_transport
+        self._connect = transport
+        self._t = None
+    def _smb_transport(self):
+        return SmbTransport(self.addr, self.username, self.password, self.share, self.timeout)
     def __enter__(self):
-        self._c = smb_connect(self.addr, self.username, self.password, self.timeout)
+        self._t = self._connect()
         return self
     def __exit__(self, type, value, traceback):
-        try:
-            self._c.close()
-        except:
-            pass
+        self._t.close()
+        self._t = None
+    def _transport(self):
+        if self._t is None:
+            raise ValueError('not connected; use RemoteIfcb in a with statement')
+        return self._t
     def list_filesets(self):
         """list fileset lids, most recent first"""
         fs = []
-        for f in self._c.listPath(self.share, ''):
-            if f.isDirectory:
+        for f in self._transport().listdir(''):
+            if f.isdir:
                 continue
-            fn = f.filename
+            fn = f.name
             if fn.endswith('.hdr'):
                 fs.append(fn[:-4])
         return sorted(fs, reverse=True)
-    def transfer_fileset(self, lid, local_directory, skip_existing=True):
-        for ext in ['hdr', 'adc', 'roi']:
-            fn = '{}.{}'.format(lid, ext)
-            local_path = os.path.join(local_directory, fn)
-            remote_path = fn
-            temp_local_path = local_path + '.temp_download'
+    def _transfer_file(self, t, fn, local_directory, skip_existing):
+        local_path = os.path.join(local_directory, fn)
+        temp_local_path = local_path + TEMP_SUFFIX
+        # the remote mtime of the file a partial download came from
+        mtime_path = temp_local_path + MTIME_SUFFIX
+        stat = t.stat(fn)
+        size = stat.size
 
-            if skip_existing and os.path.exists(local_path):
-                lf_size = os.path.getsize(local_path)
-                rf = self._c.getAttributes(self.share, remote_path)
-                if lf_size == rf.file_size:
-                    continue
+        if skip_existing and os.path.exists(local_path):
+            if os.path.getsize(local_path) == size:
+                return FileTransfer(fn, size, size, 0, 0)
 
-            with open(temp_local_path, 'wb') as fout:
-                self._c.retrieveFile(self.share, remote_path, fout)
-            os.rename(temp_local_path, local_path)
+        # resume an interrupted transfer, unless the remote file has
+        # been rewritten since it started
+        offset = 0
+        if os.path.exists(temp_local_path):
+            try:
+                with open(mtime_path) as fin:
+                    partial_mtime = float(fin.read())
+            except (IOError, ValueError):
+                partial_mtime = None
+            if partial_mtime == stat.mtime:
+                offset = os.path.getsize(temp_local_path)
+            if offset > size: # the remote file has changed
+                offset = 0
+        if offset == 0:
+            with open(mtime_path, 'w') as fout:
+                fout.write(repr(stat.mtime))
+        then = time.time()
+        with open(temp_local_path, 'ab' if offset else 'wb') as fout:
+            n = t.retrieve(fn, fout, offset) if offset < size else 0
+        elapsed = time.time() - then
+        # the file may have grown (e.g., it is still being acquired)
+        # since it was stat'ed; only a short read is an error
+        if offset + n < size:
+            raise IOError('transferred {} of {} bytes of {}'.format(offset + n, size, fn))
+        os.replace(temp_local_path, local_path)
+        os.remove(mtime_path)
+        transfer = FileTransfer(fn, offset + n, offset, n, elapsed)
+        logging.info('transferred {} ({} bytes from offset {}) in {:.2f}s ({} B/s)'.format(
+            fn, n, offset, elapsed, '%.0f' % transfer.throughput if transfer.throughput else '-'))
+        return transfer
+    def _transfer_fileset(self, t, lid, local_directory, skip_existing):
+        return [self._transfer_file(t, '{}.{}'.format(lid, ext), local_directory, skip_existing)
+            for ext in ['hdr', 'adc', 'roi']]
+    def transfer_fileset(self, lid, local_directory, skip_existing=True):
+        """transfer the three files of a fileset to a local directory.
+        partial downloads left by an interrupted transfer are resumed.
+        returns a ``FileTransfer`` for each file"""
+        return self._transfer_fileset(self._transport(), lid, local_directory, skip_existing)
+    def transfer_filesets(self, lids, local_directory, skip_existing=True, workers=DEFAULT_WORKERS):
+        """transfer many filesets to a local directory, using up to
+        ``workers`` connections at once. if any fileset fails, the
+        others are still transferred, and then the first error is raised.
+        returns a dict mapping each lid to a list of ``FileTransfer``"""
+        pool = Queue()
+        pool.put(self._transport())
+        extra = []
+        try:
+            for _ in range(min(workers, len(lids)) - 1):
+                t = self._connect()
+                extra.append(t)
+                pool.put(t)
+            def transfer(lid):
+                t = pool.get()
+                try:
+                    return self._transfer_fileset(t, lid, local_directory, skip_existing)
+                finally:
+                    pool.put(t)
+            with ThreadPoolExecutor(max(1, len(extra) + 1)) as executor:
+                futures = [(lid, executor.submit(transfer, lid)) for lid in lids]
+            results, error = {}, None
+            for lid, future in futures:
+                try:
+                    results[lid] = future.result()
+                except Exception as e:
+                    logging.error('transfer of {} failed: {}'.format(lid, e))
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+            return results
+        finally:
+            for t in extra:
+                t.close()
@@ -1,6 +1,8 @@
 import sys
 import os
+import json
 import logging
+import posixpath
 from contextlib import contextmanager
 import traceback
 
@@ -69,63 +71,144 @@ def smb_connection(remote_server, username, password, timeout=DEFAULT_TIMEOUT):
 
         c.close()
 
+MANIFEST_NAME = '.sync_manifest.json'
+FILESET_EXTENSIONS = ('hdr', 'adc', 'roi')
+
+class SyncManifest(object):
+    """record of the name, size, and modification time of each file
+    synced to a local directory, persisted as JSON. a remote file
+    needs to be synced only if it is new or its size or modification
+    time has changed since it was recorded."""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as fin:
+                self.entries = { k: tuple(v) for k, v in json.load(fin).items() }
+    def has_changed(self, name, remote_file):
+        return self.entries.get(name) != (remote_file.size, remote_file.mtime)
+    def record(self, name, remote_file):
+        self.entries[name] = (remote_file.size, remote_file.mtime)
+    def save(self):
+        # write atomically so an interrupted save leaves the old manifest
+        temp_path = self.path + '.temp'
+        with open(temp_path, 'w') as fout:
+            json.dump(self.entries, fout)
+        os.replace(temp_path, self.path)
+
+def list_remote_files(transport, path, recursive=False):
+    """returns a dict mapping the path of each file (relative to
+    ``path``, with / separators) to its ``RemoteFile``"""
+    files = {}
+    def walk(relpath):
+        for f in transport.listdir(posixpath.join(path, relpath) if relpath else path):
+            name = posixpath.join(relpath, f.name) if relpath else f.name
+            if not f.isdir:
+                files[name] = f
+            elif recursive:
+                walk(name)
+    walk('')
+    return files
+
+def sync_order(names, remote_files):
+    """order files for transfer: files of complete filesets first, newest
+    fileset first, then all other files, newest first"""
+    groups = {}
+    for name in names:
+        base, ext = posixpath.splitext(name)
+        groups.setdefault(base, []).append(name)
+    def is_complete(base):
+        return all('{}.{}'.format(base, ext) in remote_files for ext in FILESET_EXTENSIONS)
+    def newest(base):
+        return max(remote_files[n].mtime for n in groups[base])
+    complete = sorted((b for b in groups if is_complete(b)), key=lambda b: (newest(b), b), reverse=True)
+    complete_names = [n for b in complete for n in sorted(groups[b])]
+    rest = set(names).difference(complete_names)
+    return complete_names + sorted(rest, key=lambda n: (remote_files[n].mtime, n), reverse=True)
+
+def sync_directory(transport, remote_path, local_path, manifest_path=None, recursive=False, limit=None):
+    """copies files from a transport's directory to a local one.
+    only files that are new or whose size or modification time has
+    changed since the last sync (as recorded in a manifest) are
+    considered. files missing locally are copied again. files that
+    are not in the manifest but exist locally with the same size are
+    recorded without being copied. returns the number of files copied."""
+    if manifest_path is None:
+        manifest_path = os.path.join(local_path, MANIFEST_NAME)
+    manifest = SyncManifest(manifest_path)
+
+    logging.debug('listing remote directory {}'.format(remote_path))
+    remote_files = list_remote_files(transport, remote_path, recursive=recursive)
+
+    local_names = {} # directory -> set of names
+    def exists_locally(name):
+        d, fn = posixpath.split(name)
+        if d not in local_names:
+            try:
+                local_names[d] = set(os.listdir(os.path.join(local_path, d)))
+            except FileNotFoundError:
+                local_names[d] = set()
+        return fn in local_names[d]
+
+    candidates = []
+    for name, rf in remote_files.items():
+        if not exists_locally(name):
+            candidates.append(name)
+        elif manifest.has_changed(name, rf):
+            if name not in manifest.entries and os.path.getsize(os.path.join(local_path, name)) == rf.size:
+                manifest.record(name, rf) # synced before the manifest existed
+            else:
+                candidates.append(name)
+
+    def safe_copy_file(name, local_file):
+        logging.debug('Copying {} to {}'.format(name, local_file))
+        download_path = local_file + '.temp_download'
+        try:
+            os.makedirs(os.path.dirname(local_file), exist_ok=True)
+            with open(download_path,'wb') as fout:
+                transport.retrieve(posixpath.join(remote_path, name), fout)
+            os.replace(download_path, local_file)
+            return True
+        except:
+            traceback.print_exc()
+            return False
+        finally:
+            # clean up
+            if os.path.exists(download_path):
+                os.remove(download_path)
+
+    n_copied = 0
+    try:
+        for name in sync_order(candidates, remote_files):
+            if limit is not None and n_copied == limit:
+                break
+            if safe_copy_file(name, os.path.join(local_path, name)):
+                manifest.record(name, remote_files[name])
+                n_copied += 1
+    finally:
+        manifest.save()
+    return n_copied
+
 def smb_sync_directory(remote_server, username, password, remote_path, local_path,
-    timeout=DEFAULT_TIMEOUT, limit=None):
-    """copies a remote directory to a local one (non-recursive).
+    timeout=DEFAULT_TIMEOUT, limit=None, recursive=False, manifest_path=None):
+    """copies a remote directory to a local one.
     remote_server = remote server DNS name or IP address
     username = Samba username on remote server
     password = Samba username's password on remote server
     remote_path = path to remote directory including share name (e.g., '/some_share/some/folder')
     local_path = path to local directory
-    will only transfer files that are 1) not in the local directory, or
-    2) are a different size than the one in the local directory.
-    Does not recurse into subdirectories."""
-    local_files = list_local_directory(local_path)
-
-    n_copied = 0
-
-    with smb_connection(remote_server, username, password, timeout=timeout) as c:
-        logging.debug('listing remote directory {}'.format(remote_path))
-
-        share = share_name(remote_path)
-        pos = path_on_share(remote_path)
-        remote_files = [f for f in c.listPath(share, pos) if not f.isDirectory]
-
-        def safe_copy_file(remote_file, local_file):
-            logging.debug('Copying {} to {}'.format(remote_file.filename, local_file))
-            download_path = local_file + '.temp_download'
-            remote_path = os.path.join(pos, remote_file.filename)
-
-            try:
-                with open(download_path,'wb') as fout:
-                    c.retrieveFile(share, remote_path, fout)
-                os.rename(download_path, local_file)
-                return True
-            except:
-                return False
-            finally:
-                # clean up
-                if os.path.exists(download_path):
-                    os.remove(download_path)
-
-        for rf in remote_files:
-            if limit is not None and n_copied == limit:
-                return
-
-            name = rf.filename
-            local_file = os.path.join(local_path, name)
-            try:
-                if name not in local_files:
-                    logging.debug('{} does not exist locally'.format(name))
-                    if safe_copy_file(rf, local_file):
-                        n_copied += 1
-                else:
-                    remote_size = rf.file_size
-                    local_size = os.path.getsize(local_file)
-                    if local_size != remote_size:
-                        logging.debug('remote file {} is not the same size as local copy'.format(name))
-                        if safe_copy_file(rf, local_file):
-                            n_copied += 1
-            except:
-                traceback.print_exc()
-                # move on to next file
\ No newline at end of file
+    will only transfer files that are new or changed since the last
+    sync (see ``sync_directory``). complete filesets are transferred
+    first, newest first.
+    recurses into subdirectories if ``recursive`` is True.
+    returns the number of files copied."""
+    from .transport import SmbTransport
+    share = share_name(remote_path)
+    pos = path_on_share(remote_path)
+    transport = SmbTransport(remote_server, username, password, share, timeout)
+    try:
+        return sync_directory(transport, pos, local_path, manifest_path=manifest_path,
+            recursive=recursive, limit=limit)
+    finally:
+        logging.debug('Closing connection to {}'.format(remote_server))
+        transport.close()
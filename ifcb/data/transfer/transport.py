@@ -0,0 +1,95 @@
+"""
+File transports for copying raw data from IFCBs. A transport lists
+and retrieves files below some root (e.g., an SMB share on an
+instrument). ``SmbTransport`` talks to an instrument; ``LocalTransport``
+reads from a local directory, which is useful for testing.
+"""
+
+import os
+from collections import namedtuple
+
+RemoteFile = namedtuple('RemoteFile', ['name', 'size', 'mtime', 'isdir'])
+"""
+A file or directory on a transport: name, size in bytes,
+modification time (seconds since the epoch), and whether it is a directory
+"""
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+class SmbTransport(object):
+    """
+    Transport for files on an SMB share.
+    """
+    def __init__(self, addr, username, password, share, timeout=30):
+        """
+        :param addr: the server's DNS name or IP address
+        :param username: the SMB username
+        :param password: the SMB password
+        :param share: the name of the share
+        :param timeout: the connection timeout in seconds
+        """
+        from .smb_utils import smb_connect
+        self.share = share
+        self._c = smb_connect(addr, username, password, timeout)
+    def close(self):
+        try:
+            self._c.close()
+        except:
+            pass
+    def listdir(self, path=''):
+        """
+        :param path: the path of a directory on the share
+        :returns list: a ``RemoteFile`` for each entry in the directory
+        """
+        return [RemoteFile(f.filename, f.file_size, f.last_write_time, f.isDirectory)
+            for f in self._c.listPath(self.share, path) if f.filename not in ('.', '..')]
+    def stat(self, path):
+        """
+        :param path: the path of a file on the share
+        :returns RemoteFile: the file's attributes
+        """
+        f = self._c.getAttributes(self.share, path)
+        return RemoteFile(os.path.basename(path), f.file_size, f.last_write_time, f.isDirectory)
+    def retrieve(self, path, fout, offset=0):
+        """
+        Copy a file, starting at an offset, to a file-like object.
+
+        :param path: the path of the file on the share
+        :param fout: the file-like object to write to
+        :param offset: the position in the file to start at
+        :returns int: the number of bytes copied
+        """
+        _, n = self._c.retrieveFileFromOffset(self.share, path, fout, offset)
+        return n
+
+class LocalTransport(object):
+    """
+    Transport for files in a local directory.
+    """
+    def __init__(self, root):
+        """
+        :param root: the directory
+        """
+        self.root = root
+    def close(self):
+        pass
+    def _path(self, path):
+        return os.path.join(self.root, path)
+    def _remote_file(self, name, path):
+        st = os.stat(path)
+        return RemoteFile(name, st.st_size, st.st_mtime, os.path.isdir(path))
+    def listdir(self, path=''):
+        dirpath = self._path(path)
+        return [self._remote_file(name, os.path.join(dirpath, name)) for name in os.listdir(dirpath)]
+    def stat(self, path):
+        return self._remote_file(os.path.basename(path), self._path(path))
+    def retrieve(self, path, fout, offset=0):
+        n = 0
+        with open(self._path(path), 'rb') as fin:
+            fin.seek(offset)
+            while True:
+                data = fin.read(COPY_BUFFER_SIZE)
+                if not data:
+                    return n
+                fout.write(data)
+                n += len(data)
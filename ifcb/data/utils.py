@@ -1,6 +1,61 @@
 """
 Utilities for the IFCB data API.
 """
+from functools import wraps
+
+CACHE_ATTR = '_cached'
+
+def _instance_cache(obj):
+    # cached values live in a dict on the instance itself,
+    # so they are released along with it
+    try:
+        return obj.__dict__[CACHE_ATTR]
+    except KeyError:
+        return obj.__dict__.setdefault(CACHE_ATTR, {})
+
+class cached_property(object):
+    """
+    Like ``property``, but the value is computed on first access
+    and cached on the instance until ``clear_cache`` is called.
+    Unlike ``lru_cache`` on a method, the cache does not hold
+    references to instances or share capacity between them.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+    def __set_name__(self, owner, name):
+        self.name = name
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        cache = _instance_cache(obj)
+        try:
+            return cache[self.name]
+        except KeyError:
+            return cache.setdefault(self.name, self.func(obj))
+
+def cached_method(func):
+    """
+    Per-instance cache for a method that takes no arguments
+    (see ``cached_property``).
+    """
+    name = func.__name__
+    @wraps(func)
+    def wrapper(self):
+        cache = _instance_cache(self)
+        try:
+            return cache[name]
+        except KeyError:
+            return cache.setdefault(name, func(self))
+    return wrapper
+
+def clear_cache(obj):
+    """
+    Discard all values cached on an object by
+    ``cached_property`` and ``cached_method``.
+    """
+    obj.__dict__.pop(CACHE_ATTR, None)
 
 class BaseDictlike(object):
     """
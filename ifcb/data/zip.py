@@ -1,14 +1,18 @@
 from zipfile import ZipFile, ZIP_STORED
 import json
+import struct
 from io import StringIO, BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from functools import lru_cache
+import numpy as np
 import pandas as pd
 
 from .identifiers import Pid
 from .adc import SCHEMA
-from .utils import BaseDictlike
+from .utils import BaseDictlike, cached_property
 from .bins import BaseBin
+from .roi import image_view, iter_all_images
 
 from .imageio import format_image, read_image
 
@@ -16,7 +20,65 @@ METADATA_ARCNAME = 'metadata.json'
 HEADERS_ARCNAME_SUFFIX = '_headers.json'
 ADC_ARCNAME_SUFFIX = '.csv'
 
-def bin2zip(b, zip_path):
+PNG_FORMAT = 'png'
+RAW_FORMAT = 'raw'
+IMAGE_EXTENSIONS = {
+    PNG_FORMAT: '.png',
+    RAW_FORMAT: '.raw'
+}
+
+# layout of a zip local file header (APPNOTE.TXT 4.3.7): signature,
+# versions, flags, compression, time, date, CRC-32, sizes, and the
+# lengths of the name and extra field that follow it
+_FH_STRUCT = struct.Struct('<4s2B4HL2L2H')
+_FH_SIZE = _FH_STRUCT.size # 30 bytes
+
+# positions of the name and extra field lengths in a local file header
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+
+def _encode_png(image):
+    return format_image(image, mimetype='image/png').getvalue()
+
+def _encode_pngs(images, workers):
+    # yield (target, png bytes) in the order of images, encoding
+    # up to 2 * workers images at a time
+    if not workers or workers < 2:
+        for target, image in images:
+            yield target, _encode_png(image)
+        return
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for target, image in images:
+            pending.append((target, pool.submit(_encode_png, image)))
+            if len(pending) >= 2 * workers:
+                target, future = pending.popleft()
+                yield target, future.result()
+        while pending:
+            target, future = pending.popleft()
+            yield target, future.result()
+
+def bin2zip(b, zip_path, images=None, workers=None, raw=False):
+    """
+    Write a bin to a zip file, with the bin's metadata and headers
+    as JSON, its ADC data as CSV, and its images as PNGs.
+
+    If ``raw`` is True, images are instead stored as uncompressed
+    8-bit pixels, with their shapes recorded in the metadata. Raw
+    archives are larger, but ``ZipBin`` can read their images without
+    decoding or copying them.
+
+    :param b: the bin
+    :param zip_path: the path of the zip file
+    :param images: (optional) (target number, image) pairs to write
+      instead of the bin's images (e.g., an ``ImageStream``)
+    :param workers: (optional) the number of threads with which to
+      encode PNGs. Entries are written in the same order, and the
+      output is identical, regardless of the number of threads.
+    :param raw: whether to store raw pixels instead of PNGs
+    """
+    if images is None:
+        images = iter_all_images(b.images)
     with ZipFile(zip_path, 'w', compression=ZIP_STORED) as zip:
         # bin metadata as JSON
         metadata = {
@@ -24,7 +86,8 @@ def bin2zip(b, zip_path):
             'schema': b.pid.schema_version,
             'timestamp': b.timestamp.isoformat()
         }
-        zip.writestr(METADATA_ARCNAME, json.dumps(metadata))
+        if not raw:
+            zip.writestr(METADATA_ARCNAME, json.dumps(metadata))
         # headers as JSON
         headers_json = json.dumps(b.headers)
         zip.writestr(b.lid + HEADERS_ARCNAME_SUFFIX, headers_json)
@@ -33,12 +96,23 @@ def bin2zip(b, zip_path):
         # FIXME what float format to use?
         b.adc.to_csv(buf, header=False)
         zip.writestr(b.lid + ADC_ARCNAME_SUFFIX, buf.getvalue())
+        if raw:
+            # images as raw pixels, with their shapes in the metadata
+            shapes = {}
+            for target, image in images:
+                image_lid = b.pid.with_target(target, namespace=False)
+                arcname = image_lid + IMAGE_EXTENSIONS[RAW_FORMAT]
+                zip.writestr(arcname, np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+                shapes[str(target)] = list(image.shape)
+            metadata['images'] = RAW_FORMAT
+            metadata['shapes'] = shapes
+            zip.writestr(METADATA_ARCNAME, json.dumps(metadata))
+            return
         # images as PNGs
-        for target in b.images:
+        for target, png in _encode_pngs(images, workers):
             image_lid = b.pid.with_target(target, namespace=False)
-            arcname = image_lid + '.png'
-            buf = format_image(b.images[target], mimetype='image/png')
-            zip.writestr(arcname, buf.getvalue())
+            arcname = image_lid + IMAGE_EXTENSIONS[PNG_FORMAT]
+            zip.writestr(arcname, png)
 
 class ZipImages(BaseDictlike):
     def __init__(self, open_zip_file):
@@ -56,13 +130,43 @@ class _ZipBinImages(BaseDictlike):
     def __init__(self, zip_bin):
         self.b = zip_bin
         self.zi = ZipImages(zip_bin._zip)
-        s = self.b.schema
-        csv = self.b.adc
-        csv = csv[csv[s.ROI_WIDTH] != 0]
-        self.index = csv.index
+        if zip_bin.image_format == RAW_FORMAT:
+            self.index = pd.Index(list(zip_bin._shapes.keys()))
+        else:
+            s = self.b.schema
+            csv = self.b.adc
+            csv = csv[csv[s.ROI_WIDTH] != 0]
+            self.index = csv.index
+        self._data = None
     def arcname(self, target):
-        return self.b.pid.with_target(target) + '.png'
+        return self.b.pid.with_target(target) + IMAGE_EXTENSIONS[self.b.image_format]
+    def _raw_image(self, target):
+        try:
+            h, w = self.b._shapes[target]
+        except KeyError:
+            raise KeyError('no ROI #%s' % target)
+        zinfo = self.zi._zip.getinfo(self.arcname(target))
+        if zinfo.compress_type != ZIP_STORED or h * w == 0:
+            data = np.frombuffer(self.zi._zip.read(zinfo), dtype=np.uint8)
+            return data.reshape((h, w))
+        if self._data is None:
+            # dropped when the bin is closed (see release), and
+            # unmapped when no image refers to it
+            self._data = np.memmap(self.b.zip_path, dtype=np.uint8, mode='r')
+        # entry data follows the local file header, whose name and
+        # extra fields can differ in length from the central directory's
+        start = zinfo.header_offset
+        header = _FH_STRUCT.unpack(self._data[start:start + _FH_SIZE].tobytes())
+        offset = start + _FH_SIZE + header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH]
+        return image_view(self._data, offset, h, w)
+    def release(self):
+        # drop the mapping of the zip file. images already returned
+        # are views of it, and keep it (and the file) open until
+        # they are garbage collected; copy them to avoid that
+        self._data = None
     def __getitem__(self, target):
+        if self.b.image_format == RAW_FORMAT:
+            return self._raw_image(target)
         return self.zi[self.arcname(target)]
     def keys(self):
         return self.index
@@ -70,6 +174,15 @@ class _ZipBinImages(BaseDictlike):
         return k in self.index
     
 class ZipBin(BaseBin):
+    """
+    Bin interface to a zip file written by ``bin2zip``.
+
+    Images in raw archives are read-only views of a memory mapping
+    of the zip file. Closing the bin drops its reference to the
+    mapping, but images already returned keep it, and the file,
+    open until they are garbage collected; copy them if the file
+    needs to be deleted or replaced while they are in use.
+    """
     def __init__(self, zip_path):
         self.zip_path = zip_path
         self._zip = None
@@ -87,6 +200,7 @@ class ZipBin(BaseBin):
             raise ValueError('zip file not open')
         self._zip.close()
         self._zip = None
+        self.images.release()
     def __enter__(self):
         return self
     def __exit__(self, *args):
@@ -96,19 +210,19 @@ class ZipBin(BaseBin):
         j = self._zip.read(METADATA_ARCNAME)
         md = json.loads(j.decode('utf8'))
         self._pid = Pid(md['lid'])
+        self.image_format = md.get('images', PNG_FORMAT)
+        self._shapes = { int(k): tuple(v) for k, v in md.get('shapes', {}).items() }
     @property
     def pid(self):
         return self._pid
-    @property
-    @lru_cache()
+    @cached_property
     def adc(self):
         arcname = self.lid + ADC_ARCNAME_SUFFIX
         fin = self._zip.open(arcname)
         adc = pd.read_csv(fin, header=None, index_col=0)
         adc.columns = [c-1 for c in adc.columns]
         return adc
-    @property
-    @lru_cache()
+    @cached_property
     def headers(self):
         arcname = self.lid + HEADERS_ARCNAME_SUFFIX
         j = self._zip.read(arcname)
@@ -1,11 +1,17 @@
 import unittest
 import shutil
 import os
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
 
 from ifcb.tests.utils import test_dir
 from .fileset_info import list_test_filesets, TEST_FILES
 
-from ifcb.data.adc import AdcFile
+from ifcb.data.adc import AdcFile, AdcFragment, parse_adc_file, SCHEMA_VERSION_1, SCHEMA_VERSION_2
+from ifcb.data.adc import adc_index, adc_index_path, read_adc_index, write_adc_index
 
 def list_adcs():
     for fs in list_test_filesets():
@@ -41,3 +47,91 @@ class TestAdcFile(unittest.TestCase):
             s = adc.schema
             assert target[s.ROI_WIDTH] == w
             assert target[s.ROI_HEIGHT] == h
+    def test_schema_dtypes(self):
+        for adc in list_adcs():
+            s = adc.schema
+            df = adc.csv
+            assert list(df.columns) == list(s._cols)
+            for c in df.columns:
+                assert df[c].dtype == s._dtypes[c], 'wrong column type'
+    def test_typed_same_as_inferred(self):
+        for adc in list_adcs():
+            s = adc.schema
+            inferred = pd.read_csv(adc.path, header=None, index_col=False)
+            inferred.index += 1
+            typed = adc.csv
+            for c in s._cols:
+                assert np.array_equal(typed[c].values, inferred[c].values), 'column %d differs' % c
+    def test_column_projection(self):
+        for adc in list_adcs():
+            s = adc.schema
+            full = adc.csv
+            proj = AdcFile(adc.path, columns=s._image_cols).csv
+            assert list(proj.columns) == s._image_cols
+            assert np.all(proj.index == full.index)
+            for c in s._image_cols:
+                assert np.all(proj[c] == full[c])
+
+class TestParseAdc(unittest.TestCase):
+    def test_untyped_fallback(self):
+        # ROI_X is not an integer, so types must be inferred
+        buf = BytesIO(b'1,2.5,3,0.5,0.5,0.5,0.5,0.5,0.5,1.5,2,3,4,5,6\n')
+        df = parse_adc_file(buf, schema=SCHEMA_VERSION_1)
+        assert df[SCHEMA_VERSION_1.ROI_X][1] == 1.5
+    def test_empty_projection(self):
+        s = SCHEMA_VERSION_2
+        df = parse_adc_file(BytesIO(b''), schema=s, columns=s._image_cols)
+        assert len(df) == 0
+        assert list(df.columns) == s._image_cols
+
+def copied_adcs():
+    with test_dir() as d:
+        for fs in list_test_filesets():
+            shutil.copy(fs.adc_path, d)
+            yield AdcFile(os.path.join(d, os.path.basename(fs.adc_path)))
+
+class TestAdcIndex(unittest.TestCase):
+    def test_offsets(self):
+        for adc in copied_adcs():
+            offsets = adc_index(adc.path)
+            with open(adc.path, 'rb') as fin:
+                lines = fin.readlines()
+            assert len(offsets) == len(lines) + 1
+            assert offsets[-1] == adc.getsize()
+            with open(adc.path, 'rb') as fin:
+                for line, o in zip(lines, offsets):
+                    fin.seek(o)
+                    assert fin.readline() == line
+    def test_persistence(self):
+        for adc in copied_adcs():
+            assert read_adc_index(adc.path) is None
+            offsets = adc_index(adc.path)
+            assert os.path.exists(adc_index_path(adc.path))
+            assert np.all(read_adc_index(adc.path) == offsets)
+    def test_not_mapped(self):
+        for adc in copied_adcs():
+            adc_index(adc.path)
+            assert not isinstance(read_adc_index(adc.path), np.memmap)
+    def test_concurrent_writes(self):
+        for adc in copied_adcs():
+            with ThreadPoolExecutor(8) as pool:
+                results = list(pool.map(lambda _: write_adc_index(adc.path), range(16)))
+            offsets = read_adc_index(adc.path)
+            assert all(np.all(r == offsets) for r in results)
+            d = os.path.dirname(adc.path)
+            assert not [n for n in os.listdir(d) if n.endswith('.tmp')]
+    def test_stale(self):
+        for adc in copied_adcs():
+            adc_index(adc.path)
+            with open(adc.path, 'ab') as fout:
+                fout.write(b'\n')
+            assert read_adc_index(adc.path) is None
+            assert adc_index(adc.path)[-1] == adc.getsize()
+    def test_fragment(self):
+        for adc in copied_adcs():
+            n = len(adc)
+            for start, end in [(1, 3), (n - 1, n + 1), (n, None), (2, None), (n + 5, None)]:
+                a = AdcFragment(adc.path, start, end).csv
+                b = AdcFragment(adc.path, start, end, index=True).csv
+                assert np.all(a.index == b.index)
+                assert np.all(a == b)
@@ -1,6 +1,10 @@
 import unittest
 import os
 import shutil
+import gc
+import weakref
+
+import pandas as pd
 
 from ifcb.tests.utils import test_dir
 
@@ -44,3 +48,49 @@ class TestMemoryBin(unittest.TestCase):
                 with open_raw(p) as b:
                     c = b.read()
             assert_bin_equals(a, c)
+
+def use_bin(b):
+    # access the cached data of a bin
+    with b:
+        b.adc
+        b.images_adc
+        b.headers
+        b.ml_analyzed
+        for k in list(b.images)[:3]:
+            b.images[k]
+
+class TestBinCache(unittest.TestCase):
+    def test_cached(self):
+        for b in list_test_bins():
+            assert b.adc is b.adc
+            assert b.images_adc is b.images_adc
+            assert b.headers is b.headers
+    def test_clear_cache(self):
+        for b in list_test_bins():
+            use_bin(b)
+            adc, images_adc, index = b.adc, b.images_adc, b.roi_file.roi_index
+            b.clear_cache()
+            assert b.adc is not adc
+            assert b.images_adc is not images_adc
+            assert b.roi_file.roi_index is not index
+            assert b.adc.equals(adc)
+            assert b.images_adc.equals(images_adc)
+    def test_collectable(self):
+        # bins and their ADC data must not be kept alive by caches
+        refs = []
+        for _ in range(3):
+            for b in list_test_bins():
+                use_bin(b)
+                refs.append(weakref.ref(b))
+                refs.append(weakref.ref(b.adc))
+                refs.append(weakref.ref(b.images_adc))
+            del b
+        gc.collect()
+        assert all(ref() is None for ref in refs)
+    def test_not_shared(self):
+        b = MockBin('D20000101T000000_IFCB001')
+        c = MockBin('D20000101T000000_IFCB001')
+        b.adc = pd.DataFrame({SCHEMA[2].ROI_WIDTH: [0, 1]})
+        c.adc = pd.DataFrame({SCHEMA[2].ROI_WIDTH: [1, 1]})
+        assert len(b.images_adc) == 1
+        assert len(c.images_adc) == 2
@@ -1,10 +1,19 @@
 import unittest
 import os
 import sys
+import gc
+import weakref
+import shutil
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
 import numpy as np
 
 from ifcb.data import files
+from ifcb.data.adc import adc_index_path
+from ifcb.data.identifiers import Pid
+from ifcb.tests.utils import test_dir
 from .fileset_info import TEST_FILES, data_dir, WHITELIST, list_test_filesets, list_test_bins
 
 class TestListUtils(unittest.TestCase):
@@ -27,6 +36,73 @@ class TestListUtils(unittest.TestCase):
         """test with validation off and search"""
         paths = list(files.list_filesets(self.data_dir, whitelist=WHITELIST, validate=False))
         assert len(paths) == 5
+    def test_list_filesets_workers(self):
+        serial = list(files.list_filesets(self.data_dir, whitelist=WHITELIST, workers=1))
+        parallel = list(files.list_filesets(self.data_dir, whitelist=WHITELIST, workers=8))
+        assert serial == parallel
+        assert len(serial) == 2
+    def test_walk_filesets(self):
+        # compare with os.walk on a synthetic tree
+        with test_dir() as d:
+            for i, sub in enumerate(['a', 'a/b', 'a/b/c', 'a-c', 'skip', 'skip/x', 'z']):
+                p = os.path.join(d, *sub.split('/'))
+                os.makedirs(p, exist_ok=True)
+                for j in range(3):
+                    for ext in ['adc', 'hdr', 'roi']:
+                        open(os.path.join(p, 'f%d_%d.%s' % (i, j, ext)), 'w').close()
+                open(os.path.join(p, 'incomplete%d.adc' % i), 'w').close()
+            expected = []
+            for dp, dirnames, filenames in os.walk(d):
+                dirnames[:] = sorted(n for n in dirnames if n != 'skip')
+                adcs = sorted(f[:-4] for f in filenames if f.endswith('.adc'))
+                expected.append((dp, [b for b in adcs if b + '.hdr' in filenames and b + '.roi' in filenames]))
+            for workers in [1, 4]:
+                assert list(files.walk_filesets(d, blacklist=['skip'], workers=workers)) == expected
+    def test_walk_filesets_read_ahead(self):
+        with test_dir() as d:
+            for i in range(40):
+                os.makedirs(os.path.join(d, 'd%02d' % i, 'sub'))
+            scanned = []
+            scan_dir = files._scan_dir
+            def counting_scan_dir(dirpath, *args):
+                scanned.append(dirpath)
+                return scan_dir(dirpath, *args)
+            with patch.object(files, '_scan_dir', counting_scan_dir):
+                consumed = 0
+                for dp, basenames in files.walk_filesets(d, workers=2):
+                    consumed += 1
+                    assert len(scanned) - consumed <= 4
+            assert consumed == 81
+            assert sorted(scanned) == sorted(set(scanned))
+    def test_scan_dir_entry_error(self):
+        # an error on one entry must not drop the rest of the directory
+        with test_dir() as d:
+            for name in ['a', 'bad', 'c']:
+                os.makedirs(os.path.join(d, name))
+            for ext in ['adc', 'hdr', 'roi']:
+                open(os.path.join(d, 'x.' + ext), 'w').close()
+            class BadEntry(object):
+                def __init__(self, entry):
+                    self.name = entry.name
+                def is_dir(self):
+                    raise OSError('bad entry')
+            scandir = os.scandir
+            class Scandir(object):
+                def __init__(self, path):
+                    self._it = scandir(path)
+                def __enter__(self):
+                    return self
+                def __exit__(self, *exc):
+                    self._it.close()
+                def __iter__(self):
+                    return self
+                def __next__(self):
+                    entry = next(self._it)
+                    return BadEntry(entry) if entry.name == 'bad' else entry
+            with patch.object(files.os, 'scandir', Scandir):
+                basenames, subdirs = files._scan_dir(d, [], True)
+            assert basenames == ['x']
+            assert subdirs == ['a', 'c']
 
 class TestDataDirectory(unittest.TestCase):
     def setUp(self):
@@ -157,3 +233,167 @@ class TestFilesetFragmentBin(TestFilesetBin):
         # pass this test, which would fail because superclass
         # test expects the image index to be complete
         pass
+    def test_indexed(self):
+        for b in list_test_bins():
+            d = TEST_FILES[b.lid]
+            roi_number = d['roi_number']
+            with test_dir() as td:
+                for path in [b.fileset.adc_path, b.fileset.hdr_path, b.fileset.roi_path]:
+                    shutil.copy(path, td)
+                fs = files.Fileset(os.path.join(td, b.lid))
+                s = files.FilesetBin(fs).as_single(roi_number, index=True)
+                assert list(s.images) == list(b.as_single(roi_number).images)
+                assert s.images[roi_number].shape == d['roi_shape']
+                assert os.path.exists(adc_index_path(fs.adc_path))
+
+class TestDataDirectoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = data_dir()
+    def test_same_as_walk(self):
+        with test_dir() as d:
+            for wl in [files.DEFAULT_WHITELIST, WHITELIST, ['empty']]:
+                walked = files.DataDirectory(self.data_dir, whitelist=wl)
+                indexed = files.DataDirectory(self.data_dir, whitelist=wl, index=os.path.join(d, 'index.db'))
+                assert [str(fs) for fs in walked.list_filesets()] == [str(fs) for fs in indexed.list_filesets()]
+                assert len(walked) == len(indexed)
+                for fs in walked.list_filesets():
+                    assert indexed.has_key(fs.lid)
+                    assert indexed[fs.lid].lid == fs.lid
+                assert not indexed.has_key('D20000101T000000_IFCB000')
+    def test_record(self):
+        with test_dir() as d:
+            dd = files.DataDirectory(self.data_dir, whitelist=WHITELIST, index=os.path.join(d, 'index.db'))
+            for fs in list_test_filesets():
+                r = dd.index.get_record(fs.lid)
+                assert r['instrument'] == fs.pid.instrument
+                assert r['schema_version'] == fs.pid.schema_version
+                assert r['timestamp'] == fs.pid.timestamp.isoformat()
+                sizes = fs.getsizes()
+                for ext in ['adc', 'hdr', 'roi']:
+                    assert r[ext + '_size'] == sizes[ext]
+    def test_refresh(self):
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            shutil.copytree(self.data_dir, root)
+            db = os.path.join(d, 'index.db')
+            dd = files.DataDirectory(root, whitelist=WHITELIST, index=db)
+            assert len(dd) == 2
+            assert dd.index.refresh() == 0, 'unchanged directories should not be rescanned'
+            # add a fileset in a new directory
+            fs = list_test_filesets()[0]
+            new_dir = os.path.join(root, 'data', 'D2020')
+            os.mkdir(new_dir)
+            new_lid = 'D20200101T000000_IFCB999'
+            for ext in ['adc', 'hdr', 'roi']:
+                shutil.copy(fs.basepath + '.' + ext, os.path.join(new_dir, new_lid + '.' + ext))
+            assert not dd.has_key(new_lid)
+            dd.refresh()
+            assert dd.has_key(new_lid)
+            assert len(dd) == 3
+            # reopening the index does not rebuild it
+            assert files.DataDirectory(root, whitelist=WHITELIST, index=db).index.refresh() == 0
+            # remove the directory
+            shutil.rmtree(new_dir)
+            dd.refresh()
+            assert not dd.has_key(new_lid)
+            assert len(dd) == 2
+    def test_threads(self):
+        with test_dir() as d:
+            dd = files.DataDirectory(self.data_dir, whitelist=WHITELIST, index=os.path.join(d, 'index.db'))
+            lids = [fs.lid for fs in list_test_filesets()]
+            with ThreadPoolExecutor(2) as executor:
+                found = list(executor.map(lambda lid: dd.has_key(lid), lids))
+                listed = executor.submit(lambda: [fs.lid for fs in dd.list_filesets()]).result()
+                executor.submit(dd.refresh).result()
+            assert all(found)
+            assert sorted(listed) == sorted(lids)
+    def test_duplicate_lids(self):
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            shutil.copytree(self.data_dir, root)
+            fs = list_test_filesets()[0]
+            dup_dir = os.path.join(root, 'data', 'white')
+            os.mkdir(dup_dir)
+            for ext in ['adc', 'hdr', 'roi']:
+                shutil.copy(fs.basepath + '.' + ext, dup_dir)
+            walked = files.DataDirectory(root, whitelist=WHITELIST)
+            indexed = files.DataDirectory(root, whitelist=WHITELIST, index=os.path.join(d, 'index.db'))
+            assert len(indexed) == len(walked) == 3
+            assert [str(f) for f in walked.list_filesets()] == [str(f) for f in indexed.list_filesets()]
+            assert indexed.find_fileset(fs.lid) is not None
+    def test_check_files(self):
+        with test_dir() as d:
+            root = os.path.join(d, 'data')
+            shutil.copytree(self.data_dir, root)
+            dd = files.DataDirectory(root, whitelist=WHITELIST, index=os.path.join(d, 'index.db'))
+            fs = [f for f in dd.list_filesets()][0]
+            dir_mtime = os.stat(os.path.dirname(fs.basepath)).st_mtime_ns
+            # rewrite a file in place
+            with open(fs.adc_path, 'a') as fout:
+                fout.write('\n')
+            os.utime(os.path.dirname(fs.basepath), ns=(dir_mtime, dir_mtime))
+            assert dd.index.refresh() == 0
+            assert dd.index.refresh(check_files=True) == 1
+            assert dd.index.get_record(fs.lid)['adc_size'] == os.path.getsize(fs.adc_path)
+            assert dd.index.refresh(check_files=True) == 0
+    def test_old_schema(self):
+        with test_dir() as d:
+            db = os.path.join(d, 'index.db')
+            conn = sqlite3.connect(db)
+            conn.executescript("""
+                create table meta (key text primary key, value text);
+                create table dirs (dir text primary key, mtime integer);
+                create table filesets (lid text primary key, dir text, sortkey text, timestamp text,
+                    instrument integer, schema_version integer, adc_size integer, hdr_size integer,
+                    roi_size integer, adc_mtime integer, hdr_mtime integer, roi_mtime integer);
+            """)
+            conn.close()
+            dd = files.DataDirectory(self.data_dir, whitelist=WHITELIST, index=db)
+            assert len(dd) == 2
+    def test_filter(self):
+        with test_dir() as d:
+            dd = files.DataDirectory(self.data_dir, whitelist=WHITELIST, index=os.path.join(d, 'index.db'),
+                                     filter=files.time_filter(end='2013-01-01'))
+            assert len(dd) == 1
+            assert [b.lid for b in dd] == ['IFCB5_2012_028_081515']
+
+LAYOUTS = ['data/{year}/{day_prefix}', 'white/D{year}/D{year}{month}/{day_prefix}']
+
+class TestLayouts(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = data_dir()
+    def test_layout_dir(self):
+        v1 = Pid('IFCB5_2012_028_081515')
+        v2 = Pid('D20130526T095207_IFCB013')
+        assert files.layout_dir('{year}/{day_prefix}', v1) == os.path.join('2012', 'IFCB5_2012_028')
+        assert files.layout_dir('D{year}/D{year}{month}', v2) == os.path.join('D2013', 'D201305')
+        assert files.layout_dir('D{year}{month}', v1) is None
+        assert files.layout_dir('', v1) == ''
+    def test_find_by_layout(self):
+        for fs in list_test_filesets():
+            found = files.find_fileset_by_layout(self.data_dir, fs.lid, LAYOUTS, whitelist=WHITELIST)
+            assert found is not None
+            assert os.path.samefile(found.adc_path, fs.adc_path)
+            assert files.find_fileset_by_layout(self.data_dir, fs.lid, ['{day_prefix}'], whitelist=WHITELIST) is None
+    def test_no_search(self):
+        dd = files.DataDirectory(self.data_dir, whitelist=WHITELIST, layouts=LAYOUTS)
+        with patch('os.listdir', side_effect=AssertionError('directory was listed')):
+            for lid in TEST_FILES:
+                assert dd[lid].lid == lid
+    def test_fallback(self):
+        dd = files.DataDirectory(self.data_dir, whitelist=WHITELIST, layouts=['{day_prefix}'])
+        for lid in TEST_FILES:
+            assert dd[lid].lid == lid
+        assert not dd.has_key('D20000101T000000_IFCB000')
+        assert not dd.has_key('not_a_pid')
+
+class TestFilesetPid(unittest.TestCase):
+    def test_collectable(self):
+        # caching a fileset's pid must not keep the fileset alive
+        fs = files.Fileset(list_test_filesets()[0].basepath)
+        assert fs.pid is fs.pid
+        assert fs.lid in TEST_FILES
+        ref = weakref.ref(fs)
+        del fs
+        gc.collect()
+        assert ref() is None
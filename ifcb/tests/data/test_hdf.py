@@ -1,5 +1,6 @@
 import os
 import unittest
+from unittest.mock import patch
 
 import numpy as np
 import h5py as h5
@@ -12,6 +13,7 @@ from ifcb.data.adc import AdcFile
 from ifcb.data.roi import RoiFile
 from ifcb.data.hdr import parse_hdr_file
 from ifcb.data.hdf import roi2hdf, hdr2hdf, adc2hdf, fileset2hdf, hdf2fileset, HdfBin, filesetbin2hdf, bin2hdf
+from ifcb.data.hdf import HdfRoi, images2hdf, images2hdf_ragged, INDEX_ATTR_MAX_SIZE
 from ifcb.data.files import FilesetBin
 
 from .fileset_info import list_test_filesets, list_test_bins
@@ -128,3 +130,84 @@ class TestHdfBin(unittest.TestCase):
         for out_bin in list_test_bins():
             with HdfBin(path, out_bin.lid) as in_bin:
                 assert_bin_equals(in_bin, out_bin)
+
+class TestRaggedLayout(unittest.TestCase):
+    @withfile
+    def test_roi_roundtrip(self, path):
+        for fs in list_test_filesets():
+            with RoiFile(fs.adc_path, fs.roi_path) as roi:
+                roi2hdf(roi, path, layout='ragged')
+                with hdfopen(path) as h:
+                    assert h.attrs['layout'] == 'ragged'
+                    assert 'images' not in h
+                    assert list(h['targets']) == list(roi.keys())
+                    hroi = HdfRoi(h)
+                    assert hroi.layout == 'ragged'
+                    assert len(hroi) == len(roi)
+                    assert list(hroi.keys()) == list(roi.keys())
+                    for k in roi:
+                        assert k in hroi
+                        assert np.all(hroi[k] == roi[k])
+                    for k, image in hroi.items():
+                        assert np.all(image == roi[k])
+                    assert 0 not in hroi
+                    with self.assertRaises(KeyError):
+                        hroi[0]
+    @withfile
+    def test_bin_roundtrip(self, path):
+        for compression in [None, 'gzip']:
+            for fs in list_test_filesets():
+                with FilesetBin(fs) as out_bin:
+                    out_bin.to_hdf(path, layout='ragged', compression=compression)
+                    with HdfBin(path) as in_bin:
+                        assert in_bin.images.layout == 'ragged'
+                        assert_bin_equals(in_bin, out_bin)
+    @withfile
+    def test_items_blocks(self, path):
+        # items reads multiple blocks when the pixels span several chunks
+        for out_bin in list_test_bins():
+            with out_bin:
+                with hdfopen(path, replace=True) as h:
+                    images2hdf_ragged(out_bin.images.items(), h, chunk_size=1024)
+                with patch('ifcb.data.hdf.DEFAULT_MAX_READ', 1024):
+                    with hdfopen(path) as h:
+                        items = list(HdfRoi(h).items())
+                assert [k for k, _ in items] == list(out_bin.images.keys())
+                for k, image in items:
+                    assert np.all(image == out_bin.images[k])
+    @withfile
+    def test_refs_default(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                out_bin.to_hdf(path)
+                with HdfBin(path) as in_bin:
+                    assert in_bin.images.layout == 'refs'
+    @withfile
+    def test_refs_large(self, path):
+        # too many images for the index to fit in an attribute
+        n = 2 * INDEX_ATTR_MAX_SIZE
+        images = { i: np.full((2, 3), i % 256, dtype=np.uint8) for i in range(1, n + 1) }
+        roi2hdf(images, path)
+        with hdfopen(path) as h:
+            assert 'index' not in h.attrs
+            hroi = HdfRoi(h)
+            assert len(hroi) == n
+            assert list(hroi.keys()) == list(images)
+            assert np.all(hroi[n] == images[n])
+    @withfile
+    def test_refs_index_attribute(self, path):
+        # files whose index is only an attribute can still be read
+        images = { 3: np.zeros((2, 2), dtype=np.uint8), 5: np.ones((3, 1), dtype=np.uint8) }
+        with hdfopen(path, replace=True) as h:
+            images2hdf(images.items(), h)
+            del h['index']
+        with hdfopen(path) as h:
+            hroi = HdfRoi(h)
+            assert list(hroi.keys()) == [3, 5]
+            assert 5 in hroi and 4 not in hroi
+            assert np.all(hroi[5] == images[5])
+    @withfile
+    def test_unknown_layout(self, path):
+        for out_bin in list_test_bins():
+            with self.assertRaises(ValueError):
+                out_bin.to_hdf(path, layout='tiled')
@@ -0,0 +1,119 @@
+import os
+import unittest
+from unittest.mock import patch
+
+import h5py as h5
+
+from ifcb.tests.utils import withfile, test_dir
+
+from ifcb.data.hdfarchive import HdfArchive, archive_path, archive_bins
+from ifcb.data.identifiers import Pid
+
+from .fileset_info import list_test_bins, TEST_FILES
+from .bins import assert_bin_equals
+
+class TestHdfArchive(unittest.TestCase):
+    @withfile
+    def test_roundtrip(self, path):
+        with HdfArchive(path) as archive:
+            for b in list_test_bins():
+                with b:
+                    archive.add(b)
+            assert len(archive) == len(TEST_FILES)
+        with HdfArchive(path, 'r') as archive:
+            assert set(archive.keys()) == set(TEST_FILES)
+            for b in list_test_bins():
+                assert b.lid in archive
+                with b, archive[b.lid] as in_bin:
+                    assert_bin_equals(in_bin, b)
+            assert 'D20000101T000000_IFCB000' not in archive
+            with self.assertRaises(KeyError):
+                archive['D20000101T000000_IFCB000']
+    @withfile
+    def test_append(self, path):
+        bins = list_test_bins()
+        for b in bins:
+            with HdfArchive(path) as archive, b:
+                archive.add(b)
+        with HdfArchive(path, 'r') as archive:
+            assert list(archive.keys()) == [b.lid for b in bins]
+            assert [b.lid for b in archive] == [b.lid for b in bins]
+    @withfile
+    def test_index(self, path):
+        with HdfArchive(path) as archive:
+            for b in list_test_bins():
+                with b:
+                    archive.add(b)
+            df = archive.index
+            for b in list_test_bins():
+                rec = archive.get_record(b.lid)
+                assert rec['timestamp'] == b.timestamp
+                assert rec['n_targets'] == TEST_FILES[b.lid]['n_targets']
+                assert rec['n_rois'] == TEST_FILES[b.lid]['n_rois']
+                assert rec['group'] == 'bins/' + b.lid
+                assert df.loc[b.lid, 'timestamp'] == b.timestamp
+                assert df.loc[b.lid, 'n_rois'] == rec['n_rois']
+            assert archive.get_record('D20000101T000000_IFCB000') is None
+    @withfile
+    def test_replace(self, path):
+        with HdfArchive(path) as archive:
+            for b in list_test_bins():
+                with b:
+                    archive.add(b)
+                    with self.assertRaises(ValueError):
+                        archive.add(b)
+                    archive.add(b, replace=True, layout='refs')
+                    with archive[b.lid] as in_bin:
+                        assert in_bin.images.layout == 'refs'
+                        assert_bin_equals(in_bin, b)
+            assert len(archive) == len(TEST_FILES)
+            assert len(archive.index) == len(TEST_FILES)
+    @withfile
+    def test_failed_replace(self, path):
+        def failing(items):
+            for i, item in enumerate(items):
+                if i == 2:
+                    raise IOError('disk full')
+                yield item
+        with HdfArchive(path) as archive:
+            for b in list_test_bins():
+                with b:
+                    archive.add(b)
+                    record = archive.get_record(b.lid)
+                    with self.assertRaises(IOError):
+                        archive.add(b, replace=True, images=failing(b.images.items()))
+                    # the original bin is intact and nothing is left behind
+                    assert archive.get_record(b.lid) == record
+                    with archive[b.lid] as in_bin:
+                        assert_bin_equals(in_bin, b)
+            assert sorted(archive._file['bins'].keys()) == sorted(archive.keys())
+    @withfile
+    def test_not_archive(self, path):
+        with h5.File(path, 'w') as h:
+            h.create_group('foo')
+        opened, h5_file = [], h5.File
+        def File(*args):
+            opened.append(h5_file(*args))
+            return opened[-1]
+        with patch('ifcb.data.hdfarchive.h5.File', File):
+            with self.assertRaises(ValueError):
+                HdfArchive(path, 'r')
+        # closed, not just left for garbage collection
+        assert not opened[0].id.valid
+
+class TestArchivePath(unittest.TestCase):
+    def test_archive_path(self):
+        for lid, day, month in [
+                ('D20130526T095207_IFCB013', 'D20130526.h5', 'D201305.h5'),
+                ('IFCB5_2012_028_081515', 'D20120128.h5', 'D201201.h5')]:
+            assert archive_path('arch', lid) == os.path.join('arch', day)
+            assert archive_path('arch', Pid(lid), 'month') == os.path.join('arch', month)
+        with self.assertRaises(ValueError):
+            archive_path('arch', lid, 'year')
+    def test_archive_bins(self):
+        with test_dir() as d:
+            n = archive_bins(list_test_bins(), d, period='month')
+            assert n == len(TEST_FILES)
+            for b in list_test_bins():
+                with HdfArchive(archive_path(d, b.pid, 'month'), 'r') as archive:
+                    assert list(archive.keys()) == [b.lid]
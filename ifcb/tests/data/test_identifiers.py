@@ -1,6 +1,9 @@
 import unittest
 import random
 
+import numpy as np
+import pandas as pd
+
 from ifcb.data import identifiers as ids
 from ifcb.data.identifiers import Pid
 
@@ -206,3 +209,142 @@ class TestV2Identifiers(unittest.TestCase):
         assert Pid(GOOD_V2).instrument == 1
     def test_day_prefix(self):
         assert Pid(GOOD_V2).day_prefix == 'D20000101'
+
+class TestParseMany(unittest.TestCase):
+    def pids(self):
+        prefixes = ['', '/foo/bar/', 'http://mysite.org/data/', 'C:\\foo\\bar\\']
+        suffixes = ['', '_00027', '_blob', '.png', '_00927_baz.quux', '_features_v2.csv']
+        for spid in GOOD + ['IFCB5_2012_028_081515', 'D20130526T095207_IFCB013']:
+            for prefix in prefixes:
+                for suffix in suffixes:
+                    yield prefix + spid + suffix
+    def bad_pids(self):
+        for pid in GOOD:
+            d = DestroyPid(pid)
+            for p in d.insert_character():
+                yield p
+            for p in d.delete_character():
+                yield p
+    def assert_same(self, pid, row):
+        expected = Pid(pid)
+        for field in ['namespace', 'lid', 'bin_lid', 'instrument', 'schema_version', 'product', 'extension']:
+            assert row[field] == getattr(expected, field), field
+        if expected.target is None:
+            assert row['target'] is pd.NA
+        else:
+            assert row['target'] == expected.target
+        assert row['timestamp'] == expected.timestamp
+    def test_same_as_parse(self):
+        pids = list(self.pids())
+        df = ids.parse_many(pids)
+        assert len(df) == len(pids)
+        for pid, (_, row) in zip(pids, df.iterrows()):
+            self.assert_same(pid, row)
+    def test_dtypes(self):
+        df = ids.parse_many(list(self.pids()))
+        assert df.instrument.dtype == np.int64
+        assert df.schema_version.dtype == np.int64
+        assert str(df.target.dtype) == 'Int64'
+        assert str(df.timestamp.dtype) == 'datetime64[ns, UTC]'
+    def test_invalid(self):
+        for p in self.bad_pids():
+            with self.assertRaises(ValueError):
+                ids.parse_many([GOOD_V1, p])
+    def test_coerce(self):
+        bad = list(self.bad_pids())
+        df = ids.parse_many(GOOD + bad, errors='coerce')
+        assert len(df) == len(GOOD) + len(bad)
+        for pid, (_, row) in zip(GOOD, df.iloc[:len(GOOD)].iterrows()):
+            self.assert_same(pid, row)
+        invalid = df.iloc[len(GOOD):]
+        assert invalid.bin_lid.isna().all()
+        assert invalid.timestamp.isna().all()
+        assert list(invalid.pid) == bad
+    def test_empty(self):
+        df = ids.parse_many([])
+        assert len(df) == 0
+        assert list(df.columns) == ids.PARSE_MANY_COLUMNS
+
+class TestPidCache(unittest.TestCase):
+    def test_hits(self):
+        cache = ids.PidCache(maxsize=10)
+        for _ in range(3):
+            for pid in GOOD:
+                cache.parse(pid)
+        info = cache.info()
+        assert info.misses == len(GOOD)
+        assert info.hits == 2 * len(GOOD)
+        assert info.currsize == len(GOOD)
+    def test_same_as_parse(self):
+        cache = ids.PidCache()
+        for pid in GOOD:
+            for _ in range(2):
+                parsed = cache.parse(pid + '_00012_blob.png')
+                assert parsed == Pid(pid + '_00012_blob.png').parsed
+                assert parsed['target'] == 12
+    def test_namespace_and_extension(self):
+        # pids differing only in namespace and extension share an entry
+        cache, uncached = ids.PidCache(), ids.PidCache(maxsize=0)
+        variants = ['', '.png', '.adc', '.hdr']
+        namespaces = ['', 'http://foo.bar/ts/', '/data/', 'c:\\data\\']
+        for pid in GOOD:
+            for ns in namespaces:
+                for v in variants:
+                    s = ns + pid + '_00012' + v
+                    assert cache.parse(s) == uncached.parse(s)
+        assert len(cache) == len(GOOD)
+    def test_not_normalized(self):
+        # pids with parts that parsing ignores are parsed as themselves
+        cache, uncached = ids.PidCache(), ids.PidCache(maxsize=0)
+        for pid in GOOD:
+            for s in [pid + '.png', pid + '.png.adc', pid + '_blob-x.png', pid + '_blob-x.adc',
+                      pid + '_00001_blob.png', pid + '_00001_blob', pid + '_00001_raw.jpg',
+                      pid + '_00001.roi', pid + '.x.roi']:
+                for _ in range(2):
+                    assert cache.parse(s) == uncached.parse(s), s
+    def test_bounded(self):
+        cache = ids.PidCache(maxsize=5)
+        for i in range(100):
+            cache.parse('%s_%05d' % (GOOD_V2, i))
+            assert len(cache) <= 5
+        # most recently used entries are retained
+        cache.parse('%s_%05d' % (GOOD_V2, 99))
+        assert cache.info().hits == 1
+        cache.resize(2)
+        assert len(cache) == 2
+        cache.clear()
+        assert cache.info() == ids.CacheInfo(0, 0, 2, 0)
+    def test_disabled(self):
+        cache = ids.PidCache(maxsize=0)
+        cache.parse(GOOD_V1)
+        cache.parse(GOOD_V1)
+        assert len(cache) == 0
+        assert cache.info().misses == 2
+    def test_copies(self):
+        # modifying a Pid must not modify the cached entry
+        cache = ids.PidCache()
+        parsed = cache.parse(GOOD_V1)
+        parsed['target'] = 7
+        assert cache.parse(GOOD_V1)['target'] is None
+        pid = Pid(GOOD_V2)
+        pid.target = 3
+        assert Pid(GOOD_V2).target is None
+    def test_invalid(self):
+        cache = ids.PidCache()
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                cache.parse('not_a_pid')
+        assert len(cache) == 0
+    def test_module_cache(self):
+        ids.clear_pid_cache()
+        for _ in range(2):
+            Pid(GOOD_V1).parsed
+        info = ids.pid_cache_info()
+        assert (info.hits, info.misses) == (1, 1)
+        size = info.maxsize
+        try:
+            ids.set_pid_cache_size(1)
+            Pid(GOOD_V2).parsed
+            assert ids.pid_cache_info().currsize == 1
+        finally:
+            ids.set_pid_cache_size(size)
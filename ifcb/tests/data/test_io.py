@@ -1,8 +1,13 @@
 import unittest
 
-from ifcb.data.io import open_raw, open_hdf, open_zip, open_mat
+import os
 
-from ifcb.tests.utils import withfile
+import numpy as np
+from scipy.io import loadmat
+
+from ifcb.data.io import open_raw, open_hdf, open_zip, open_mat, convert
+
+from ifcb.tests.utils import withfile, test_dir
 
 from .fileset_info import list_test_bins
 from .bins import assert_bin_equals
@@ -30,6 +35,42 @@ class TestFormatConversionAPI(unittest.TestCase):
                 with open_mat(path) as in_bin:
                     assert_bin_equals(in_bin, out_bin)
 
+class TestConvert(unittest.TestCase):
+    def test_hdf(self):
+        with test_dir() as d:
+            for out_bin in list_test_bins():
+                path = os.path.join(d, out_bin.lid + '.hdf')
+                convert(out_bin, path, buffer_size=4096)
+                with open_hdf(path) as in_bin:
+                    assert_bin_equals(in_bin, out_bin)
+    def test_zip(self):
+        with test_dir() as d:
+            for out_bin in list_test_bins():
+                path = os.path.join(d, out_bin.lid + '.zip')
+                convert(out_bin, path, buffer_size=4096)
+                with open_zip(path) as in_bin:
+                    assert_bin_equals(in_bin, out_bin)
+    def test_mat(self):
+        with test_dir() as d:
+            for out_bin in list_test_bins():
+                path = os.path.join(d, out_bin.lid + '.mat')
+                convert(out_bin, path, buffer_size=4096)
+                mat = loadmat(path, squeeze_me=True)
+                assert mat['pid'] == out_bin.lid
+                assert list(mat['roi_numbers']) == list(out_bin.images.keys())
+                for k, image in zip(mat['roi_numbers'], mat['images']):
+                    assert np.all(image == out_bin.images[k])
+    @withfile
+    def test_format(self, path):
+        for out_bin in list_test_bins():
+            convert(out_bin, path, format='zip')
+            with open_zip(path) as in_bin:
+                assert_bin_equals(in_bin, out_bin)
+            with self.assertRaises(ValueError):
+                convert(out_bin, path)
+            with self.assertRaises(ValueError):
+                convert(out_bin, path, format='tiff')
+
 class TestOpenIdioms(unittest.TestCase):
     def test_open_raw(self):
         for a in list_test_bins():
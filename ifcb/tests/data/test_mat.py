@@ -1,6 +1,13 @@
 import unittest
+from unittest.mock import patch
 
-from ifcb.data.matlab import bin2mat, MatBin
+import numpy as np
+import h5py as h5
+from scipy.io import loadmat, savemat
+
+from ifcb.data.matlab import bin2mat, MatBin, _MatBinImages, _write_cells, _append_variables
+from ifcb.data.mat73 import Mat73Writer, read_value, is_mat73
+from ifcb.data.io import convert
 
 from ifcb.tests.utils import withfile
 
@@ -15,3 +22,144 @@ class TestMatBin(unittest.TestCase):
                 bin2mat(out_bin, path)
                 with MatBin(path) as in_bin:
                     assert_bin_equals(in_bin, out_bin)
+    @withfile
+    def test_eager(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2mat(out_bin, path)
+                with MatBin(path, lazy=False) as in_bin:
+                    assert_bin_equals(in_bin, out_bin)
+    @withfile
+    def test_lazy(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2mat(out_bin, path)
+                with patch('ifcb.data.matlab.loadmat', wraps=loadmat) as lm:
+                    in_bin = MatBin(path)
+                    assert in_bin.lid == out_bin.lid
+                    assert len(in_bin.adc) == len(out_bin.adc)
+                    assert set(in_bin.images) == set(out_bin.images)
+                    assert lm.call_count == 1
+                    assert 'images' not in lm.call_args[1]['variable_names']
+                    for k in out_bin.images:
+                        assert np.all(in_bin.images[k] == out_bin.images[k])
+                    assert lm.call_count == 2
+                with self.assertRaises(KeyError):
+                    in_bin.images[0]
+    @withfile
+    def test_single_image(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                b = out_bin.read()
+            target = list(b.images)[0]
+            b.images = { target: b.images[target] }
+            bin2mat(b, path)
+            in_bin = MatBin(path)
+            assert list(in_bin.images) == [target]
+            assert np.all(in_bin.images[target] == b.images[target])
+    @withfile
+    def test_write_cells(self, path):
+        arrays = [np.arange(6, dtype=np.uint8).reshape((2, 3)), np.ones((3, 5), dtype=np.float32),
+            np.array([[-1, 2]], dtype=np.int16)]
+        with open(path, 'wb') as fout:
+            savemat(fout, { 'x': 1 })
+            keys = _write_cells(fout, 'c', enumerate(arrays), len(arrays))
+            _append_variables(fout, { 'y': 'after' })
+        assert keys == [0, 1, 2]
+        mat = loadmat(path, squeeze_me=True)
+        assert mat['x'] == 1 and mat['y'] == 'after'
+        for a, b in zip(mat['c'], arrays):
+            assert a.dtype == b.dtype and np.all(np.atleast_2d(a) == b)
+    @withfile
+    def test_write_cells_count(self, path):
+        with open(path, 'wb') as fout:
+            with self.assertRaises(ValueError):
+                _write_cells(fout, 'c', enumerate([np.zeros((2, 2))]), 2)
+            with self.assertRaises(ValueError):
+                _write_cells(fout, 'c', enumerate([np.zeros((2, 2))] * 2), 1)
+    def test_bad_version(self):
+        for out_bin in list_test_bins():
+            with self.assertRaises(ValueError):
+                bin2mat(out_bin, 'unused.mat', version='4')
+
+class TestMat73(unittest.TestCase):
+    @withfile
+    def test_roundtrip(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2mat(out_bin, path, version='7.3')
+                assert is_mat73(path)
+                with MatBin(path) as in_bin:
+                    assert_bin_equals(in_bin, out_bin)
+                    assert in_bin.headers == out_bin.headers
+    @withfile
+    def test_eager(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2mat(out_bin, path, version='7.3')
+                with MatBin(path, lazy=False) as in_bin:
+                    assert_bin_equals(in_bin, out_bin)
+    @withfile
+    def test_header(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2mat(out_bin, path, version='7.3')
+            with open(path, 'rb') as fin:
+                header = fin.read(128)
+            assert header.startswith(b'MATLAB 7.3 MAT-file')
+            assert header[124:] == b'\x00\x02IM'
+    @withfile
+    def test_structure(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2mat(out_bin, path, version='7.3')
+                n_images = len(out_bin.images)
+                n_adc = len(out_bin.adc)
+            with h5.File(path, 'r') as f:
+                assert f['images'].attrs['MATLAB_class'] == b'cell'
+                assert f['images'].shape == (n_images, 1)
+                assert f['headers'].attrs['MATLAB_class'] == b'struct'
+                assert f['pid'].attrs['MATLAB_class'] == b'char'
+                # column-major: an n x m MATLAB array is stored m x n
+                assert f['adc'].shape[1] == n_adc
+    @withfile
+    def test_values(self, path):
+        with Mat73Writer(path) as w:
+            w.write('s', 'hello')
+            w.write('x', 3.5)
+            w.write('a', np.arange(6, dtype=np.int32).reshape((2, 3)))
+            w.write('e', np.zeros((0, 4)))
+            w.write('t', { 'b': True, 'name': 'x' })
+            w.write_cells('c', enumerate([np.ones((2, 3), dtype=np.uint8)]), 1)
+        with h5.File(path, 'r') as f:
+            assert read_value(f['s']) == 'hello'
+            assert read_value(f['x']) == 3.5
+            assert np.all(read_value(f['a']) == np.arange(6).reshape((2, 3)))
+            assert read_value(f['e']).shape == (0, 4)
+            assert read_value(f['t']) == { 'b': True, 'name': 'x' }
+            c = read_value(f['c'])
+            assert len(c) == 1
+            assert c[0].shape == (2, 3)
+    @withfile
+    def test_wrong_count(self, path):
+        with Mat73Writer(path) as w:
+            with self.assertRaises(ValueError):
+                w.write_cells('c', enumerate([1, 2]), 3)
+    @withfile
+    def test_convert(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                convert(out_bin, path, format='mat', version='7.3')
+                with MatBin(path) as in_bin:
+                    assert_bin_equals(in_bin, out_bin)
+
+class TestMatBinImages(unittest.TestCase):
+    def test_index(self):
+        class FakeBin(object):
+            _roi_numbers = np.array([5, 9, 12])
+            _images = ['a', 'b', 'c']
+        images = _MatBinImages(FakeBin())
+        assert list(images.keys()) == [5, 9, 12]
+        assert images[9] == 'b'
+        assert 9 in images and 10 not in images
+        assert len(images) == 3
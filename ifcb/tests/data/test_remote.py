@@ -0,0 +1,279 @@
+import os
+import time
+import shutil
+import unittest
+
+import requests
+
+import numpy as np
+
+from ifcb.data.files import FilesetBin
+from ifcb.data.remote import open_url, open_urls, HttpRoiFile, HttpFilesetBin, BinCache
+
+from ifcb.tests.utils import http_server, test_dir
+
+from .fileset_info import list_test_filesets, TEST_FILES
+from .bins import assert_bin_equals
+
+def _roi_requests(server):
+    return [r for r in server.requests if r[1].endswith('.roi')]
+
+class TestOpenUrl(unittest.TestCase):
+    def test_download(self):
+        for fs in list_test_filesets():
+            with http_server(os.path.dirname(fs.basepath)) as server:
+                with open_url('%s/%s' % (server.url, fs.lid)) as in_bin:
+                    assert isinstance(in_bin, FilesetBin)
+                    with FilesetBin(fs) as out_bin:
+                        assert_bin_equals(in_bin, out_bin)
+    def test_no_images(self):
+        for fs in list_test_filesets():
+            with http_server(os.path.dirname(fs.basepath)) as server:
+                with open_url('%s/%s' % (server.url, fs.lid), images=False) as in_bin:
+                    assert len(in_bin.adc) == TEST_FILES[fs.lid]['n_targets']
+                assert not _roi_requests(server)
+
+    def test_concurrent(self):
+        latency = 0.3
+        for fs in list_test_filesets():
+            with http_server(os.path.dirname(fs.basepath), latency=latency) as server:
+                with open_url('%s/%s' % (server.url, fs.lid)) as in_bin:
+                    with FilesetBin(fs) as out_bin:
+                        assert_bin_equals(in_bin, out_bin)
+                # the files are requested at once
+                assert server.max_in_flight > 1
+    def test_missing(self):
+        fs = list_test_filesets()[0]
+        with http_server(os.path.dirname(fs.basepath)) as server:
+            with self.assertRaises(requests.HTTPError):
+                with open_url('%s/%s' % (server.url, 'D20990101T000000_IFCB999')) as in_bin:
+                    pass
+
+class TestOpenUrls(unittest.TestCase):
+    def test_open_urls(self):
+        filesets = list_test_filesets()
+        with test_dir() as data_dir, http_server(data_dir) as server:
+            for fs in filesets:
+                _copy_fileset(fs, data_dir)
+            urls = ['%s/%s' % (server.url, fs.lid) for fs in filesets]
+            paths = []
+            for fs, in_bin in zip(filesets, open_urls(urls)):
+                paths.append(in_bin.fileset.basepath)
+                with FilesetBin(fs) as out_bin, in_bin:
+                    assert_bin_equals(in_bin, out_bin)
+            assert len(paths) == len(filesets)
+            # temporary files are removed
+            assert not any(os.path.exists(p + '.adc') for p in paths)
+    def test_pipelined(self):
+        latency = 0.2
+        filesets = list_test_filesets() * 3
+        with test_dir() as data_dir, http_server(data_dir, latency=latency) as server:
+            for fs in filesets:
+                _copy_fileset(fs, data_dir)
+            urls = ['%s/%s' % (server.url, fs.lid) for fs in filesets]
+            lids = [b.lid for b in open_urls(urls, images=False, workers=len(urls))]
+            assert lids == [fs.lid for fs in filesets]
+            # more than one bin's files are requested at once
+            assert server.max_in_flight > 3
+    def test_abandoned(self):
+        filesets = list_test_filesets()
+        with test_dir() as data_dir, http_server(data_dir) as server:
+            for fs in filesets:
+                _copy_fileset(fs, data_dir)
+            urls = ['%s/%s' % (server.url, fs.lid) for fs in filesets] * 2
+            bins = open_urls(urls, workers=2)
+            b = next(bins)
+            path = b.fileset.basepath
+            bins.close()
+            assert not os.path.exists(path + '.adc')
+    def test_cache(self):
+        fs = list_test_filesets()[0]
+        with test_dir() as cache_dir, http_server(os.path.dirname(fs.basepath)) as server:
+            cache = BinCache(cache_dir)
+            urls = ['%s/%s' % (server.url, fs.lid)] * 2
+            for in_bin in open_urls(urls, cache=cache, workers=1):
+                assert len(in_bin.images) == TEST_FILES[fs.lid]['n_rois']
+            assert len(server.requests) == 3
+
+class TestRanges(unittest.TestCase):
+    def test_single_image(self):
+        for fs in list_test_filesets():
+            info = TEST_FILES[fs.lid]
+            with http_server(os.path.dirname(fs.basepath)) as server:
+                with open_url('%s/%s' % (server.url, fs.lid), ranges=True) as in_bin:
+                    assert isinstance(in_bin, HttpFilesetBin)
+                    image = in_bin.images[info['roi_number']]
+                    assert image.shape == info['roi_shape']
+                    assert np.all(image[tuple(info['roi_slice_coords'])] == info['roi_slice'])
+                roi_requests = _roi_requests(server)
+                assert len(roi_requests) == 1
+                method, path, range_header = roi_requests[0]
+                assert method == 'GET' and range_header is not None
+                start, end = range_header[len('bytes='):].split('-')
+                h, w = info['roi_shape']
+                assert int(end) - int(start) + 1 == h * w
+    def test_roundtrip(self):
+        for fs in list_test_filesets():
+            with http_server(os.path.dirname(fs.basepath)) as server:
+                with open_url('%s/%s' % (server.url, fs.lid), ranges=True) as in_bin:
+                    with FilesetBin(fs) as out_bin:
+                        assert_bin_equals(in_bin, out_bin)
+                # the .roi file is never downloaded in full
+                assert all(r[2] is not None for r in _roi_requests(server))
+    def test_read_many(self):
+        for fs in list_test_filesets():
+            with http_server(os.path.dirname(fs.basepath)) as server:
+                with open_url('%s/%s' % (server.url, fs.lid), ranges=True) as in_bin:
+                    images = dict(in_bin.images.iter_images(max_gap=1024*1024))
+                    assert len(_roi_requests(server)) == 1
+                    with FilesetBin(fs) as out_bin:
+                        for k, image in out_bin.images.items():
+                            assert np.all(images[k] == image)
+    def test_getsize(self):
+        for fs in list_test_filesets():
+            with http_server(os.path.dirname(fs.basepath)) as server:
+                roi_file = HttpRoiFile(fs.adc_path, '%s/%s.roi' % (server.url, fs.lid))
+                assert roi_file.getsize() == TEST_FILES[fs.lid]['sizes']['roi']
+
+def _copy_fileset(fs, d):
+    for path in [fs.adc_path, fs.hdr_path, fs.roi_path]:
+        shutil.copy2(path, d)
+
+class TestBinCache(unittest.TestCase):
+    def test_warm(self):
+        for fs in list_test_filesets():
+            with test_dir() as cache_dir, http_server(os.path.dirname(fs.basepath)) as server:
+                cache = BinCache(cache_dir)
+                url = '%s/%s' % (server.url, fs.lid)
+                with open_url(url, cache=cache) as in_bin:
+                    with FilesetBin(fs) as out_bin:
+                        assert_bin_equals(in_bin, out_bin)
+                assert len(server.requests) == 3
+                assert url in cache
+                with open_url(url, cache=cache) as in_bin:
+                    with FilesetBin(fs) as out_bin:
+                        assert_bin_equals(in_bin, out_bin)
+                assert len(server.requests) == 3 # no network traffic
+    def test_revalidate(self):
+        fs = list_test_filesets()[0]
+        with test_dir() as cache_dir, test_dir() as data_dir, http_server(data_dir) as server:
+            _copy_fileset(fs, data_dir)
+            cache = BinCache(cache_dir, max_age=0)
+            url = '%s/%s' % (server.url, fs.lid)
+            path = cache.fetch(url, ['hdr', 'adc', 'roi'])
+            # unchanged files are revalidated but not downloaded again
+            assert cache.fetch(url, ['hdr', 'adc', 'roi']) == path
+            assert len(server.requests) == 6
+            # a changed file is downloaded again, into a new version
+            adc_path = os.path.join(data_dir, fs.lid + '.adc')
+            t = time.time() + 10
+            os.utime(adc_path, (t, t))
+            new_path = cache.fetch(url, ['hdr', 'adc', 'roi'])
+            assert new_path != path
+            with open(new_path + '.adc', 'rb') as a, open(adc_path, 'rb') as b:
+                assert a.read() == b.read()
+    def test_add_files(self):
+        fs = list_test_filesets()[0]
+        with test_dir() as cache_dir, http_server(os.path.dirname(fs.basepath)) as server:
+            cache = BinCache(cache_dir)
+            url = '%s/%s' % (server.url, fs.lid)
+            with open_url(url, images=False, cache=cache) as in_bin:
+                assert len(in_bin.adc) == TEST_FILES[fs.lid]['n_targets']
+            assert not _roi_requests(server)
+            with open_url(url, cache=cache) as in_bin:
+                assert len(in_bin.images) == TEST_FILES[fs.lid]['n_rois']
+            assert len(server.requests) == 3
+    def test_evict(self):
+        filesets = list_test_filesets()
+        with test_dir() as cache_dir, test_dir() as data_dir, http_server(data_dir) as server:
+            for fs in filesets:
+                _copy_fileset(fs, data_dir)
+            urls = ['%s/%s' % (server.url, fs.lid) for fs in filesets]
+            cache = BinCache(cache_dir, max_size=1)
+            cache.GRACE_PERIOD = 0
+            for url in urls:
+                cache.fetch(url, ['hdr', 'adc', 'roi'])
+                # the most recently used bin is always kept
+                assert url in cache
+            assert urls[0] not in cache
+            cache.max_size = 1024 * 1024 * 1024
+            cache.fetch(urls[0], ['hdr', 'adc', 'roi'])
+            assert all(url in cache for url in urls)
+            cache.max_size = cache.size() - 1
+            cache.fetch(urls[0], ['hdr', 'adc']) # makes urls[1] least recently used
+            cache.evict()
+            assert urls[0] in cache and urls[1] not in cache
+    def test_grace_period(self):
+        filesets = list_test_filesets()
+        with test_dir() as cache_dir, test_dir() as data_dir, http_server(data_dir) as server:
+            for fs in filesets:
+                _copy_fileset(fs, data_dir)
+            urls = ['%s/%s' % (server.url, fs.lid) for fs in filesets]
+            cache = BinCache(cache_dir, max_size=1)
+            for url in urls:
+                cache.fetch(url, ['hdr', 'adc', 'roi'])
+            # recently used bins are not evicted
+            assert all(url in cache for url in urls)
+    def test_lease(self):
+        filesets = list_test_filesets()
+        with test_dir() as cache_dir, test_dir() as data_dir, http_server(data_dir) as server:
+            for fs in filesets:
+                _copy_fileset(fs, data_dir)
+            urls = ['%s/%s' % (server.url, fs.lid) for fs in filesets]
+            cache = BinCache(cache_dir, max_size=1)
+            cache.GRACE_PERIOD = 0
+            with open_url(urls[0], cache=cache) as in_bin:
+                cache.fetch(urls[1], ['hdr', 'adc', 'roi'])
+                # the open bin is not evicted
+                assert urls[0] in cache
+                with FilesetBin(filesets[0]) as out_bin:
+                    assert_bin_equals(in_bin, out_bin)
+            cache.evict()
+            assert urls[0] not in cache
+    def test_fetch_lease(self):
+        fs = list_test_filesets()[0]
+        with test_dir() as cache_dir, test_dir() as data_dir, http_server(data_dir) as server:
+            _copy_fileset(fs, data_dir)
+            url = '%s/%s' % (server.url, fs.lid)
+            cache = BinCache(cache_dir)
+            for _ in range(2): # new, then cached
+                path, lease = cache.fetch(url, ['hdr', 'adc'], lease=True)
+                assert os.path.exists(lease)
+                assert os.path.dirname(lease) == os.path.dirname(path)
+                cache.release(lease)
+            # the version is removed by another process, leaving the entry
+            shutil.rmtree(os.path.dirname(path))
+            path, lease = cache.fetch(url, ['hdr', 'adc'], lease=True)
+            assert os.path.exists(path + '.adc') and os.path.exists(lease)
+    def test_open_urls_evict(self):
+        filesets = list_test_filesets()
+        with test_dir() as cache_dir, test_dir() as data_dir, http_server(data_dir) as server:
+            for fs in filesets:
+                _copy_fileset(fs, data_dir)
+            urls = ['%s/%s' % (server.url, fs.lid) for fs in filesets] * 2
+            cache = BinCache(cache_dir, max_size=1)
+            cache.GRACE_PERIOD = 0
+            n = 0
+            for fs, in_bin in zip(filesets * 2, open_urls(urls, cache=cache, workers=3)):
+                with FilesetBin(fs) as out_bin:
+                    assert_bin_equals(in_bin, out_bin)
+                n += 1
+            assert n == len(urls)
+    def test_extension(self):
+        fs = list_test_filesets()[0]
+        with test_dir() as cache_dir, http_server(os.path.dirname(fs.basepath)) as server:
+            cache = BinCache(cache_dir)
+            url = '%s/%s' % (server.url, fs.lid)
+            path = cache.fetch(url + '.adc', ['hdr', 'adc'])
+            assert url in cache and url + '.roi' in cache
+            assert cache.fetch(url, ['hdr', 'adc']) == path
+            assert len(server.requests) == 2
+            assert cache.size() == os.path.getsize(fs.hdr_path) + os.path.getsize(fs.adc_path)
+    def test_clear(self):
+        fs = list_test_filesets()[0]
+        with test_dir() as cache_dir, http_server(os.path.dirname(fs.basepath)) as server:
+            cache = BinCache(cache_dir)
+            cache.fetch('%s/%s' % (server.url, fs.lid), ['hdr', 'adc'])
+            assert cache.size() > 0
+            cache.clear()
+            assert cache.size() == 0
@@ -1,11 +1,15 @@
 import unittest
 import sys
+import random
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
 import numpy as np
+import pandas as pd
 
 from .fileset_info import TEST_FILES, list_test_filesets
-from ifcb.data.roi import RoiFile
+from ifcb.data.roi import RoiFile, coalesce_ranges, iter_all_images
 
 class TestRoi(unittest.TestCase):
     def setUp(self):
@@ -44,3 +48,161 @@ class TestRoi(unittest.TestCase):
             no = 0
             assert no not in roi
 
+
+class TestRoiMmap(unittest.TestCase):
+    def setUp(self):
+        self.data = { fs.lid: fs for fs in list_test_filesets() }
+    def test_images(self):
+        for lid, info in TEST_FILES.items():
+            fs = self.data[lid]
+            roi = RoiFile(fs.adc_path, fs.roi_path)
+            with RoiFile(fs.adc_path, fs.roi_path, mmap=True) as mroi:
+                assert len(mroi) == len(roi)
+                for k in roi.keys():
+                    assert np.all(mroi[k] == roi[k])
+                image = mroi[info['roi_number']]
+                assert image.shape == info['roi_shape']
+                assert type(image) is np.ndarray
+    def test_zero_copy(self):
+        for lid, info in TEST_FILES.items():
+            fs = self.data[lid]
+            with RoiFile(fs.adc_path, fs.roi_path, mmap=True) as roi:
+                image = roi[info['roi_number']]
+                assert not image.flags.writeable, 'image view should be read-only'
+                assert not image.flags.owndata, 'image should be a view'
+    def test_close(self):
+        for lid, info in TEST_FILES.items():
+            fs = self.data[lid]
+            roi = RoiFile(fs.adc_path, fs.roi_path, mmap=True)
+            with roi:
+                assert roi.isopen()
+                image = roi[info['roi_number']]
+            assert not roi.isopen()
+            # images outlive the open file
+            assert image.shape == info['roi_shape']
+            assert roi[info['roi_number']] is not None
+            assert not roi.isopen()
+    def test_fileset_bin(self):
+        for lid, info in TEST_FILES.items():
+            b = self.data[lid].as_bin(mmap=True)
+            with b:
+                assert b.isopen()
+                image = b.images[info['roi_number']]
+                c = tuple(info['roi_slice_coords'])
+                assert np.all(image[c] == info['roi_slice'])
+            assert not b.isopen()
+
+class TestReadMany(unittest.TestCase):
+    def setUp(self):
+        self.filesets = list_test_filesets()
+    def rois(self):
+        for fs in self.filesets:
+            for mmap in [False, True]:
+                yield RoiFile(fs.adc_path, fs.roi_path, mmap=mmap)
+    def test_iter_images(self):
+        for roi in self.rois():
+            keys = list(roi.keys())
+            pairs = list(roi.iter_images())
+            assert [k for k, _ in pairs] == keys
+            for k, im in pairs:
+                assert np.all(im == roi.get_image(k))
+            assert not roi.isopen()
+    def test_items(self):
+        # items reads each image separately, in index order
+        for roi in self.rois():
+            if roi.mmap:
+                continue # images are views of the mapped file
+            pairs = list(roi.items())
+            assert [k for k, _ in pairs] == list(roi.keys())
+            for (_, a), (_, b) in zip(pairs, pairs[1:]):
+                assert not np.shares_memory(a, b)
+    def test_iter_all_images(self):
+        for roi in self.rois():
+            with patch.object(roi, 'iter_images', wraps=roi.iter_images) as iter_images:
+                pairs = list(iter_all_images(roi))
+            assert iter_images.called
+            assert [k for k, _ in pairs] == list(roi.keys())
+        images = { 1: np.zeros((2, 2), dtype=np.uint8) }
+        assert list(iter_all_images(images)) == list(images.items())
+    def test_read_many(self):
+        for roi in self.rois():
+            keys = list(roi.keys())
+            subset = keys[::-2] # out of order, non-adjacent
+            with roi:
+                pairs = dict(roi.read_many(subset))
+                assert roi.isopen()
+                assert set(pairs) == set(subset)
+                for k in subset:
+                    assert np.all(pairs[k] == roi[k])
+    def test_small_reads(self):
+        for roi in self.rois():
+            expected = dict(roi.iter_images())
+            for k, im in roi.iter_images(max_read=1):
+                assert np.all(im == expected[k])
+    def test_missing(self):
+        for roi in self.rois():
+            with self.assertRaises(KeyError):
+                list(roi.read_many([0]))
+    def test_coalesce(self):
+        offsets = [0, 10, 20, 35, 40]
+        lengths = [10, 10, 10, 5, 10]
+        reads = coalesce_ranges(offsets, lengths)
+        assert reads == [(0, 30, 0, 3), (35, 50, 3, 5)]
+        reads = coalesce_ranges(offsets, lengths, max_gap=5)
+        assert reads == [(0, 50, 0, 5)]
+        reads = coalesce_ranges(offsets, lengths, max_read=20)
+        assert reads == [(0, 20, 0, 2), (20, 30, 2, 3), (35, 50, 3, 5)]
+        assert coalesce_ranges([], []) == []
+
+class TestRoiIndex(unittest.TestCase):
+    def test_lookup(self):
+        for fs in list_test_filesets():
+            roi = RoiFile(fs.adc_path, fs.roi_path)
+            s = roi.adc.schema
+            ix = roi.roi_index
+            assert len(ix) == len(roi.csv)
+            assert list(ix.targets) == list(roi.csv.index)
+            assert isinstance(roi.keys(), pd.Index)
+            assert roi.index.equals(roi.csv.index)
+            assert roi.keys() is roi.index # built once
+            roi.clear_cache()
+            assert roi.index.equals(roi.csv.index)
+            for n, row in roi.csv.iterrows():
+                assert ix.lookup(n) == (row[s.START_BYTE], row[s.ROI_HEIGHT], row[s.ROI_WIDTH])
+    def test_missing(self):
+        for fs in list_test_filesets():
+            ix = RoiFile(fs.adc_path, fs.roi_path).roi_index
+            for n in [-1, 0, ix.targets.max() + 1, 10**9]:
+                assert n not in ix
+                with self.assertRaises(KeyError):
+                    ix.lookup(n)
+
+class TestConcurrentReads(unittest.TestCase):
+    N_THREADS = 16
+    N_READS = 2000
+    def hammer(self, roi):
+        expected = { k: np.array(im) for k, im in roi.iter_images() }
+        keys = list(expected)
+        r = random.Random(0)
+        targets = [r.choice(keys) for _ in range(self.N_READS)]
+        def read(k):
+            return k, roi[k]
+        with ThreadPoolExecutor(self.N_THREADS) as pool:
+            for k, im in pool.map(read, targets):
+                assert np.array_equal(im, expected[k]), 'corrupt image from concurrent read'
+    def test_open(self):
+        for fs in list_test_filesets():
+            with fs.as_bin() as b:
+                self.hammer(b.images)
+    def test_closed(self):
+        for fs in list_test_filesets():
+            self.hammer(fs.as_bin().images)
+    def test_mmap(self):
+        for fs in list_test_filesets():
+            with fs.as_bin(mmap=True) as b:
+                self.hammer(b.images)
+    def test_without_pread(self):
+        with patch('ifcb.data.roi.HAS_PREAD', False):
+            for fs in list_test_filesets():
+                with fs.as_bin() as b:
+                    self.hammer(b.images)
@@ -19,6 +19,18 @@ class TestStitcher(unittest.TestCase):
                 assert target in s, 'stitched target missing'
                 assert s[target].shape == tf['stitched_roi_shape'], 'stitched roi shape wrong'
                 assert np.all(s[target][coords] == tf['stitched_roi_slice']), 'stitched roi data wrong'
+    def test_clear_cache(self):
+        dd = DataDirectory(TEST_DATA_DIR)
+        for lid, tf in TEST_FILES.items():
+            if 'stitched_roi_number' not in tf:
+                continue
+            s = Stitcher(dd[lid])
+            coords = s.coordinates
+            assert s.coordinates is coords
+            assert s.excluded_targets() is s.excluded_targets()
+            s.clear_cache()
+            assert s.coordinates is not coords
+            assert s.coordinates.equals(coords)
     def test_infilled_keys(self):
         dd = DataDirectory(TEST_DATA_DIR)
         for lid, tf in TEST_FILES.items():
@@ -45,3 +57,33 @@ class TestStitcher(unittest.TestCase):
                     assert roi_corners[rn] == corners
 
         
+    def test_boxes(self):
+        dd = DataDirectory(TEST_DATA_DIR)
+        for lid, tf in TEST_FILES.items():
+            if 'stitched_roi_number' not in tf:
+                continue
+            b = dd[lid]
+            s = Stitcher(b)
+            coords = s.coordinates
+            assert list(s.keys()) == list(coords.index)
+            for k, row in coords.iterrows():
+                assert s.shape(k) == (row['sy2'] - row['sy1'], row['sx2'] - row['sx1'])
+                assert s.boxes.box(k) == { c: row[c] for c in s.boxes.COLUMNS }
+            excluded = set(s.excluded_targets())
+            for k in b:
+                assert s.is_excluded(k) == (k in excluded)
+                assert (k in s) == (k in coords.index)
+            assert not s.is_excluded(-1) and not s.is_excluded(10**9) and 10**9 not in s
+            with self.assertRaises(KeyError):
+                s.shape(10**9)
+    def test_infilled_shape(self):
+        dd = DataDirectory(TEST_DATA_DIR)
+        for lid, tf in TEST_FILES.items():
+            if 'roi_numbers_stitched' not in tf:
+                continue
+            with dd[lid] as b:
+                ii = InfilledImages(b)
+                for k in ii.keys():
+                    assert ii.shape(k) == ii[k].shape
+                with self.assertRaises(KeyError):
+                    ii.shape(10**9)
@@ -0,0 +1,81 @@
+import unittest
+import threading
+
+import numpy as np
+
+from ifcb.data.streaming import ImageStream
+
+from .fileset_info import list_test_bins
+
+class SyntheticImages(object):
+    """images of a fixed size, recording how many have been read"""
+    def __init__(self, n, shape=(100, 100), fail_at=None):
+        self.n = n
+        self.shape = shape
+        self.fail_at = fail_at
+        self.n_read = 0
+    def items(self):
+        for k in range(1, self.n + 1):
+            if k == self.fail_at:
+                raise IOError('read failed')
+            self.n_read += 1
+            yield k, np.full(self.shape, k % 256, dtype=np.uint8)
+
+class TestImageStream(unittest.TestCase):
+    def test_order(self):
+        for b in list_test_bins():
+            with b:
+                expected = list(b.images.keys())
+                with ImageStream(b.images) as stream:
+                    items = list(stream)
+                assert [k for k, _ in items] == expected
+                for k, image in items:
+                    assert np.all(image == b.images[k])
+    def test_bounded(self):
+        images = SyntheticImages(50)
+        with ImageStream(images, buffer_size=35000) as stream:
+            for k, image in stream:
+                assert image[0, 0] == k % 256
+        assert 0 < stream.max_buffered <= 35000
+    def test_at_least_one(self):
+        # images bigger than the buffer are streamed one at a time
+        with ImageStream(SyntheticImages(5), buffer_size=10) as stream:
+            assert len(list(stream)) == 5
+        assert stream.max_buffered == 100 * 100
+    def test_error(self):
+        with ImageStream(SyntheticImages(10, fail_at=4)) as stream:
+            with self.assertRaises(IOError):
+                for _ in stream:
+                    pass
+    def test_close(self):
+        images = SyntheticImages(1000)
+        stream = ImageStream(images, buffer_size=50000)
+        it = iter(stream)
+        next(it)
+        stream.close()
+        assert images.n_read < 1000
+        assert not stream._thread.is_alive()
+    def test_once(self):
+        with ImageStream(SyntheticImages(2)) as stream:
+            list(stream)
+            with self.assertRaises(ValueError):
+                list(stream)
+    def test_views_copied(self):
+        # views into a shared block are copied, so buffered images
+        # do not keep the block alive
+        block = np.zeros(100000, dtype=np.uint8)
+        class Views(object):
+            def items(self):
+                for k in range(10):
+                    yield k, block[k*100:(k+1)*100].reshape((10, 10))
+        with ImageStream(Views(), buffer_size=1000) as stream:
+            for k, image in stream:
+                assert not np.shares_memory(image, block)
+        assert stream.max_buffered <= 1000
+    def test_owned_not_copied(self):
+        image = np.zeros((10, 10), dtype=np.uint8)
+        class Owned(object):
+            def items(self):
+                yield 1, image
+        with ImageStream(Owned()) as stream:
+            assert next(iter(stream))[1] is image
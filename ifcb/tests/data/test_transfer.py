@@ -0,0 +1,234 @@
+import os
+import shutil
+import unittest
+
+from ifcb.data.transfer.remote import RemoteIfcb, TEMP_SUFFIX, MTIME_SUFFIX
+from ifcb.data.transfer.transport import LocalTransport, RemoteFile
+from ifcb.data.transfer.smb_utils import sync_directory, sync_order, list_remote_files, MANIFEST_NAME
+
+from ifcb.tests.utils import test_dir
+
+from .fileset_info import list_test_filesets
+
+class FlakyTransport(LocalTransport):
+    """fails after writing ``fail_after`` bytes of any file, once"""
+    def __init__(self, root, fail_after=None, log=None):
+        super(FlakyTransport, self).__init__(root)
+        self.fail_after = fail_after
+        self.log = log if log is not None else []
+    def retrieve(self, path, fout, offset=0):
+        self.log.append((path, offset))
+        if self.fail_after is not None:
+            with open(self._path(path), 'rb') as fin:
+                fin.seek(offset)
+                fout.write(fin.read(self.fail_after))
+            self.fail_after = None
+            raise IOError('connection lost')
+        return super(FlakyTransport, self).retrieve(path, fout, offset)
+
+class GrowingTransport(LocalTransport):
+    """reports files as ``shrink`` bytes smaller than they are, as if
+    they grew between stat and retrieve"""
+    def __init__(self, root, shrink):
+        super(GrowingTransport, self).__init__(root)
+        self.shrink = shrink
+    def stat(self, path):
+        f = super(GrowingTransport, self).stat(path)
+        return f._replace(size=f.size - self.shrink)
+
+def _same_contents(a, b):
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        return fa.read() == fb.read()
+
+class TestRemoteIfcb(unittest.TestCase):
+    def setUp(self):
+        self.remote_dir = test_dir()
+        self.local_dir = test_dir()
+        self.remote = self.remote_dir.__enter__()
+        self.local = self.local_dir.__enter__()
+        self.filesets = list_test_filesets()
+        for fs in self.filesets:
+            for path in [fs.hdr_path, fs.adc_path, fs.roi_path]:
+                shutil.copy(path, self.remote)
+        self.lids = [fs.lid for fs in self.filesets]
+    def tearDown(self):
+        self.remote_dir.__exit__(None, None, None)
+        self.local_dir.__exit__(None, None, None)
+    def _ifcb(self, **kw):
+        log = []
+        ifcb = RemoteIfcb(None, None, None, transport=lambda: FlakyTransport(self.remote, log=log, **kw))
+        return ifcb, log
+    def _assert_transferred(self, lid):
+        for ext in ['hdr', 'adc', 'roi']:
+            fn = '{}.{}'.format(lid, ext)
+            assert _same_contents(os.path.join(self.remote, fn), os.path.join(self.local, fn))
+            assert not os.path.exists(os.path.join(self.local, fn + TEMP_SUFFIX))
+    def test_list_filesets(self):
+        ifcb, _ = self._ifcb()
+        with ifcb:
+            assert ifcb.list_filesets() == sorted(self.lids, reverse=True)
+    def test_transfer_fileset(self):
+        ifcb, log = self._ifcb()
+        with ifcb:
+            transfers = ifcb.transfer_fileset(self.lids[0], self.local)
+            assert [t.name for t in transfers] == ['{}.{}'.format(self.lids[0], e) for e in ['hdr', 'adc', 'roi']]
+            assert all(t.transferred == t.size for t in transfers)
+            assert all(t.throughput is None or t.throughput > 0 for t in transfers)
+            self._assert_transferred(self.lids[0])
+            # existing files are skipped
+            transfers = ifcb.transfer_fileset(self.lids[0], self.local)
+            assert all(t.transferred == 0 for t in transfers)
+            assert len(log) == 3
+    def test_transfer_filesets(self):
+        ifcb, log = self._ifcb()
+        with ifcb:
+            results = ifcb.transfer_filesets(self.lids, self.local, workers=2)
+        assert set(results) == set(self.lids)
+        for lid in self.lids:
+            self._assert_transferred(lid)
+        assert len(log) == 3 * len(self.lids)
+    def test_resume(self):
+        lid = self.lids[0]
+        roi = '{}.roi'.format(lid)
+        size = os.path.getsize(os.path.join(self.remote, roi))
+        ifcb, log = self._ifcb(fail_after=100)
+        with ifcb:
+            with self.assertRaises(IOError):
+                ifcb.transfer_filesets([lid], self.local)
+            # the .hdr transfer failed partway; its partial download is kept
+            hdr = '{}.hdr'.format(lid)
+            assert os.path.getsize(os.path.join(self.local, hdr + TEMP_SUFFIX)) == 100
+            transfers = ifcb.transfer_filesets([lid], self.local)[lid]
+        assert transfers[0].offset == 100
+        assert transfers[0].transferred == transfers[0].size - 100
+        assert (hdr, 100) in log
+        assert transfers[2].size == size
+        self._assert_transferred(lid)
+    def test_resume_rewritten(self):
+        lid = self.lids[0]
+        hdr = '{}.hdr'.format(lid)
+        temp_path = os.path.join(self.local, hdr + TEMP_SUFFIX)
+        mtime = os.path.getmtime(os.path.join(self.remote, hdr))
+        ifcb, log = self._ifcb()
+        with ifcb:
+            # a partial download of an older version of the file
+            for partial_mtime in [mtime - 60, None]:
+                with open(temp_path, 'wb') as fout:
+                    fout.write(b'x' * 100)
+                if partial_mtime is not None:
+                    with open(temp_path + MTIME_SUFFIX, 'w') as fout:
+                        fout.write(repr(partial_mtime))
+                transfers = ifcb.transfer_fileset(lid, self.local, skip_existing=False)
+                assert transfers[0].offset == 0
+                assert (hdr, 0) in log
+                self._assert_transferred(lid)
+                assert not os.path.exists(temp_path + MTIME_SUFFIX)
+    def test_grown(self):
+        lid = self.lids[0]
+        ifcb = RemoteIfcb(None, None, None, transport=lambda: GrowingTransport(self.remote, 10))
+        with ifcb:
+            transfers = ifcb.transfer_fileset(lid, self.local)
+        for t in transfers:
+            assert t.size == os.path.getsize(os.path.join(self.remote, t.name))
+        self._assert_transferred(lid)
+    def test_not_connected(self):
+        ifcb, _ = self._ifcb()
+        with self.assertRaises(ValueError):
+            ifcb.transfer_filesets(self.lids, self.local)
+        with self.assertRaises(ValueError):
+            ifcb.transfer_fileset(self.lids[0], self.local)
+    def test_partial_failure(self):
+        ifcb, _ = self._ifcb()
+        with ifcb:
+            with self.assertRaises(OSError):
+                ifcb.transfer_filesets(['D20990101T000000_IFCB999'] + self.lids, self.local)
+        for lid in self.lids:
+            self._assert_transferred(lid)
+
+class CountingTransport(LocalTransport):
+    def __init__(self, root):
+        super(CountingTransport, self).__init__(root)
+        self.retrieved = []
+    def retrieve(self, path, fout, offset=0):
+        self.retrieved.append(path)
+        return super(CountingTransport, self).retrieve(path, fout, offset)
+
+class TestSyncDirectory(unittest.TestCase):
+    def setUp(self):
+        self._dirs = [test_dir(), test_dir()]
+        self.remote, self.local = [d.__enter__() for d in self._dirs]
+        self.filesets = list_test_filesets()
+        for fs in self.filesets:
+            for path in [fs.hdr_path, fs.adc_path, fs.roi_path]:
+                shutil.copy(path, self.remote)
+    def tearDown(self):
+        for d in self._dirs:
+            d.__exit__(None, None, None)
+    def _names(self):
+        return sorted(n for n in os.listdir(self.remote))
+    def test_sync(self):
+        t = CountingTransport(self.remote)
+        assert sync_directory(t, '', self.local) == 6
+        for name in self._names():
+            assert _same_contents(os.path.join(self.remote, name), os.path.join(self.local, name))
+        # nothing has changed
+        t = CountingTransport(self.remote)
+        assert sync_directory(t, '', self.local) == 0
+        assert t.retrieved == []
+    def test_changed(self):
+        sync_directory(LocalTransport(self.remote), '', self.local)
+        name = self._names()[0]
+        with open(os.path.join(self.remote, name), 'ab') as fout:
+            fout.write(b'more')
+        os.remove(os.path.join(self.local, self._names()[1]))
+        t = CountingTransport(self.remote)
+        assert sync_directory(t, '', self.local) == 2
+        assert sorted(t.retrieved) == self._names()[:2]
+        assert _same_contents(os.path.join(self.remote, name), os.path.join(self.local, name))
+    def test_existing_without_manifest(self):
+        for name in self._names():
+            shutil.copy(os.path.join(self.remote, name), self.local)
+        t = CountingTransport(self.remote)
+        assert sync_directory(t, '', self.local) == 0
+        assert os.path.exists(os.path.join(self.local, MANIFEST_NAME))
+    def test_order(self):
+        # an incomplete fileset, and complete filesets with different ages
+        lids = [fs.lid for fs in self.filesets]
+        os.remove(os.path.join(self.remote, lids[0] + '.roi'))
+        shutil.copy(self.filesets[1].roi_path, os.path.join(self.remote, 'D20990101T000000_IFCB999.roi'))
+        for fs, t in zip(self.filesets, [3000, 1000]):
+            for ext in ['hdr', 'adc', 'roi']:
+                path = os.path.join(self.remote, '{}.{}'.format(fs.lid, ext))
+                if os.path.exists(path):
+                    os.utime(path, (t, t))
+        t = CountingTransport(self.remote)
+        sync_directory(t, '', self.local)
+        # the only complete fileset comes first
+        assert sorted(t.retrieved[:3]) == ['{}.{}'.format(lids[1], e) for e in ['adc', 'hdr', 'roi']]
+        assert len(t.retrieved) == 6
+    def test_limit(self):
+        t = CountingTransport(self.remote)
+        assert sync_directory(t, '', self.local, limit=2) == 2
+        assert sync_directory(t, '', self.local) == 4
+    def test_recursive(self):
+        sub = os.path.join(self.remote, 'sub', 'dir')
+        os.makedirs(sub)
+        shutil.copy(self.filesets[0].hdr_path, sub)
+        name = 'sub/dir/' + os.path.basename(self.filesets[0].hdr_path)
+        assert sync_directory(LocalTransport(self.remote), '', self.local) == 6
+        assert sync_directory(LocalTransport(self.remote), '', self.local, recursive=True) == 1
+        assert _same_contents(self.filesets[0].hdr_path, os.path.join(self.local, name))
+        files = list_remote_files(LocalTransport(self.remote), '', recursive=True)
+        assert name in files and 'sub' not in files
+    def test_sync_order(self):
+        remote_files = {}
+        for lid, t in [('old', 1), ('new', 3), ('partial', 5)]:
+            for ext in ['hdr', 'adc', 'roi']:
+                if lid == 'partial' and ext == 'roi':
+                    continue
+                name = '{}.{}'.format(lid, ext)
+                remote_files[name] = RemoteFile(name, 10, t, False)
+        remote_files['notes.txt'] = RemoteFile('notes.txt', 10, 4, False)
+        order = sync_order(list(remote_files), remote_files)
+        assert [n.split('.')[0] for n in order[:6]] == ['new'] * 3 + ['old'] * 3
+        assert order[6:] == ['partial.hdr', 'partial.adc', 'notes.txt']
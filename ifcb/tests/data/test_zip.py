@@ -1,4 +1,9 @@
 import unittest
+import gc
+import weakref
+from zipfile import ZipFile, ZIP_STORED
+
+import numpy as np
 
 from ifcb.data.zip import bin2zip, ZipBin
 from ifcb.data.files import FilesetBin
@@ -16,3 +21,68 @@ class TestZipBin(unittest.TestCase):
                 bin2zip(out_bin, path)
                 with ZipBin(path) as in_bin:
                     assert_bin_equals(in_bin, out_bin)
+    @withfile
+    def test_workers(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2zip(out_bin, path)
+                with ZipFile(path) as z:
+                    expected = [(i.filename, z.read(i.filename)) for i in z.infolist()]
+                for workers in [1, 2, 4]:
+                    bin2zip(out_bin, path, workers=workers)
+                    with ZipFile(path) as z:
+                        actual = [(i.filename, z.read(i.filename)) for i in z.infolist()]
+                    assert actual == expected
+                # options are passed through the bin API
+                out_bin.to_zip(path, workers=2)
+                with ZipFile(path) as z:
+                    assert [(i.filename, z.read(i.filename)) for i in z.infolist()] == expected
+    @withfile
+    def test_raw_roundtrip(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                out_bin.to_zip(path, raw=True)
+                with ZipBin(path) as in_bin:
+                    assert in_bin.image_format == 'raw'
+                    assert_bin_equals(in_bin, out_bin)
+                with ZipFile(path) as z:
+                    for i in z.infolist():
+                        assert i.compress_type == ZIP_STORED
+                        assert not i.filename.endswith('.png')
+    @withfile
+    def test_raw_views(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2zip(out_bin, path, raw=True)
+                with ZipBin(path) as in_bin:
+                    images = dict(in_bin.images.items())
+                    for k, image in images.items():
+                        # zero-copy views into the mapped archive
+                        assert np.shares_memory(image, in_bin.images._data)
+                        assert not image.flags.writeable
+                    with self.assertRaises(KeyError):
+                        in_bin.images[0]
+                # images remain valid after the archive is closed
+                for k, image in images.items():
+                    assert np.all(image == out_bin.images[k])
+    @withfile
+    def test_raw_close(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2zip(out_bin, path, raw=True)
+            with ZipBin(path) as in_bin:
+                image = in_bin.images[list(in_bin.images.keys())[0]]
+                data = weakref.ref(in_bin.images._data)
+            # closing drops the bin's reference to the mapping
+            assert in_bin.images._data is None
+            assert data() is not None # still used by the image
+            del image
+            gc.collect()
+            assert data() is None
+    @withfile
+    def test_png_format(self, path):
+        for out_bin in list_test_bins():
+            with out_bin:
+                bin2zip(out_bin, path)
+                with ZipBin(path) as in_bin:
+                    assert in_bin.image_format == 'png'
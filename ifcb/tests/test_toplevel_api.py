@@ -15,6 +15,7 @@ class TestToplevelAPI(unittest.TestCase):
         ifcb.open_zip
         ifcb.open_mat
         ifcb.open_url
+        ifcb.open_urls
         ifcb.parse_adc_file
         ifcb.parse_hdr_file
         ifcb.read_image
@@ -1,8 +1,13 @@
+import io
 import os
+import re
+import time
 import shutil
 import tempfile
+import threading
 from contextlib import contextmanager
-from functools import wraps
+from functools import wraps, partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
 @contextmanager
 def test_dir():
@@ -29,3 +34,63 @@ def withfile(method):
             return method(*args, **kw)
     return wrapper
 
+
+class _RangeRequestHandler(SimpleHTTPRequestHandler):
+    """serves files from the server's directory, honoring single Range headers"""
+    def log_message(self, *args):
+        pass
+    def send_head(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path, self.headers.get('Range')))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+            return self._send_head()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+    def _send_head(self):
+        path = self.translate_path(self.path)
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m is None or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+        size = os.path.getsize(path)
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return io.BytesIO(data)
+
+@contextmanager
+def http_server(directory, latency=0):
+    """context mgr for a local HTTP server serving the files in a
+    directory. yields the server, whose ``url`` attribute is the base URL
+    and whose ``requests`` attribute lists (method, path, range) for each
+    request. ``max_in_flight`` is the largest number of requests that
+    were being handled at once. ``latency`` is a delay in seconds added
+    to each request"""
+    handler = partial(_RangeRequestHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.lock = threading.Lock()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.latency = latency
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
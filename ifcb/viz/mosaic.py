@@ -1,5 +1,3 @@
-from functools import lru_cache
-
 from rectpack import newPacker, SORT_AREA
 from rectpack.guillotine import GuillotineBafSlas
 
@@ -7,6 +5,7 @@ import numpy as np
 import pandas as pd
 
 from ifcb.data.stitching import InfilledImages
+from ifcb.data.utils import cached_method
 
 class Mosaic(object):
     def __init__(self, the_bin, shape=(720, 1280), bg_color=200):
@@ -14,7 +13,7 @@ class Mosaic(object):
         self.shape = shape
         self.bg_color = bg_color
         self.ii = InfilledImages(self.bin)
-    @lru_cache()
+    @cached_method
     def _shapes(self):
         hs, ws, ix = [], [], []
         for target_number in self.ii:
@@ -22,8 +21,8 @@ class Mosaic(object):
             hs.append(h)
             ws.append(w)
             ix.append(target_number)
-        return zip(hs, ws, ix)
-    @lru_cache()
+        return list(zip(hs, ws, ix))
+    @cached_method
     def pack(self):
         page_h, page_w = self.shape
         pages = [(page_h - 1, page_w - 1) for _ in range(20)]